@@ -19,6 +19,7 @@ normal_queues = [
     "missedmessage_emails",
     "missedmessage_mobile_notifications",
     "outgoing_webhooks",
+    "translation",
     "user_activity",
     "user_activity_interval",
     "user_presence",
@@ -41,12 +42,14 @@ MAX_SECONDS_TO_CLEAR: DefaultDict[str, int] = defaultdict(
     digest_emails=1200,
     missedmessage_mobile_notifications=120,
     embed_links=60,
+    translation=60,
 )
 CRITICAL_SECONDS_TO_CLEAR: DefaultDict[str, int] = defaultdict(
     lambda: 60,
     missedmessage_mobile_notifications=180,
     digest_emails=1800,
     embed_links=90,
+    translation=90,
 )
 
 
@@ -1,5 +1,6 @@
 import datetime
 import itertools
+import logging
 from collections import defaultdict
 from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 
@@ -64,6 +65,7 @@ from zerver.models import (
     ArchivedAttachment,
     Attachment,
     Message,
+    MessageTranslation,
     Reaction,
     Stream,
     UserMessage,
@@ -312,6 +314,8 @@ def do_update_embedded_data(
         message.rendered_content_version = markdown_version
         event["content"] = content
         event["rendered_content"] = rendered_content
+        # Stored translations don't include the new embedded content.
+        MessageTranslation.objects.filter(message_id=message.id).delete()
 
     message.save(update_fields=["content", "rendered_content"])
 
@@ -326,6 +330,71 @@ def do_update_embedded_data(
     send_event(user_profile.realm, event, list(map(user_info, ums)))
 
 
+def do_rerender_degraded_message(message_id: int) -> None:
+    """Renders in full a message which was sent with a degraded
+    rendering, because it took too long to render (see
+    render_degraded_markdown), and updates its recipients' flags for
+    mentions and alert words, which the degraded rendering only
+    approximated."""
+    message = (
+        Message.objects.select_related("realm", "sender", "sending_client")
+        .filter(id=message_id)
+        .first()
+    )
+    if message is None:
+        return
+    realm = message.realm
+    mention_data = MentionData(MentionBackend(realm.id), message.content)
+    try:
+        rendering_result = render_incoming_message(
+            message, message.content, realm, mention_data=mention_data
+        )
+    except JsonableError:
+        logging.warning(
+            "Failed to render message %s in full; it keeps its degraded rendering", message.id
+        )
+        return
+
+    # add data from group mentions to mentions_user_ids.
+    for group_id in rendering_result.mentions_user_group_ids:
+        members = mention_data.get_group_members(group_id)
+        rendering_result.mentions_user_ids.update(members)
+
+    with transaction.atomic(savepoint=False):
+        # Editing the message renders it in full too, so if it's been
+        # edited (or deleted) while we were rendering it, we're done.
+        current_content = list(
+            Message.objects.select_for_update()
+            .filter(id=message.id)
+            .values_list("content", flat=True)
+        )
+        if current_content != [message.content]:
+            return
+
+        message.rendered_content = rendering_result.rendered_content
+        message.rendered_content_version = markdown_version
+        message.save(
+            update_fields=["rendered_content", "rendered_content_version", "has_link", "has_image"]
+        )
+        # Stored translations are of the degraded rendering.
+        MessageTranslation.objects.filter(message_id=message.id).delete()
+        ums = list(UserMessage.objects.filter(message=message.id))
+        update_user_message_flags(rendering_result, ums)
+
+    event: Dict[str, Any] = {
+        "type": "update_message",
+        "user_id": None,
+        "edit_timestamp": datetime_to_timestamp(timezone_now()),
+        "message_id": message.id,
+        "message_ids": update_to_dict_cache([message], realm.id),
+        "rendering_only": True,
+        "content": message.content,
+        "rendered_content": message.rendered_content,
+    }
+    users = [{"id": um.user_profile_id, "flags": um.flags_list()} for um in ums]
+    send_event(realm, event, users)
+
+
 def get_visibility_policy_after_merge(
     orig_topic_visibility_policy: int, target_topic_visibility_policy: int
 ) -> int:
@@ -436,6 +505,9 @@ def do_update_message(
         target_message.content = content
         target_message.rendered_content = rendering_result.rendered_content
         target_message.rendered_content_version = markdown_version
+        # Translations of the old content are stale; they'll be filled
+        # in again, lazily, as users fetch the edited message.
+        MessageTranslation.objects.filter(message_id=target_message.id).delete()
         event["content"] = content
         event["rendered_content"] = rendering_result.rendered_content
         event["prev_rendered_content_version"] = target_message.rendered_content_version
@@ -0,0 +1,135 @@
+import logging
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils.timezone import now as timezone_now
+
+from zerver.lib.markdown.render_pool import MarkdownRenderPool, get_shared_render_pool
+from zerver.lib.message import RenderingChange, get_last_message_id, rerender_messages
+from zerver.lib.queue import queue_json_publish
+from zerver.lib.timestamp import datetime_to_timestamp
+from zerver.models import Message, Realm, UserMessage
+from zerver.tornado.django_api import send_events
+
+logger = logging.getLogger(__name__)
+
+# Existing messages are re-rendered by scanning this many message IDs
+# at a time, so that each query is bounded, however few messages in
+# the range are from the realm, or contain the text we're looking for.
+RERENDER_SCAN_WINDOW = 5000
+
+# Each rerender_messages event on the deferred_work queue works for
+# about this long, and then queues an event to continue from where it
+# stopped; so other deferred work isn't held up, and a restarted
+# worker loses at most one step's progress.
+RERENDER_STEP_SECONDS = 10
+
+
+def do_rerender_messages(
+    realm: Realm,
+    messages: List[Message],
+    render_pool: MarkdownRenderPool,
+    change: Optional[RenderingChange] = None,
+) -> List[Message]:
+    """Like rerender_messages, but also sends update_message events
+    for the messages whose rendering changed."""
+    changed_messages = rerender_messages(realm, messages, render_pool, change)
+    if not changed_messages:
+        return changed_messages
+
+    users_by_message: Dict[int, List[Dict[str, Any]]] = defaultdict(list)
+    for message_id, user_profile_id, flags in UserMessage.objects.filter(
+        message_id__in=[message.id for message in changed_messages]
+    ).values_list("message_id", "user_profile_id", "flags"):
+        users_by_message[message_id].append(
+            {"id": user_profile_id, "flags": UserMessage.flags_list_for_flags(flags)}
+        )
+
+    edit_timestamp = datetime_to_timestamp(timezone_now())
+    send_events(
+        (
+            realm,
+            {
+                "type": "update_message",
+                "user_id": None,
+                "edit_timestamp": edit_timestamp,
+                "message_id": message.id,
+                "message_ids": [message.id],
+                "rendering_only": True,
+                "content": message.content,
+                "rendered_content": message.rendered_content,
+            },
+            users_by_message[message.id],
+        )
+        for message in changed_messages
+    )
+    return changed_messages
+
+
+def queue_rerender_messages(
+    realm: Realm, substrings: Optional[List[str]], change: RenderingChange
+) -> None:
+    """Queues re-rendering the realm's existing messages which contain
+    (case-insensitively) any of `substrings`, or all of its messages,
+    if `substrings` is None, for `change`; messages sent later will be
+    rendered with the change anyway.  Only renderings which differ
+    just because of `change` are saved; see rerender_messages.
+    """
+    if substrings == []:
+        return
+    event = {
+        "type": "rerender_messages",
+        "realm_id": realm.id,
+        "substrings": substrings,
+        "emoji_name": change.emoji_name,
+        "after_id": 0,
+        "max_id": get_last_message_id(),
+    }
+    transaction.on_commit(lambda: queue_json_publish("deferred_work", event))
+
+
+def queue_rerender_degraded_message(message: Message) -> None:
+    """Queues rendering a message in full, which was sent with a
+    degraded rendering because it took too long to render; see
+    do_rerender_degraded_message."""
+    event = {
+        "type": "rerender_degraded_message",
+        "message_id": message.id,
+    }
+    transaction.on_commit(lambda: queue_json_publish("deferred_work", event))
+
+
+def process_rerender_messages_event(event: Dict[str, Any]) -> None:
+    realm = Realm.objects.get(id=event["realm_id"])
+    query = Message.objects.filter(realm_id=realm.id)
+    if event["substrings"] is not None:
+        content_filter = Q()
+        for substring in event["substrings"]:
+            content_filter |= Q(content__icontains=substring)
+        query = query.filter(content_filter)
+    query = query.select_related("sender", "sending_client").order_by("id")
+
+    change = RenderingChange(emoji_name=event.get("emoji_name"))
+    render_pool = get_shared_render_pool()
+    after_id = event["after_id"]
+    max_id = event["max_id"]
+    start = time.time()
+    changed_count = 0
+    while after_id < max_id and time.time() - start < RERENDER_STEP_SECONDS:
+        window_end = min(after_id + RERENDER_SCAN_WINDOW, max_id)
+        messages = list(query.filter(id__gt=after_id, id__lte=window_end))
+        changed_count += len(do_rerender_messages(realm, messages, render_pool, change))
+        after_id = window_end
+
+    logger.info(
+        "Re-rendered messages in realm %s through ID %s of %s; %s changed",
+        realm.id,
+        after_id,
+        max_id,
+        changed_count,
+    )
+    if after_id < max_id:
+        queue_json_publish("deferred_work", {**event, "after_id": after_id})
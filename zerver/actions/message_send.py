@@ -9,7 +9,9 @@ from typing import (
     Callable,
     Collection,
     Dict,
+    Iterable,
     List,
+    Mapping,
     Optional,
     Sequence,
     Set,
@@ -22,18 +24,19 @@ import orjson
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.db import IntegrityError, transaction
-from django.db.models import F
 from django.utils.html import escape
 from django.utils.timezone import now as timezone_now
 from django.utils.translation import gettext as _
 from django.utils.translation import override as override_language
 from django_stubs_ext import ValuesQuerySet
 
+from zerver.actions.message_rerender import queue_rerender_degraded_message
 from zerver.actions.uploads import do_claim_attachments
 from zerver.lib.addressee import Addressee
 from zerver.lib.alert_words import get_alert_word_automaton
 from zerver.lib.cache import cache_with_key, user_profile_delivery_email_cache_key
 from zerver.lib.create_user import create_user
+from zerver.lib.delivery_snapshot import StreamDeliverySnapshot, get_stream_delivery_snapshot
 from zerver.lib.exceptions import (
     JsonableError,
     MarkdownRenderingError,
@@ -41,8 +44,13 @@ from zerver.lib.exceptions import (
     StreamWithIDDoesNotExistError,
     ZephyrMessageAlreadySentError,
 )
-from zerver.lib.markdown import MessageRenderingResult
+from zerver.lib.markdown import (
+    MarkdownRenderTask,
+    MessageRenderingResult,
+    prepare_markdown_render,
+)
 from zerver.lib.markdown import version as markdown_version
+from zerver.lib.markdown.render_pool import RenderedMessage, get_shared_render_pool
 from zerver.lib.mention import MentionBackend, MentionData
 from zerver.lib.message import (
     MessageDict,
@@ -57,14 +65,10 @@ from zerver.lib.muted_users import get_muting_users
 from zerver.lib.notification_data import (
     UserMessageNotificationsData,
     get_user_group_mentions_data,
-    user_allows_notifications_in_StreamTopic,
 )
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.recipient_users import recipient_for_user_profiles
-from zerver.lib.stream_subscription import (
-    get_subscriptions_for_send_message,
-    num_subscribers_for_stream_id,
-)
+from zerver.lib.stream_subscription import num_subscribers_for_stream_id
 from zerver.lib.stream_topic import StreamTopicTarget
 from zerver.lib.streams import access_stream_for_send_message, ensure_stream
 from zerver.lib.string_validation import check_stream_name
@@ -74,7 +78,7 @@ from zerver.lib.topic import (
     participants_for_topic,
 )
 from zerver.lib.url_preview.types import UrlEmbedData
-from zerver.lib.user_message import UserMessageLite, bulk_insert_ums
+from zerver.lib.user_message import UserMessageRows, bulk_insert_user_message_rows
 from zerver.lib.validator import check_widget_content
 from zerver.lib.widget import do_widget_post_save_actions
 from zerver.models import (
@@ -96,9 +100,7 @@ from zerver.models import (
     is_cross_realm_bot_email,
     query_for_ids,
 )
-from zerver.tornado.django_api import send_event
-
-from zerver.lib.translate import translate_message
+from zerver.tornado.django_api import send_events
 
 
 def compute_irc_user_fullname(email: str) -> str:
@@ -146,6 +148,7 @@ def render_incoming_message(
     mention_data: Optional[MentionData] = None,
     url_embed_data: Optional[Dict[str, Optional[UrlEmbedData]]] = None,
     email_gateway: bool = False,
+    allow_degraded: bool = False,
 ) -> MessageRenderingResult:
     realm_alert_words_automaton = get_alert_word_automaton(realm)
 
@@ -158,12 +161,71 @@ def render_incoming_message(
             mention_data=mention_data,
             url_embed_data=url_embed_data,
             email_gateway=email_gateway,
+            allow_degraded=allow_degraded,
         )
     except MarkdownRenderingError:
         raise JsonableError(_("Unable to render message"))
     return rendering_result
 
 
+@dataclass
+class PrerenderedMessage:
+    content: str
+    mention_data: MentionData
+    rendered: RenderedMessage
+
+
+def render_incoming_messages(
+    realm: Realm,
+    sender: UserProfile,
+    message_contents: Sequence[str],
+    mention_backend: MentionBackend,
+) -> List[Optional[PrerenderedMessage]]:
+    """Renders the content of several messages from `sender` at once,
+    for passing to check_message, so that they can be rendered in
+    parallel; see zerver.lib.markdown.render_pool.  Returns None for
+    content that's invalid or fails to render, which check_message
+    will render (and report on) itself.
+    """
+    realm_alert_words_automaton = get_alert_word_automaton(realm)
+
+    prerendered_messages: List[Optional[PrerenderedMessage]] = [None] * len(message_contents)
+    indexes: List[int] = []
+    contents: List[str] = []
+    mention_datas: List[MentionData] = []
+    # The Messages don't exist yet, so we render as if for placeholders;
+    # build_message_send_dict copies the flags rendering sets from the
+    # RenderedMessage.
+    tasks: List[Tuple[MarkdownRenderTask, Optional[Message]]] = []
+    for i, message_content in enumerate(message_contents):
+        try:
+            content = normalize_body(message_content)
+        except JsonableError:
+            continue
+        mention_data = MentionData(mention_backend=mention_backend, content=content)
+        task = prepare_markdown_render(
+            content,
+            realm_alert_words_automaton=realm_alert_words_automaton,
+            message_realm=realm,
+            sent_by_bot=sender.is_bot,
+            translate_emoticons=sender.translate_emoticons,
+            mention_data=mention_data,
+            allow_degraded=True,
+        )
+        indexes.append(i)
+        contents.append(content)
+        mention_datas.append(mention_data)
+        tasks.append((task, Message()))
+
+    results = get_shared_render_pool().render(tasks)
+    for i, content, mention_data, rendered in zip(indexes, contents, mention_datas, results):
+        if rendered is not None:
+            prerendered_messages[i] = PrerenderedMessage(
+                content=content, mention_data=mention_data, rendered=rendered
+            )
+    return prerendered_messages
+
+
 @dataclass
 class RecipientInfoResult:
     active_user_ids: Set[int]
@@ -215,6 +277,9 @@ def get_recipient_info(
     topic_wildcard_mention_in_followed_topic_user_ids: Set[int] = set()
     stream_wildcard_mention_in_followed_topic_user_ids: Set[int] = set()
     muted_sender_user_ids: Set[int] = get_muting_users(sender_id)
+    # For stream messages, the data we need about subscribers comes
+    # from the stream's StreamDeliverySnapshot.
+    snapshot: Optional[StreamDeliverySnapshot] = None
 
     if recipient.type == Recipient.PERSONAL:
         # The sender and recipient may be the same id, so
@@ -238,82 +303,60 @@ def get_recipient_info(
             topic_participant_user_ids = participants_for_topic(
                 recipient.id, stream_topic.topic_name
             )
-        subscription_rows = (
-            get_subscriptions_for_send_message(
-                realm_id=realm_id,
-                stream_id=stream_topic.stream_id,
-                topic_name=stream_topic.topic_name,
-                possible_stream_wildcard_mention=possible_stream_wildcard_mention,
-                topic_participant_user_ids=topic_participant_user_ids,
-                possibly_mentioned_user_ids=possibly_mentioned_user_ids,
-            )
-            .annotate(
-                user_profile_email_notifications=F(
-                    "user_profile__enable_stream_email_notifications"
-                ),
-                user_profile_push_notifications=F("user_profile__enable_stream_push_notifications"),
-                user_profile_wildcard_mentions_notify=F("user_profile__wildcard_mentions_notify"),
-                followed_topic_email_notifications=F(
-                    "user_profile__enable_followed_topic_email_notifications"
-                ),
-                followed_topic_push_notifications=F(
-                    "user_profile__enable_followed_topic_push_notifications"
-                ),
-                followed_topic_wildcard_mentions_notify=F(
-                    "user_profile__enable_followed_topic_wildcard_mentions_notify"
-                ),
-            )
-            .values(
-                "user_profile_id",
-                "push_notifications",
-                "email_notifications",
-                "wildcard_mentions_notify",
-                "followed_topic_push_notifications",
-                "followed_topic_email_notifications",
-                "followed_topic_wildcard_mentions_notify",
-                "user_profile_email_notifications",
-                "user_profile_push_notifications",
-                "user_profile_wildcard_mentions_notify",
-                "is_muted",
-            )
-            .order_by("user_profile_id")
+        snapshot = get_stream_delivery_snapshot(
+            realm_id=realm_id, recipient_id=recipient.id, stream_id=stream_topic.stream_id
         )
+        user_id_to_visibility_policy = snapshot.visibility_policies_for_topic(stream_topic)
 
-        message_to_user_ids = [row["user_profile_id"] for row in subscription_rows]
-        user_id_to_visibility_policy = stream_topic.user_id_to_visibility_policy_dict()
-
-        def notification_recipients(setting: str) -> Set[int]:
+        def user_ids_with_visibility_policy(visibility_policy: int) -> Set[int]:
             return {
-                row["user_profile_id"]
-                for row in subscription_rows
-                if user_allows_notifications_in_StreamTopic(
-                    row["is_muted"],
-                    user_id_to_visibility_policy.get(
-                        row["user_profile_id"], UserTopic.VisibilityPolicy.INHERIT
-                    ),
-                    row[setting],
-                    row["user_profile_" + setting],
-                )
+                user_id
+                for user_id, policy in user_id_to_visibility_policy.items()
+                if policy == visibility_policy
             }
 
-        stream_push_user_ids = notification_recipients("push_notifications")
-        stream_email_user_ids = notification_recipients("email_notifications")
+        followed_topic_user_ids = user_ids_with_visibility_policy(
+            UserTopic.VisibilityPolicy.FOLLOWED
+        )
+        muted_topic_user_ids = user_ids_with_visibility_policy(UserTopic.VisibilityPolicy.MUTED)
+        unmuted_topic_user_ids = user_ids_with_visibility_policy(UserTopic.VisibilityPolicy.UNMUTED)
+
+        message_to_user_id_set = set(snapshot.subscriber_ids)
+        if not possible_stream_wildcard_mention:
+            # Leave out the long_term_idle subscribers who can't need
+            # any processing for this message; see the comment on
+            # get_subscriptions_for_send_message for details.
+            message_to_user_id_set -= (
+                snapshot.long_term_idle_ids
+                - snapshot.push_notifications_ids
+                - snapshot.email_notifications_ids
+                - possibly_mentioned_user_ids
+                - topic_participant_user_ids
+                - snapshot.alert_word_ids
+                - followed_topic_user_ids
+            )
+        message_to_user_ids = message_to_user_id_set
+
+        def notification_recipients(enabled_user_ids: AbstractSet[int]) -> Set[int]:
+            # The set equivalent of user_allows_notifications_in_StreamTopic.
+            return (
+                (message_to_user_id_set & enabled_user_ids)
+                - (snapshot.muted_stream_ids - unmuted_topic_user_ids)
+                - muted_topic_user_ids
+            )
 
-        def followed_topic_notification_recipients(setting: str) -> Set[int]:
-            return {
-                row["user_profile_id"]
-                for row in subscription_rows
-                if user_id_to_visibility_policy.get(
-                    row["user_profile_id"], UserTopic.VisibilityPolicy.INHERIT
-                )
-                   == UserTopic.VisibilityPolicy.FOLLOWED
-                   and row["followed_topic_" + setting]
-            }
+        stream_push_user_ids = notification_recipients(snapshot.push_notifications_ids)
+        stream_email_user_ids = notification_recipients(snapshot.email_notifications_ids)
+
+        def followed_topic_notification_recipients(disabled_user_ids: AbstractSet[int]) -> Set[int]:
+            return (message_to_user_id_set & followed_topic_user_ids) - disabled_user_ids
 
         followed_topic_email_user_ids = followed_topic_notification_recipients(
-            "email_notifications"
+            snapshot.followed_topic_email_disabled_ids
+        )
+        followed_topic_push_user_ids = followed_topic_notification_recipients(
+            snapshot.followed_topic_push_disabled_ids
         )
-        followed_topic_push_user_ids = followed_topic_notification_recipients("push_notifications")
 
         if possible_stream_wildcard_mention or possible_topic_wildcard_mention:
             # We calculate `wildcard_mentions_notify_user_ids` and `followed_topic_wildcard_mentions_notify_user_ids`
@@ -321,9 +364,13 @@ def get_recipient_info(
             # This is important so as to avoid unnecessarily sending huge user ID lists with
             # thousands of elements to the event queue (which can happen because these settings
             # are `True` by default for new users.)
-            wildcard_mentions_notify_user_ids = notification_recipients("wildcard_mentions_notify")
+            wildcard_mentions_notify_user_ids = notification_recipients(
+                snapshot.wildcard_mentions_notify_ids
+            )
             followed_topic_wildcard_mentions_notify_user_ids = (
-                followed_topic_notification_recipients("wildcard_mentions_notify")
+                followed_topic_notification_recipients(
+                    snapshot.followed_topic_wildcard_mentions_disabled_ids
+                )
             )
 
         if possible_stream_wildcard_mention:
@@ -358,6 +405,10 @@ def get_recipient_info(
     # escaped).  `get_ids_for` will filter these extra user rows
     # for our data structures not related to bots
     user_ids |= possibly_mentioned_user_ids
+    if snapshot is not None:
+        # Every recipient of a stream message is a subscriber; we
+        # only need to fetch data for mentioned non-subscribers.
+        user_ids -= snapshot.subscriber_ids
 
     if user_ids:
         query: ValuesQuerySet[UserProfile, ActiveUserDict] = UserProfile.objects.filter(
@@ -425,6 +476,22 @@ def get_recipient_info(
         lambda r: r["long_term_idle"],
     )
 
+    if snapshot is not None:
+        active_user_ids |= message_to_user_id_set
+        online_push_user_ids |= message_to_user_id_set & snapshot.online_push_ids
+        pm_mention_email_disabled_user_ids |= (
+            message_to_user_id_set & snapshot.offline_email_disabled_ids
+        )
+        pm_mention_push_disabled_user_ids |= (
+            message_to_user_id_set & snapshot.offline_push_disabled_ids
+        )
+        um_eligible_user_ids |= message_to_user_id_set - {
+            user_id
+            for user_id, bot_type in snapshot.bot_types.items()
+            if bot_type in UserProfile.SERVICE_BOT_TYPES
+        }
+        long_term_idle_user_ids |= message_to_user_id_set & snapshot.long_term_idle_ids
+
     # These three bot data structures need to filter from the full set
     # of users who either are receiving the message or might have been
     # mentioned in it, and so can't use get_ids_for.
@@ -450,6 +517,20 @@ def get_recipient_info(
     # where we determine notifiability of the message for users.
     all_bot_user_ids = {row["id"] for row in rows if row["is_bot"]}
 
+    if snapshot is not None:
+        # The subscribers who are receiving the message or might have
+        # been mentioned in it are exactly message_to_user_id_set.
+        for user_id, bot_type in snapshot.bot_types.items():
+            if user_id not in message_to_user_id_set:
+                continue
+            if bot_type == UserProfile.DEFAULT_BOT:
+                default_bot_user_ids.add(user_id)
+            elif bot_type in UserProfile.SERVICE_BOT_TYPES:
+                assert bot_type is not None
+                service_bot_tuples.append((user_id, bot_type))
+            all_bot_user_ids.add(user_id)
+        service_bot_tuples.sort()
+
     return RecipientInfoResult(
         active_user_ids=active_user_ids,
         online_push_user_ids=online_push_user_ids,
@@ -550,6 +631,7 @@ def build_message_send_dict(
     mention_backend: Optional[MentionBackend] = None,
     limit_unread_user_ids: Optional[Set[int]] = None,
     disable_external_notifications: bool = False,
+    prerendered: Optional[PrerenderedMessage] = None,
 
 ) -> SendMessageRequest:
     """Returns a dictionary that can be passed into do_send_messages.  In
@@ -563,11 +645,15 @@ def build_message_send_dict(
     if mention_backend is None:
         mention_backend = MentionBackend(realm.id)
 
-    mention_data = MentionData(
-        mention_backend=mention_backend,
-        content=message.content,
+    if prerendered is not None and prerendered.content == message.content:
+        mention_data = prerendered.mention_data
+    else:
+        prerendered = None
+        mention_data = MentionData(
+            mention_backend=mention_backend,
+            content=message.content,
 
-    )
+        )
 
     if message.is_stream_message():
         stream_id = message.recipient.type_id
@@ -591,15 +677,20 @@ def build_message_send_dict(
     # Render our message_dicts.
     assert message.rendered_content is None
 
-    rendering_result = render_incoming_message(
-        message,
-        message.content,
-        realm,
-        mention_data=mention_data,
-        email_gateway=email_gateway,
-    )
+    if prerendered is not None:
+        rendering_result = prerendered.rendered.rendering_result
+        message.has_link = prerendered.rendered.has_link
+        message.has_image = prerendered.rendered.has_image
+    else:
+        rendering_result = render_incoming_message(
+            message,
+            message.content,
+            realm,
+            mention_data=mention_data,
+            email_gateway=email_gateway,
+            allow_degraded=True,
+        )
     message.rendered_content = rendering_result.rendered_content
-    print(f"message.rendered_content", message.rendered_content)
     message.rendered_content_version = markdown_version
     links_for_embed = rendering_result.links_for_preview
 
@@ -646,7 +737,6 @@ def build_message_send_dict(
     default_bot_user_ids = info.default_bot_user_ids
     mentioned_bot_user_ids = default_bot_user_ids & mentioned_user_ids
     info.um_eligible_user_ids |= mentioned_bot_user_ids
-    # message.translated_content = message.translated_content
     message_send_dict = SendMessageRequest(
         stream=stream,
         local_id=local_id,
@@ -700,7 +790,7 @@ def create_user_messages(
     scheduled_message_to_self: bool,
     topic_wildcard_mention_user_ids: Set[int],
     topic_wildcard_mention_in_followed_topic_user_ids: Set[int],
-) -> List[UserMessageLite]:
+) -> UserMessageRows:
     # These properties on the Message are set via
     # render_markdown by code in the Markdown inline patterns
     ids_with_alert_words = rendering_result.user_ids_with_alert_words
@@ -716,6 +806,46 @@ def create_user_messages(
     if message.recipient.type in [Recipient.HUDDLE, Recipient.PERSONAL]:
         base_flags |= UserMessage.flags.is_private
 
+    # Rather than testing each recipient against each of these sets,
+    # which is slow for messages to large streams, we compute the set
+    # of recipients who get each flag with set operations, and only
+    # loop in Python over the (usually few) recipients whose flags
+    # aren't shared with a large group of other recipients.
+    read_user_ids = (mark_as_read_user_ids & um_eligible_user_ids) | (
+        um_eligible_user_ids - limit_unread_user_ids if limit_unread_user_ids is not None else set()
+    )
+    # Messages you sent from a non-API client are automatically
+    # marked as read for yourself; scheduled messages to yourself
+    # only are not.
+    if (
+        sender_id in um_eligible_user_ids
+        and message.sent_by_human()
+        and not scheduled_message_to_self
+    ):
+        read_user_ids.add(sender_id)
+    user_ids_by_flag = [
+        (UserMessage.flags.mentioned, mentioned_user_ids & um_eligible_user_ids),
+        (UserMessage.flags.has_alert_word, ids_with_alert_words & um_eligible_user_ids),
+    ]
+    if rendering_result.mentions_topic_wildcard:
+        user_ids_by_flag.append(
+            (
+                UserMessage.flags.wildcard_mentioned,
+                all_topic_wildcard_mention_user_ids & um_eligible_user_ids,
+            )
+        )
+
+    flags_by_user_id: Dict[int, int] = {}
+    for flag, user_ids in user_ids_by_flag:
+        for user_profile_id in user_ids:
+            flags_by_user_id[user_profile_id] = (
+                flags_by_user_id.get(user_profile_id, base_flags) | flag
+            )
+    for user_profile_id in flags_by_user_id.keys() & read_user_ids:
+        flags_by_user_id[user_profile_id] |= UserMessage.flags.read
+    read_user_ids -= flags_by_user_id.keys()
+    unflagged_user_ids = um_eligible_user_ids - flags_by_user_id.keys() - read_user_ids
+
     # For long_term_idle (aka soft-deactivated) users, we are allowed
     # to optimize by lazily not creating UserMessage rows that would
     # have the default 0 flag set (since the soft-reactivation logic
@@ -735,50 +865,22 @@ def create_user_messages(
     #
     # See https://zulip.readthedocs.io/en/latest/subsystems/sending-messages.html#soft-deactivation
     # for details on this system.
-    user_messages = []
-    for user_profile_id in um_eligible_user_ids:
-        flags = base_flags
-        if (
-            (
-                # Messages you sent from a non-API client are
-                # automatically marked as read for yourself; scheduled
-                # messages to yourself only are not.
-                user_profile_id == sender_id
-                and message.sent_by_human()
-                and not scheduled_message_to_self
-            )
-            or user_profile_id in mark_as_read_user_ids
-            or (limit_unread_user_ids is not None and user_profile_id not in limit_unread_user_ids)
-        ):
-            flags |= UserMessage.flags.read
-        if user_profile_id in mentioned_user_ids:
-            flags |= UserMessage.flags.mentioned
-        if user_profile_id in ids_with_alert_words:
-            flags |= UserMessage.flags.has_alert_word
-        if (
-            rendering_result.mentions_topic_wildcard
-            and user_profile_id in all_topic_wildcard_mention_user_ids
-        ):
-            flags |= UserMessage.flags.wildcard_mentioned
-
-        if (
-            user_profile_id in long_term_idle_user_ids
-            and user_profile_id not in stream_push_user_ids
-            and user_profile_id not in stream_email_user_ids
-            and user_profile_id not in followed_topic_push_user_ids
-            and user_profile_id not in followed_topic_email_user_ids
-            and is_stream_message
-            and int(flags) == 0
-        ):
-            continue
-
-        um = UserMessageLite(
-            user_profile_id=user_profile_id,
-            message_id=message.id,
-            flags=flags,
+    if is_stream_message and int(base_flags) == 0:
+        unflagged_user_ids -= (
+            (long_term_idle_user_ids & unflagged_user_ids)
+            - stream_push_user_ids
+            - stream_email_user_ids
+            - followed_topic_push_user_ids
+            - followed_topic_email_user_ids
         )
-        user_messages.append(um)
 
+    user_messages = UserMessageRows()
+    user_messages.extend_user_ids(sorted(unflagged_user_ids), message.id, base_flags)
+    user_messages.extend_user_ids(
+        sorted(read_user_ids), message.id, base_flags | UserMessage.flags.read
+    )
+    for user_profile_id in sorted(flags_by_user_id):
+        user_messages.append(user_profile_id, message.id, flags_by_user_id[user_profile_id])
     return user_messages
 
 
@@ -861,17 +963,11 @@ def do_send_messages(
             ):
                 send_request.message.has_attachment = True
                 send_request.message.save(update_fields=["has_attachment"])
-        # for send_request in send_message_requests:
 
-        # if send_request.message.recipient.type == Recipient.PERSONAL:
-        #     if send_request.message.sender_id != send_request.message.recipient_id:
-        #         # For messages sent to others, show the translated content to the receiver
-        #         send_request.message.content = send_request.message.translated_content
-        #         send_request.message.rendered_content = None  # Clear the rendered content to force
-        #         # re-rendering
-        #     # Otherwise, do nothing for the sender; they will see the original content
-
-        ums: List[UserMessageLite] = []
+        ums = UserMessageRows()
+        # Many recipients share the same flags, so we only convert
+        # each distinct value of the flags to a list once.
+        flags_lists: Dict[int, List[str]] = {}
 
         for send_request in send_message_requests:
             # Service bots (outgoing webhook bots and embedded bots) don't store UserMessage rows;
@@ -899,8 +995,12 @@ def do_send_messages(
                 topic_wildcard_mention_in_followed_topic_user_ids=send_request.topic_wildcard_mention_in_followed_topic_user_ids,
             )
 
-            for um in user_messages:
-                user_message_flags[send_request.message.id][um.user_profile_id] = um.flags_list()
+            for user_profile_id, flags in zip(user_messages.user_profile_ids, user_messages.flags):
+                if flags not in flags_lists:
+                    flags_lists[flags] = UserMessage.flags_list_for_flags(flags)
+                user_message_flags[send_request.message.id][user_profile_id] = list(
+                    flags_lists[flags]
+                )
 
             ums.extend(user_messages)
 
@@ -912,23 +1012,23 @@ def do_send_messages(
                 recipient_type=send_request.message.recipient.type,
             )
 
-        bulk_insert_ums(ums)
-
-        # for send_request in send_message_requests:
-        #     send_request.message.content = send_request.message.translated_content
-        #     print(f"Message translated", send_request.message.content)
+        bulk_insert_user_message_rows(ums)
 
         for send_request in send_message_requests:
             do_widget_post_save_actions(send_request)
 
-    # This next loop is responsible for notifying other parts of the
+    # These next loops are responsible for notifying other parts of the
     # Zulip system about the messages we just committed to the database:
-    # * Notifying clients via send_event
+    # * Notifying clients via send_events, with one batch of notices
+    #   for all of the messages
     # * Triggering outgoing webhooks via the service event queue.
     # * Updating the `first_message_id` field for streams without any message history.
     # * Implementing the Welcome Bot reply hack
     # * Adding links to the embed_links queue for open graph processing.
-
+    # * Queueing full renderings of messages sent with a degraded rendering.
+    message_events: List[Tuple[Realm, Mapping[str, Any], Iterable[Mapping[str, Any]]]] = []
+    sent_messages: List[Tuple[SendMessageRequest, Dict[str, Any], Set[int]]] = []
+    for send_request in send_message_requests:
         realm_id: Optional[int] = None
         if send_request.message.is_stream_message():
             if send_request.stream is None:
@@ -938,7 +1038,6 @@ def do_send_messages(
             assert send_request.stream is not None
             realm_id = send_request.stream.realm_id
 
-
         wide_message_dict = MessageDict.wide_dict(send_request.message, realm_id)
 
         user_flags = user_message_flags.get(send_request.message.id, {})
@@ -1062,8 +1161,12 @@ def do_send_messages(
             event["local_id"] = send_request.local_id
         if send_request.sender_queue_id is not None:
             event["sender_queue_id"] = send_request.sender_queue_id
-        send_event(send_request.realm, event, users)
+        message_events.append((send_request.realm, event, users))
+        sent_messages.append((send_request, wide_message_dict, user_ids))
+
+    send_events(message_events)
 
+    for send_request, wide_message_dict, user_ids in sent_messages:
         if send_request.links_for_embed:
             event_data = {
                 "message_id": send_request.message.id,
@@ -1073,6 +1176,21 @@ def do_send_messages(
             }
             queue_json_publish("embed_links", event_data)
 
+        if send_request.rendering_result.degraded:
+            queue_rerender_degraded_message(send_request.message)
+
+        if settings.MESSAGE_TRANSLATION_ENABLED and any(
+            user_id != send_request.message.sender_id for user_id in user_ids
+        ):
+            # Translating involves a round trip to an external service,
+            # so we do it in the translation queue worker, which will
+            # deliver the results to the recipients via separate events.
+            event_data = {
+                "message_id": send_request.message.id,
+                "message_content": send_request.message.content,
+            }
+            queue_json_publish("translation", event_data)
+
         if send_request.message.recipient.type == Recipient.PERSONAL:
             welcome_bot_id = get_system_bot(
                 settings.WELCOME_BOT, send_request.message.sender.realm_id
@@ -1086,20 +1204,6 @@ def do_send_messages(
                 send_welcome_bot_response(send_request)
 
         assert send_request.service_queue_events is not None
-        # for send_request in send_message_requests:
-
-        # send_request.message.content = send_request.message.translated_content
-        # send_request.message.rendered_content = None  # Clear the rendered content to force
-        for send_request in send_message_requests:
-            original_message = send_request.message.content
-            print(f"original_message=========", original_message)
-            recipient_type_id = send_request.message.recipient.type_id
-            # send_request.message.content = send_request.message.translated_content
-            translated_message = translate_messages(original_message, recipient_type_id)
-            send_request.message.content = translated_message
-            print(f"translated_message=========", translated_message)
-
-            print(f"Message translated before save", send_request.message.content)
         for queue_name, events in send_request.service_queue_events.items():
             for event in events:
                 queue_json_publish(
@@ -1279,7 +1383,6 @@ def check_send_message(
             sender,
             client,
             addressee,
-
             message_content,
             realm,
             forged,
@@ -1451,10 +1554,13 @@ def check_message(
     mention_backend: Optional[MentionBackend] = None,
     limit_unread_user_ids: Optional[Set[int]] = None,
     disable_external_notifications: bool = False,
+    prerendered: Optional[PrerenderedMessage] = None,
 ) -> SendMessageRequest:
     """See
     https://zulip.readthedocs.io/en/latest/subsystems/sending-messages.html
     for high-level documentation on this subsystem.
+
+    `prerendered` is this message's entry from render_incoming_messages.
     """
     stream = None
 
@@ -1587,7 +1693,7 @@ def check_message(
         mention_backend=mention_backend,
         limit_unread_user_ids=limit_unread_user_ids,
         disable_external_notifications=disable_external_notifications,
-
+        prerendered=prerendered,
     )
     # print(f"Check Message ", message_send_dict)
 
@@ -1719,10 +1825,6 @@ def internal_prep_private_message(
         realm = recipient_user.realm
     else:
         realm = sender.realm
-    #
-    # receiver = recipient_user.recipient.type_id
-    # translated_msg = translate_messages(content, receiver)
-    # print(f"Message translated for receiver",translated_msg)
 
     return _internal_prep_message(
         realm=realm,
@@ -1812,15 +1914,3 @@ def internal_send_huddle_message(
         return None
     message_ids = do_send_messages([message])
     return message_ids[0]
-
-
-def translate_messages(message_content, recipient_id):
-    recipient_profile = UserProfile.objects.get(id=recipient_id)
-
-    preferred_language = recipient_profile.preferred_language
-    print(f"Recepient_id is ", recipient_profile.recipient)
-    print(f"recipient_profile.preferred_language", preferred_language)
-
-    translated_content = translate_message(message_content, preferred_language)
-
-    return translated_content
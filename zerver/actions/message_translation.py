@@ -0,0 +1,138 @@
+from collections import defaultdict
+from typing import Any, Dict, List
+
+from zerver.lib.translate import translate_rendered_content, translate_rendered_contents
+from zerver.models import Message, MessageTranslation, UserMessage, UserProfile
+from zerver.tornado.django_api import send_event
+
+
+def get_recipient_ids_by_language(message: Message) -> Dict[str, List[int]]:
+    """Groups the recipients of `message` (other than its sender) by
+    their preferred language, using a single query.  Translation work
+    is then proportional to the number of distinct languages, not the
+    number of recipients, which matters for large streams.
+
+    We take the message to be written in its sender's preferred
+    language, so recipients who prefer that language are left out.
+    """
+    rows = (
+        UserMessage.objects.filter(message_id=message.id, user_profile__is_active=True)
+        .exclude(user_profile_id=message.sender_id)
+        .exclude(user_profile__preferred_language=None)
+        .values_list(
+            "user_profile_id",
+            "user_profile__preferred_language",
+            "message__sender__preferred_language",
+        )
+    )
+    user_ids_by_language: Dict[str, List[int]] = defaultdict(list)
+    for user_profile_id, language, source_language in rows:
+        if language != source_language:
+            user_ids_by_language[language].append(user_profile_id)
+    return user_ids_by_language
+
+
+def do_send_message_translation(
+    message: Message,
+    language: str,
+    translated_rendered_content: str,
+    user_ids: List[int],
+) -> None:
+    """Delivers a translation of an already-sent message to the
+    users who asked to read it in `language`.  Translations never
+    modify the Message row itself; they're a per-recipient overlay
+    on top of the original content, computed by the translation
+    queue worker after the message has been sent.
+    """
+    event: Dict[str, Any] = {
+        "type": "translation",
+        "message_id": message.id,
+        "language": language,
+        "rendered_content": translated_rendered_content,
+    }
+    send_event(message.realm, event, user_ids)
+
+
+def do_translate_message(message: Message) -> Dict[str, str]:
+    """Translates the rendered content of `message` once for each
+    distinct preferred language among its recipients, stores the
+    translations, and sends each one to the recipients who prefer that
+    language.  Returns the translations, keyed by language.
+    """
+    translations: Dict[str, str] = {}
+    if message.rendered_content is None:
+        return translations
+
+    user_ids_by_language = get_recipient_ids_by_language(message)
+    for language in user_ids_by_language:
+        translations[language] = translate_rendered_content(message.rendered_content, language)
+
+    # ignore_conflicts, since a lazy fill (see
+    # do_fill_message_translations) may have beaten us to it.
+    MessageTranslation.objects.bulk_create(
+        [
+            MessageTranslation(message=message, language=language, rendered_content=translated)
+            for language, translated in translations.items()
+        ],
+        ignore_conflicts=True,
+    )
+    for language, user_ids in user_ids_by_language.items():
+        do_send_message_translation(message, language, translations[language], user_ids)
+    return translations
+
+
+def do_fill_message_translations(
+    user_profile: UserProfile, message_ids: List[int], language: str
+) -> Dict[int, str]:
+    """Translates into `language` those of `message_ids` that have no
+    stored translation into it yet, and sends the new translations to
+    `user_profile`.  This is how translations of messages sent before a
+    user changed their preferred language (or before translation was
+    enabled) get filled in, as the user reads them; see
+    MessageDict.bulk_apply_translations.
+
+    The messages are translated together, in one batch to the
+    translation backend; those whose sender prefers `language` are
+    already written in it, and are skipped.
+
+    The caller is responsible for having checked that `user_profile`
+    has access to the messages.
+    """
+    already_translated = MessageTranslation.objects.filter(
+        message_id__in=message_ids, language=language
+    ).values_list("message_id", flat=True)
+    rows = list(
+        Message.objects.filter(id__in=message_ids)
+        .exclude(id__in=already_translated)
+        .exclude(rendered_content=None)
+        .exclude(sender__preferred_language=language)
+        .values_list("id", "rendered_content")
+    )
+
+    translations: Dict[int, str] = dict(
+        zip(
+            [message_id for message_id, rendered_content in rows],
+            translate_rendered_contents(
+                [rendered_content for message_id, rendered_content in rows], language
+            ),
+        )
+    )
+
+    MessageTranslation.objects.bulk_create(
+        [
+            MessageTranslation(
+                message_id=message_id, language=language, rendered_content=translated
+            )
+            for message_id, translated in translations.items()
+        ],
+        ignore_conflicts=True,
+    )
+    for message_id, translated in translations.items():
+        event: Dict[str, Any] = {
+            "type": "translation",
+            "message_id": message_id,
+            "language": language,
+            "rendered_content": translated,
+        }
+        send_event(user_profile.realm, event, [user_profile.id])
+    return translations
@@ -7,8 +7,10 @@ from django.db.utils import IntegrityError
 from django.utils.timezone import now as timezone_now
 from django.utils.translation import gettext as _
 
+from zerver.actions.message_rerender import queue_rerender_messages
 from zerver.lib.emoji import get_emoji_file_name
 from zerver.lib.exceptions import JsonableError
+from zerver.lib.message import RenderingChange
 from zerver.lib.pysa import mark_sanitized
 from zerver.lib.upload import upload_emoji_image
 from zerver.models import (
@@ -71,6 +73,7 @@ def check_add_realm_emoji(
         ).decode(),
     )
     notify_realm_emoji(realm_emoji.realm, realm_emoji_dict)
+    queue_rerender_messages(realm, [f":{name}:"], RenderingChange(emoji_name=name))
     return realm_emoji
 
 
@@ -95,3 +98,4 @@ def do_remove_realm_emoji(realm: Realm, name: str, *, acting_user: Optional[User
     )
 
     notify_realm_emoji(realm, realm_emoji_dict)
+    queue_rerender_messages(realm, [f":{name}:"], RenderingChange(emoji_name=name))
@@ -4,6 +4,9 @@ import orjson
 from django.db import transaction
 from django.utils.timezone import now as timezone_now
 
+from zerver.actions.message_rerender import queue_rerender_messages
+from zerver.lib.markdown.linkifiers import linkifier_pattern_literal
+from zerver.lib.message import RenderingChange
 from zerver.lib.types import LinkifierDict
 from zerver.models import (
     Realm,
@@ -21,6 +24,20 @@ def notify_linkifiers(realm: Realm, realm_linkifiers: List[LinkifierDict]) -> No
     send_event_on_commit(realm, event, active_user_ids(realm.id))
 
 
+def rerender_messages_for_linkifiers(realm: Realm, patterns: List[str]) -> None:
+    """Queues re-rendering the existing messages which any of the
+    linkifiers `patterns` might match."""
+    substrings = []
+    for pattern in patterns:
+        literal = linkifier_pattern_literal(pattern)
+        if literal is None:
+            # We can't narrow down which messages it might match.
+            queue_rerender_messages(realm, None, RenderingChange())
+            return
+        substrings.append(literal)
+    queue_rerender_messages(realm, substrings, RenderingChange())
+
+
 # NOTE: Regexes must be simple enough that they can be easily translated to JavaScript
 # RegExp syntax. In addition to JS-compatible syntax, the following features are available:
 #   * Named groups will be converted to numbered groups automatically
@@ -57,6 +74,7 @@ def do_add_linkifier(
         ).decode(),
     )
     notify_linkifiers(realm, realm_linkifiers)
+    rerender_messages_for_linkifiers(realm, [pattern])
 
     return linkifier.id
 
@@ -93,6 +111,7 @@ def do_remove_linkifier(
         ).decode(),
     )
     notify_linkifiers(realm, realm_linkifiers)
+    rerender_messages_for_linkifiers(realm, [pattern])
 
 
 @transaction.atomic(durable=True)
@@ -107,6 +126,7 @@ def do_update_linkifier(
     pattern = pattern.strip()
     url_template = url_template.strip()
     linkifier = RealmFilter.objects.get(realm=realm, id=id)
+    old_pattern = linkifier.pattern
     linkifier.pattern = pattern
     linkifier.url_template = url_template
     linkifier.full_clean()
@@ -131,3 +151,4 @@ def do_update_linkifier(
     )
 
     notify_linkifiers(realm, realm_linkifiers)
+    rerender_messages_for_linkifiers(realm, [old_pattern, pattern])
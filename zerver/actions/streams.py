@@ -21,6 +21,7 @@ from zerver.lib.cache import (
     cache_delete_many,
     cache_set,
     display_recipient_cache_key,
+    flush_stream_delivery_snapshots,
     to_dict_cache_key_id,
 )
 from zerver.lib.email_mirror_helpers import encode_email_address
@@ -89,6 +90,8 @@ def do_deactivate_stream(stream: Stream, *, acting_user: Optional[UserProfile])
     get_active_subscriptions_for_stream_id(stream.id, include_deactivated_users=True).update(
         active=False
     )
+    assert stream.recipient_id is not None
+    flush_stream_delivery_snapshots([stream.recipient_id])
 
     was_invite_only = stream.invite_only
     stream.deactivated = True
@@ -411,6 +414,9 @@ def bulk_add_subs_to_db_with_logging(
     Subscription.objects.bulk_create(info.sub for info in subs_to_add)
     sub_ids = [info.sub.id for info in subs_to_activate]
     Subscription.objects.filter(id__in=sub_ids).update(active=True)
+    flush_stream_delivery_snapshots(
+        {info.sub.recipient_id for info in subs_to_add + subs_to_activate}
+    )
 
     # Log subscription activities in RealmAuditLog
     event_time = timezone_now()
@@ -815,6 +821,9 @@ def bulk_remove_subscriptions(
         Subscription.objects.filter(
             id__in=sub_ids_to_deactivate,
         ).update(active=False)
+        flush_stream_delivery_snapshots(
+            {sub_info.sub.recipient_id for sub_info in subs_to_deactivate}
+        )
         occupied_streams_after = list(get_occupied_streams(realm))
 
         # Log subscription activities in RealmAuditLog
@@ -25,6 +25,7 @@ from typing import (
 from django.conf import settings
 from django.core.cache import caches
 from django.core.cache.backends.base import BaseCache
+from django.db import transaction
 from django.db.models import Q
 from django.http import HttpRequest
 from django_stubs_ext import QuerySetAny
@@ -33,7 +34,16 @@ from typing_extensions import ParamSpec
 if TYPE_CHECKING:
     # These modules have to be imported for type annotations but
     # they cannot be imported at runtime due to cyclic dependency.
-    from zerver.models import Attachment, Message, MutedUser, Realm, Stream, SubMessage, UserProfile
+    from zerver.models import (
+        Attachment,
+        Message,
+        MutedUser,
+        Realm,
+        Stream,
+        SubMessage,
+        Subscription,
+        UserProfile,
+    )
 
 MEMCACHED_MAX_KEY_LENGTH = 250
 
@@ -417,6 +427,14 @@ def preview_url_cache_key(url: str) -> str:
     return f"preview_url:{hashlib.sha1(url.encode()).hexdigest()}"
 
 
+def translation_cache_key(text: str, target_language: str) -> str:
+    return f"translation:{target_language}:{hashlib.sha256(text.encode()).hexdigest()}"
+
+
+def translation_fill_cache_key(user_id: int, message_id: int, language: str) -> str:
+    return f"translation_fill:{user_id}:{message_id}:{language}"
+
+
 def display_recipient_cache_key(recipient_id: int) -> str:
     return f"display_recipient_dict:{recipient_id}"
 
@@ -575,12 +593,64 @@ def flush_user_profile(
     if changed(update_fields, ["email", "full_name", "id", "is_mirror_dummy"]):
         delete_display_recipient_cache(user_profile)
 
+    if changed(update_fields, delivery_snapshot_user_fields):
+        flush_realm_delivery_snapshots(user_profile.realm_id)
+
     # Invalidate our bots_in_realm info dict if any bot has
     # changed the fields in the dict or become (in)active
     if user_profile.is_bot and changed(update_fields, bot_dict_fields):
         cache_delete(bot_dicts_in_realm_cache_key(user_profile.realm_id))
 
 
+def stream_delivery_snapshot_version_cache_key(recipient_id: int) -> str:
+    return f"stream_delivery_snapshot_version:{recipient_id}"
+
+
+def realm_delivery_snapshot_version_cache_key(realm_id: int) -> str:
+    return f"realm_delivery_snapshot_version:{realm_id}"
+
+
+def flush_version_tokens(keys: List[str]) -> None:
+    # Other processes may cache data derived from the old data before
+    # our transaction commits, so we flush again once it has.
+    cache_delete_many(keys)
+    transaction.on_commit(lambda: cache_delete_many(keys))
+
+
+def flush_stream_delivery_snapshots(recipient_ids: Iterable[int]) -> None:
+    """Invalidates the StreamDeliverySnapshots (see
+    zerver/lib/delivery_snapshot.py) for these stream recipients, after
+    a change to their subscriptions or topic visibility policies."""
+    flush_version_tokens(
+        [stream_delivery_snapshot_version_cache_key(recipient_id) for recipient_id in recipient_ids]
+    )
+
+
+def flush_realm_delivery_snapshots(realm_id: int) -> None:
+    """Invalidates the StreamDeliverySnapshots for every stream in the
+    realm, after a change to a user which could affect any of them."""
+    flush_version_tokens([realm_delivery_snapshot_version_cache_key(realm_id)])
+
+
+# The UserProfile fields which are included in StreamDeliverySnapshots.
+delivery_snapshot_user_fields = [
+    "is_active",
+    "role",
+    "long_term_idle",
+    "is_bot",
+    "bot_type",
+    "enable_stream_push_notifications",
+    "enable_stream_email_notifications",
+    "wildcard_mentions_notify",
+    "enable_followed_topic_push_notifications",
+    "enable_followed_topic_email_notifications",
+    "enable_followed_topic_wildcard_mentions_notify",
+    "enable_online_push_notifications",
+    "enable_offline_email_notifications",
+    "enable_offline_push_notifications",
+]
+
+
 def flush_muting_users_cache(*, instance: "MutedUser", **kwargs: object) -> None:
     mute_object = instance
     cache_delete(get_muting_users_cache_key(mute_object.muted_user_id))
@@ -617,6 +687,34 @@ def flush_realm(
         cache_delete(realm_rendered_description_cache_key(realm))
         cache_delete(realm_text_description_cache_key(realm))
 
+    if changed(update_fields, realm_rendering_fields):
+        flush_realm_rendering_version(realm.id)
+
+
+def realm_rendering_version_cache_key(realm_id: int) -> str:
+    return f"realm_rendering_version:{realm_id}"
+
+
+def rendered_content_cache_key(rendering_version: str, options: str, content: str) -> str:
+    content_hash = hashlib.sha256(f"{options}\n{content}".encode()).hexdigest()
+    return f"rendered_content:{rendering_version}:{content_hash}"
+
+
+def flush_realm_rendering_version(realm_id: int) -> None:
+    """Invalidates the realm's cached message renderings (see
+    zerver.lib.markdown.do_convert), after a change to its linkifiers,
+    custom emoji, or settings which affect rendering."""
+    flush_version_tokens([realm_rendering_version_cache_key(realm_id)])
+
+
+# The Realm fields which the Markdown processor uses.
+realm_rendering_fields = [
+    "string_id",
+    "default_code_block_language",
+    "inline_image_preview",
+    "inline_url_embed_preview",
+]
+
 
 def realm_alert_words_cache_key(realm_id: int) -> str:
     return f"realm_alert_words:{realm_id}"
@@ -656,6 +754,12 @@ def flush_stream(
         cache_delete(bot_dicts_in_realm_cache_key(stream.realm_id))
 
 
+# Called by models.py to flush StreamDeliverySnapshots whenever we
+# save or delete a subscription.
+def flush_subscription(*, instance: "Subscription", **kwargs: object) -> None:
+    flush_stream_delivery_snapshots([instance.recipient_id])
+
+
 def flush_used_upload_space_cache(
     *,
     instance: "Attachment",
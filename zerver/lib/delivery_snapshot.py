@@ -0,0 +1,200 @@
+# A process-local cache of the per-subscriber data that
+# get_recipient_info needs to work out who receives a stream message,
+# and how they should be notified about it.
+#
+# For a busy stream, this data almost never changes between one
+# message and the next, but fetching it means reading every
+# subscription to the stream, joined with its user.  So we keep a
+# StreamDeliverySnapshot for recently used streams, in memory, as
+# sets of user IDs.
+#
+# Since each Django process has its own snapshots, they're validated
+# against version tokens in the remote cache: one per stream, and one
+# per realm (for changes to users' settings, which can affect any
+# stream in the realm).  Code which changes any of the inputs flushes
+# the relevant token (see flush_stream_delivery_snapshots and
+# flush_realm_delivery_snapshots), and the next message sent to an
+# affected stream rebuilds its snapshot.
+import secrets
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, FrozenSet, Optional, Tuple
+
+from django.db.models import Exists, OuterRef
+
+from zerver.lib.cache import (
+    cache_get_many,
+    cache_set_many,
+    realm_delivery_snapshot_version_cache_key,
+    stream_delivery_snapshot_version_cache_key,
+)
+from zerver.lib.stream_subscription import get_active_subscriptions_for_stream_id
+from zerver.lib.stream_topic import StreamTopicTarget
+from zerver.models import AlertWord
+
+STREAM_DELIVERY_SNAPSHOT_CACHE_SIZE = 100
+TOPIC_VISIBILITY_POLICY_CACHE_SIZE = 100
+
+
+@dataclass
+class StreamDeliverySnapshot:
+    # All of these are sets of the IDs of active users subscribed to
+    # the stream.
+    subscriber_ids: FrozenSet[int]
+    long_term_idle_ids: FrozenSet[int]
+    # Subscribers with any alert words.
+    alert_word_ids: FrozenSet[int]
+    muted_stream_ids: FrozenSet[int]
+    # Subscribers whose stream-level setting (or the global default,
+    # if they haven't set one for this stream) is enabled.
+    push_notifications_ids: FrozenSet[int]
+    email_notifications_ids: FrozenSet[int]
+    wildcard_mentions_notify_ids: FrozenSet[int]
+    # These default to enabled, so we keep the (usually small) sets of
+    # subscribers who have disabled them.
+    followed_topic_push_disabled_ids: FrozenSet[int]
+    followed_topic_email_disabled_ids: FrozenSet[int]
+    followed_topic_wildcard_mentions_disabled_ids: FrozenSet[int]
+    online_push_ids: FrozenSet[int]
+    offline_email_disabled_ids: FrozenSet[int]
+    offline_push_disabled_ids: FrozenSet[int]
+    # Maps each bot subscriber's ID to its bot_type.
+    bot_types: Dict[int, Optional[int]]
+    # user_id -> visibility policy dicts for recently used topics,
+    # which are invalidated along with the rest of the snapshot.
+    topic_visibility_policies: "OrderedDict[str, Dict[int, int]]" = field(
+        default_factory=OrderedDict
+    )
+
+    def visibility_policies_for_topic(self, stream_topic: StreamTopicTarget) -> Dict[int, int]:
+        topic_name = stream_topic.topic_name
+        if topic_name in self.topic_visibility_policies:
+            self.topic_visibility_policies.move_to_end(topic_name)
+        else:
+            self.topic_visibility_policies[
+                topic_name
+            ] = stream_topic.user_id_to_visibility_policy_dict()
+            if len(self.topic_visibility_policies) > TOPIC_VISIBILITY_POLICY_CACHE_SIZE:
+                self.topic_visibility_policies.popitem(last=False)
+        return self.topic_visibility_policies[topic_name]
+
+
+# recipient_id -> (version, snapshot), least recently used first.
+stream_delivery_snapshots: "OrderedDict[int, Tuple[str, StreamDeliverySnapshot]]" = OrderedDict()
+
+
+def get_delivery_snapshot_version(realm_id: int, recipient_id: int) -> str:
+    keys = [
+        stream_delivery_snapshot_version_cache_key(recipient_id),
+        realm_delivery_snapshot_version_cache_key(realm_id),
+    ]
+    versions = cache_get_many(keys)
+    # Flushing a snapshot deletes its version token; whichever process
+    # next needs it picks a new one.  That must happen before we read
+    # the database, so that a flush racing with us can't leave a
+    # snapshot of the old data marked as current.
+    new_versions = {key: secrets.token_hex(8) for key in keys if key not in versions}
+    if new_versions:
+        cache_set_many(new_versions)
+        versions.update(new_versions)
+    return ":".join(versions[key] for key in keys)
+
+
+def build_stream_delivery_snapshot(stream_id: int) -> StreamDeliverySnapshot:
+    rows = list(
+        get_active_subscriptions_for_stream_id(stream_id, include_deactivated_users=False)
+        .annotate(
+            has_alert_words=Exists(
+                AlertWord.objects.filter(user_profile_id=OuterRef("user_profile_id"))
+            )
+        )
+        .values(
+            "user_profile_id",
+            "is_muted",
+            "push_notifications",
+            "email_notifications",
+            "wildcard_mentions_notify",
+            "has_alert_words",
+            "user_profile__long_term_idle",
+            "user_profile__enable_stream_push_notifications",
+            "user_profile__enable_stream_email_notifications",
+            "user_profile__wildcard_mentions_notify",
+            "user_profile__enable_followed_topic_push_notifications",
+            "user_profile__enable_followed_topic_email_notifications",
+            "user_profile__enable_followed_topic_wildcard_mentions_notify",
+            "user_profile__enable_online_push_notifications",
+            "user_profile__enable_offline_email_notifications",
+            "user_profile__enable_offline_push_notifications",
+            "user_profile__is_bot",
+            "user_profile__bot_type",
+        )
+    )
+
+    def ids_where(
+        setting: str, value: bool = True, stream_specific_setting: Optional[str] = None
+    ) -> FrozenSet[int]:
+        # As in user_allows_notifications_in_StreamTopic, a
+        # stream-specific setting of None means to use the global one.
+        def get(row: Dict[str, Any]) -> Any:
+            if stream_specific_setting is not None and row[stream_specific_setting] is not None:
+                return row[stream_specific_setting]
+            return row[setting]
+
+        return frozenset(row["user_profile_id"] for row in rows if get(row) == value)
+
+    return StreamDeliverySnapshot(
+        subscriber_ids=frozenset(row["user_profile_id"] for row in rows),
+        long_term_idle_ids=ids_where("user_profile__long_term_idle"),
+        alert_word_ids=ids_where("has_alert_words"),
+        muted_stream_ids=ids_where("is_muted"),
+        push_notifications_ids=ids_where(
+            "user_profile__enable_stream_push_notifications",
+            stream_specific_setting="push_notifications",
+        ),
+        email_notifications_ids=ids_where(
+            "user_profile__enable_stream_email_notifications",
+            stream_specific_setting="email_notifications",
+        ),
+        wildcard_mentions_notify_ids=ids_where(
+            "user_profile__wildcard_mentions_notify",
+            stream_specific_setting="wildcard_mentions_notify",
+        ),
+        followed_topic_push_disabled_ids=ids_where(
+            "user_profile__enable_followed_topic_push_notifications", False
+        ),
+        followed_topic_email_disabled_ids=ids_where(
+            "user_profile__enable_followed_topic_email_notifications", False
+        ),
+        followed_topic_wildcard_mentions_disabled_ids=ids_where(
+            "user_profile__enable_followed_topic_wildcard_mentions_notify", False
+        ),
+        online_push_ids=ids_where("user_profile__enable_online_push_notifications"),
+        offline_email_disabled_ids=ids_where(
+            "user_profile__enable_offline_email_notifications", False
+        ),
+        offline_push_disabled_ids=ids_where(
+            "user_profile__enable_offline_push_notifications", False
+        ),
+        bot_types={
+            row["user_profile_id"]: row["user_profile__bot_type"]
+            for row in rows
+            if row["user_profile__is_bot"]
+        },
+    )
+
+
+def get_stream_delivery_snapshot(
+    *, realm_id: int, recipient_id: int, stream_id: int
+) -> StreamDeliverySnapshot:
+    version = get_delivery_snapshot_version(realm_id, recipient_id)
+    cached = stream_delivery_snapshots.get(recipient_id)
+    if cached is not None and cached[0] == version:
+        stream_delivery_snapshots.move_to_end(recipient_id)
+        return cached[1]
+
+    snapshot = build_stream_delivery_snapshot(stream_id)
+    stream_delivery_snapshots[recipient_id] = (version, snapshot)
+    stream_delivery_snapshots.move_to_end(recipient_id)
+    if len(stream_delivery_snapshots) > STREAM_DELIVERY_SNAPSHOT_CACHE_SIZE:
+        stream_delivery_snapshots.popitem(last=False)
+    return snapshot
@@ -1388,6 +1388,16 @@ equals_private_or_stream = EnumType(
     ]
 )
 
+translation_event = event_dict_type(
+    required_keys=[
+        ("type", Equals("translation")),
+        ("message_id", int),
+        ("language", str),
+        ("rendered_content", str),
+    ]
+)
+check_translation = make_checker(translation_event)
+
 typing_start_event = event_dict_type(
     required_keys=[
         ("type", Equals("typing")),
@@ -1262,6 +1262,10 @@ def apply_event(
     elif event["type"] == "submessage":
         # The client will get submessages with their messages
         pass
+    elif event["type"] == "translation":
+        # Translations are an overlay on messages, which we don't
+        # return in /register.
+        pass
     elif event["type"] == "typing":
         # Typing notification events are transient and thus ignored
         pass
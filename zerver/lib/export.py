@@ -134,6 +134,7 @@ ALL_ZULIP_TABLES = {
     "zerver_groupgroupmembership",
     "zerver_huddle",
     "zerver_message",
+    "zerver_messagetranslation",
     "zerver_missedmessageemailaddress",
     "zerver_multiuseinvite",
     "zerver_multiuseinvite_streams",
@@ -196,6 +197,9 @@ NON_EXPORTED_TABLES = {
     "zerver_missedmessageemailaddress",
     # Scheduled message notification email data is for internal use by the server.
     "zerver_scheduledmessagenotificationemail",
+    # Message translations are a cache, which the new server will
+    # recompute lazily as users read messages.
+    "zerver_messagetranslation",
     # When switching servers, clients will need to re-log in and
     # reregister for push notifications anyway.
     "zerver_pushdevicetoken",
@@ -0,0 +1,29 @@
+import bisect
+from typing import Any, Dict, List, Sequence
+
+
+class Histogram:
+    """A histogram with fixed buckets, in the style of Prometheus: a
+    value goes in the first bucket whose upper bound is at least the
+    value, or the final, unbounded bucket."""
+
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets = list(buckets)
+        self.counts: List[int] = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(
+            buckets=[
+                dict(le=bound, count=count)
+                for bound, count in zip([*self.buckets, "+Inf"], self.counts)
+            ],
+            count=self.count,
+            sum=self.sum,
+        )
@@ -23,8 +23,9 @@ from zerver.actions.user_settings import do_change_avatar_fields
 from zerver.lib.avatar_hash import user_avatar_path_from_ids
 from zerver.lib.bulk_create import bulk_set_users_or_streams_recipient_fields
 from zerver.lib.export import DATE_FIELDS, Field, Path, Record, TableData, TableName
-from zerver.lib.markdown import markdown_convert
+from zerver.lib.markdown import MarkdownRenderTask, prepare_markdown_render
 from zerver.lib.markdown import version as markdown_version
+from zerver.lib.markdown.render_pool import MarkdownRenderPool
 from zerver.lib.message import get_last_message_id
 from zerver.lib.server_initialization import create_internal_realm, server_initialized
 from zerver.lib.streams import render_stream_description
@@ -297,12 +298,20 @@ def fix_customprofilefield(data: TableData) -> None:
 
 
 def fix_message_rendered_content(
-    realm: Realm, sender_map: Dict[int, Record], messages: List[Record]
+    realm: Realm,
+    sender_map: Dict[int, Record],
+    messages: List[Record],
+    render_pool: Optional[MarkdownRenderPool] = None,
 ) -> None:
     """
     This function sets the rendered_content of all the messages
     after the messages have been imported from a non-Zulip platform.
+
+    Messages which need rendering are rendered as one batch, by
+    `render_pool` if passed.
     """
+    messages_to_render: List[Record] = []
+    render_tasks: List[Tuple[MarkdownRenderTask, None]] = []
     for message in messages:
         if message["rendered_content"] is not None:
             # For Zulip->Zulip imports, we use the original rendered
@@ -364,28 +373,38 @@ def fix_message_rendered_content(
             # words" type feature, and notifications aren't important anyway.
             realm_alert_words_automaton = None
 
-            rendered_content = markdown_convert(
+            task = prepare_markdown_render(
                 content=content,
                 realm_alert_words_automaton=realm_alert_words_automaton,
                 message_realm=realm,
                 sent_by_bot=sent_by_bot,
                 translate_emoticons=translate_emoticons,
-            ).rendered_content
-
-            message["rendered_content"] = rendered_content
-            if "scheduled_timestamp" not in message:
-                # This logic runs also for ScheduledMessage, which doesn't use
-                # the rendered_content_version field.
-                message["rendered_content_version"] = markdown_version
+            )
         except Exception:
-            # This generally happens with two possible causes:
-            # * rendering Markdown throwing an uncaught exception
-            # * rendering Markdown failing with the exception being
-            #   caught in Markdown (which then returns None, causing the the
-            #   rendered_content assert above to fire).
             logging.warning(
                 "Error in Markdown rendering for message ID %s; continuing", message["id"]
             )
+            continue
+
+        messages_to_render.append(message)
+        render_tasks.append((task, None))
+
+    if render_pool is None:
+        render_pool = MarkdownRenderPool(1)
+    for message, rendered in zip(messages_to_render, render_pool.render(render_tasks)):
+        if rendered is None:
+            # Rendering Markdown failed; the exception has been
+            # logged, with the (sanitized) content.
+            logging.warning(
+                "Error in Markdown rendering for message ID %s; continuing", message["id"]
+            )
+            continue
+
+        message["rendered_content"] = rendered.rendering_result.rendered_content
+        if "scheduled_timestamp" not in message:
+            # This logic runs also for ScheduledMessage, which doesn't use
+            # the rendered_content_version field.
+            message["rendered_content_version"] = markdown_version
 
 
 def current_table_ids(data: TableData, table: TableName) -> List[int]:
@@ -1343,7 +1362,9 @@ def do_import_realm(import_dir: Path, subdomain: str, processes: int = 1) -> Rea
         bulk_import_model(data, ScheduledMessage)
 
     # Import zerver_message and zerver_usermessage
-    import_message_data(realm=realm, sender_map=sender_map, import_dir=import_dir)
+    import_message_data(
+        realm=realm, sender_map=sender_map, import_dir=import_dir, processes=processes
+    )
 
     re_map_foreign_keys(data, "zerver_reaction", "message", related_table="message")
     re_map_foreign_keys(data, "zerver_reaction", "user_profile", related_table="user_profile")
@@ -1485,7 +1506,10 @@ def get_incoming_message_ids(import_dir: Path, sort_by_date: bool) -> List[int]:
     return message_ids
 
 
-def import_message_data(realm: Realm, sender_map: Dict[int, Record], import_dir: Path) -> None:
+def import_message_data(
+    realm: Realm, sender_map: Dict[int, Record], import_dir: Path, processes: int = 1
+) -> None:
+    render_pool = MarkdownRenderPool(processes)
     dump_file_id = 1
     while True:
         message_filename = os.path.join(import_dir, f"messages-{dump_file_id:06}.json")
@@ -1519,6 +1543,7 @@ def import_message_data(realm: Realm, sender_map: Dict[int, Record], import_dir:
             realm=realm,
             sender_map=sender_map,
             messages=data["zerver_message"],
+            render_pool=render_pool,
         )
         logging.info("Successfully rendered Markdown for message batch")
 
@@ -1538,6 +1563,8 @@ def import_message_data(realm: Realm, sender_map: Dict[int, Record], import_dir:
         bulk_import_user_message_data(data, dump_file_id)
         dump_file_id += 1
 
+    render_pool.shutdown()
+
 
 def import_attachments(data: TableData) -> None:
     # Clean up the data in zerver_attachment that is not
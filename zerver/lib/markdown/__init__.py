@@ -5,11 +5,13 @@ import datetime
 import html
 import logging
 import re
+import secrets
 import time
+import tracemalloc
 import urllib
 import urllib.parse
-from collections import deque
-from dataclasses import dataclass
+from collections import OrderedDict, deque
+from dataclasses import asdict, dataclass
 from functools import lru_cache
 from typing import (
     Any,
@@ -49,12 +51,20 @@ from soupsieve import escape as css_escape
 from tlds import tld_set
 
 from zerver.lib import mention
-from zerver.lib.cache import cache_with_key
+from zerver.lib.cache import (
+    cache_get,
+    cache_set,
+    cache_with_key,
+    realm_rendering_version_cache_key,
+    rendered_content_cache_key,
+)
 from zerver.lib.camo import get_camo_url
 from zerver.lib.emoji import EMOTICON_RE, codepoint_to_name, name_to_codepoint, translate_emoticons
 from zerver.lib.exceptions import MarkdownRenderingError
 from zerver.lib.markdown import fenced_code
 from zerver.lib.markdown.fenced_code import FENCE_RE
+from zerver.lib.markdown.linkifiers import LinkifierPrefilter, PrefilteredLinkifierRegex
+from zerver.lib.markdown.stats import markdown_render_stats
 from zerver.lib.mention import (
     BEFORE_MENTION_ALLOWED_REGEX,
     FullNameInfo,
@@ -65,7 +75,7 @@ from zerver.lib.outgoing_http import OutgoingSession
 from zerver.lib.subdomains import is_static_or_current_realm_url
 from zerver.lib.tex import render_tex
 from zerver.lib.thumbnail import user_uploads_or_external
-from zerver.lib.timeout import timeout
+from zerver.lib.timeout import TimeoutExpiredError, timeout
 from zerver.lib.timezone import common_timezones
 from zerver.lib.types import LinkifierDict
 from zerver.lib.url_encoding import encode_stream, hash_util_encode
@@ -127,6 +137,9 @@ class MessageRenderingResult:
     links_for_preview: Set[str]
     user_ids_with_alert_words: Set[int]
     potential_attachment_path_ids: List[str]
+    # Whether this is a cheap rendering of a message which took too
+    # long to render in full; see render_degraded_markdown.
+    degraded: bool = False
 
     def has_wildcard_mention(self) -> bool:
         return self.mentions_stream_wildcard or self.mentions_topic_wildcard
@@ -264,8 +277,9 @@ def get_web_link_regex() -> Pattern[str]:
 def clear_state_for_testing() -> None:
     # The link regex never changes in production, but our tests
     # try out both sides of ENABLE_FILE_LINKS, so we need
-    # a way to clear it.
+    # a way to clear it, and the engines built with it.
     get_web_link_regex.cache_clear()
+    md_engines.clear()
 
 
 markdown_logger = logging.getLogger()
@@ -551,6 +565,25 @@ class BacktickInlineProcessor(markdown.inlinepatterns.BacktickInlineProcessor):
         return ret
 
 
+def get_attachment_path_id(url: str, realm: Optional[Realm]) -> Optional[str]:
+    """Returns the path ID of the file uploaded to `realm` which `url`
+    links to, if it links to one."""
+    # Due to rewrite_local_links_to_relative, we need to handle both
+    # relative URLs beginning with `/user_uploads` and beginning with
+    # `user_uploads`.  This urllib construction converts the latter
+    # into the former.
+    parsed_url = urllib.parse.urlsplit(urllib.parse.urljoin("/", url))
+    host = parsed_url.netloc
+
+    if host != "" and (realm is None or host != realm.host):
+        return None
+
+    if not parsed_url.path.startswith("/user_uploads/"):
+        return None
+
+    return parsed_url.path[len("/user_uploads/") :]
+
+
 # List from https://support.google.com/chromeos/bin/answer.py?hl=en&answer=183093
 IMAGE_EXTENSIONS = [".bmp", ".gif", ".jpe", ".jpeg", ".jpg", ".png", ".webp"]
 
@@ -1172,24 +1205,9 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
             self.zmd.zulip_message.has_image = False  # This is updated in self.add_a
 
             for url in unique_urls:
-                # Due to rewrite_local_links_to_relative, we need to
-                # handle both relative URLs beginning with
-                # `/user_uploads` and beginning with `user_uploads`.
-                # This urllib construction converts the latter into
-                # the former.
-                parsed_url = urllib.parse.urlsplit(urllib.parse.urljoin("/", url))
-                host = parsed_url.netloc
-
-                if host != "" and (
-                    self.zmd.zulip_realm is None or host != self.zmd.zulip_realm.host
-                ):
-                    continue
-
-                if not parsed_url.path.startswith("/user_uploads/"):
-                    continue
-
-                path_id = parsed_url.path[len("/user_uploads/") :]
-                self.zmd.zulip_rendering_result.potential_attachment_path_ids.append(path_id)
+                path_id = get_attachment_path_id(url, self.zmd.zulip_realm)
+                if path_id is not None:
+                    self.zmd.zulip_rendering_result.potential_attachment_path_ids.append(path_id)
 
         if len(found_urls) == 0:
             return
@@ -1749,6 +1767,8 @@ class LinkifierPattern(CompiledInlineProcessor):
         source_pattern: str,
         url_template: str,
         zmd: "ZulipMarkdown",
+        prefilter: LinkifierPrefilter,
+        prefilter_index: int,
     ) -> None:
         # Do not write errors to stderr (this still raises exceptions)
         options = re2.Options()
@@ -1758,7 +1778,10 @@ class LinkifierPattern(CompiledInlineProcessor):
 
         self.prepared_url_template = uri_template.URITemplate(url_template)
 
-        super().__init__(compiled_re2, zmd)
+        super().__init__(
+            PrefilteredLinkifierRegex(compiled_re2, prefilter, prefilter_index),  # type: ignore[arg-type] # Only search() is used.
+            zmd,
+        )
 
     def handleMatch(  # type: ignore[override] # https://github.com/python/mypy/issues/10197
         self, m: Match[str], data: str
@@ -1779,6 +1802,26 @@ class LinkifierPattern(CompiledInlineProcessor):
         )
 
 
+def get_mentioned_user(mention_data: MentionData, name: str) -> Optional[FullNameInfo]:
+    # For @**|id** and @**name|id** mention syntaxes.
+    id_syntax_match = re.match(r"(?P<full_name>.+)?\|(?P<user_id>\d+)$", name)
+    if id_syntax_match:
+        full_name = id_syntax_match.group("full_name")
+        id = int(id_syntax_match.group("user_id"))
+        user = mention_data.get_user_by_id(id)
+
+        # For @**name|id**, we need to specifically check that
+        # name matches the full_name of user in mention_data.
+        # This enforces our decision that
+        # @**user_1_name|id_for_user_2** should be invalid syntax.
+        if full_name and user and user.full_name != full_name:
+            return None
+        return user
+
+    # For @**name** syntax.
+    return mention_data.get_user_by_name(name)
+
+
 class UserMentionPattern(CompiledInlineProcessor):
     def handleMatch(  # type: ignore[override] # https://github.com/python/mypy/issues/10197
         self, m: Match[str], data: str
@@ -1789,23 +1832,7 @@ class UserMentionPattern(CompiledInlineProcessor):
         if db_data is not None:
             topic_wildcard = mention.user_mention_matches_topic_wildcard(name)
             stream_wildcard = mention.user_mention_matches_stream_wildcard(name)
-
-            # For @**|id** and @**name|id** mention syntaxes.
-            id_syntax_match = re.match(r"(?P<full_name>.+)?\|(?P<user_id>\d+)$", name)
-            if id_syntax_match:
-                full_name = id_syntax_match.group("full_name")
-                id = int(id_syntax_match.group("user_id"))
-                user = db_data.mention_data.get_user_by_id(id)
-
-                # For @**name|id**, we need to specifically check that
-                # name matches the full_name of user in mention_data.
-                # This enforces our decision that
-                # @**user_1_name|id_for_user_2** should be invalid syntax.
-                if full_name and user and user.full_name != full_name:
-                    return None, None, None
-            else:
-                # For @**name** syntax.
-                user = db_data.mention_data.get_user_by_name(name)
+            user = get_mentioned_user(db_data.mention_data, name)
 
             user_id = None
             if stream_wildcard:
@@ -1965,16 +1992,31 @@ class AlertWordNotificationProcessor(markdown.preprocessors.Preprocessor):
         super().__init__(zmd)
         self.zmd = zmd
 
-    def check_valid_start_position(self, content: str, index: int) -> bool:
-        if index <= 0 or content[index] in self.allowed_before_punctuation:
+    @classmethod
+    def check_valid_start_position(cls, content: str, index: int) -> bool:
+        if index <= 0 or content[index] in cls.allowed_before_punctuation:
             return True
         return False
 
-    def check_valid_end_position(self, content: str, index: int) -> bool:
-        if index >= len(content) or content[index] in self.allowed_after_punctuation:
+    @classmethod
+    def check_valid_end_position(cls, content: str, index: int) -> bool:
+        if index >= len(content) or content[index] in cls.allowed_after_punctuation:
             return True
         return False
 
+    @classmethod
+    def find_user_ids_with_alert_words(
+        cls, content: str, realm_alert_words_automaton: ahocorasick.Automaton
+    ) -> Set[int]:
+        user_ids_with_alert_words: Set[int] = set()
+        content = content.lower()
+        for end_index, (original_value, user_ids) in realm_alert_words_automaton.iter(content):
+            if cls.check_valid_start_position(
+                content, end_index - len(original_value)
+            ) and cls.check_valid_end_position(content, end_index + 1):
+                user_ids_with_alert_words.update(user_ids)
+        return user_ids_with_alert_words
+
     def run(self, lines: List[str]) -> List[str]:
         db_data: Optional[DbData] = self.zmd.zulip_db_data
         if db_data is not None:
@@ -1988,14 +2030,11 @@ class AlertWordNotificationProcessor(markdown.preprocessors.Preprocessor):
             realm_alert_words_automaton = db_data.realm_alert_words_automaton
 
             if realm_alert_words_automaton is not None:
-                content = "\n".join(lines).lower()
-                for end_index, (original_value, user_ids) in realm_alert_words_automaton.iter(
-                    content
-                ):
-                    if self.check_valid_start_position(
-                        content, end_index - len(original_value)
-                    ) and self.check_valid_end_position(content, end_index + 1):
-                        self.zmd.zulip_rendering_result.user_ids_with_alert_words.update(user_ids)
+                self.zmd.zulip_rendering_result.user_ids_with_alert_words.update(
+                    self.find_user_ids_with_alert_words(
+                        "\n".join(lines), realm_alert_words_automaton
+                    )
+                )
         return lines
 
 
@@ -2053,12 +2092,24 @@ def get_sub_registry(r: markdown.util.Registry, keys: List[str]) -> markdown.uti
     return new_r
 
 
-# These are used as keys ("linkifiers_keys") to md_engines and the respective
-# linkifier caches
+# These are used as keys ("linkifiers_keys") for the linkifier caches,
+# in place of a realm ID; the zephyr mirror key also selects an engine
+# with most syntax disabled.
 DEFAULT_MARKDOWN_KEY = -1
 ZEPHYR_MIRROR_MARKDOWN_KEY = -2
 
 
+def timed_stage(stage: str, run: Callable[..., ReturnT]) -> Callable[..., ReturnT]:
+    def timed_run(*args: Any) -> ReturnT:
+        start = time.perf_counter()
+        try:
+            return run(*args)
+        finally:
+            markdown_render_stats.record_stage(stage, time.perf_counter() - start)
+
+    return timed_run
+
+
 class ZulipMarkdown(markdown.Markdown):
     zulip_message: Optional[Message]
     zulip_realm: Optional[Realm]
@@ -2071,11 +2122,11 @@ class ZulipMarkdown(markdown.Markdown):
     def __init__(
         self,
         linkifiers: List[LinkifierDict],
-        linkifiers_key: int,
+        zephyr_mirror: bool,
         email_gateway: bool,
     ) -> None:
         self.linkifiers = linkifiers
-        self.linkifiers_key = linkifiers_key
+        self.zephyr_mirror = zephyr_mirror
         self.email_gateway = email_gateway
 
         super().__init__(
@@ -2089,6 +2140,24 @@ class ZulipMarkdown(markdown.Markdown):
             ],
         )
         self.set_output_format("html")
+        self.time_stages()
+
+    def time_stages(self) -> None:
+        # Record how long each processor takes, in
+        # markdown_render_stats.  The inline patterns are all run by
+        # the "inline" tree processor, and are timed together there;
+        # timing each of a realm's linkifiers separately would cost
+        # more than searching for them does.
+        registries = [
+            ("preprocessor", self.preprocessors),
+            ("treeprocessor", self.treeprocessors),
+            ("postprocessor", self.postprocessors),
+        ]
+        for kind, registry in registries:
+            for processor in registry:
+                stage = f"{kind}/{type(processor).__name__}"
+                processor.run = timed_stage(stage, processor.run)  # type: ignore[method-assign] # Wrapped for timing
+        self.parser.parseDocument = timed_stage("block_parser", self.parser.parseDocument)  # type: ignore[method-assign] # Wrapped for timing
 
     def build_parser(self) -> markdown.Markdown:
         # Build the parser using selected default features from Python-Markdown.
@@ -2225,10 +2294,13 @@ class ZulipMarkdown(markdown.Markdown):
         return reg
 
     def register_linkifiers(self, registry: markdown.util.Registry) -> markdown.util.Registry:
-        for linkifier in self.linkifiers:
+        # The linkifiers share a prefilter, which finds the ones that
+        # could match a text node with a single scan.
+        prefilter = LinkifierPrefilter([linkifier["pattern"] for linkifier in self.linkifiers])
+        for index, linkifier in enumerate(self.linkifiers):
             pattern = linkifier["pattern"]
             registry.register(
-                LinkifierPattern(pattern, linkifier["url_template"], self),
+                LinkifierPattern(pattern, linkifier["url_template"], self, prefilter, index),
                 f"linkifiers/{pattern}",
                 45,
             )
@@ -2258,7 +2330,7 @@ class ZulipMarkdown(markdown.Markdown):
         return postprocessors
 
     def handle_zephyr_mirror(self) -> None:
-        if self.linkifiers_key == ZEPHYR_MIRROR_MARKDOWN_KEY:
+        if self.zephyr_mirror:
             # Disable almost all inline patterns for zephyr mirror
             # users' traffic that is mirrored.  Note that
             # inline_interesting_links is a treeprocessor and thus is
@@ -2278,21 +2350,84 @@ class ZulipMarkdown(markdown.Markdown):
             )
 
 
-md_engines: Dict[Tuple[int, bool], ZulipMarkdown] = {}
-linkifier_data: Dict[int, List[LinkifierDict]] = {}
+# Engines are keyed by what they're built with: the linkifiers, as
+# (pattern, url_template) pairs, so that realms with the same
+# linkifiers (most often, none) share an engine; whether the engine is
+# for zephyr mirroring; and email_gateway.
+MarkdownEngineKey = Tuple[Tuple[Tuple[str, str], ...], bool, bool]
 
+# Engines are slow to build, and large for realms with many
+# linkifiers, so each process keeps the most recently used ones.
+MARKDOWN_ENGINE_POOL_SIZE = 50
 
-def make_md_engine(linkifiers_key: int, email_gateway: bool) -> None:
-    md_engine_key = (linkifiers_key, email_gateway)
-    if md_engine_key in md_engines:
-        del md_engines[md_engine_key]
 
-    linkifiers = linkifier_data[linkifiers_key]
-    md_engines[md_engine_key] = ZulipMarkdown(
+@dataclass
+class MarkdownEngineStats:
+    builds: int = 0
+    evictions: int = 0
+    build_time: float = 0.0
+    # Python memory allocated by building engines; only measured while
+    # tracemalloc is tracing (e.g. with PYTHONTRACEMALLOC=1).
+    build_memory_bytes: int = 0
+    last_build_time: float = 0.0
+    last_build_memory_bytes: Optional[int] = None
+
+
+md_engines: "OrderedDict[MarkdownEngineKey, ZulipMarkdown]" = OrderedDict()
+md_engine_stats = MarkdownEngineStats()
+
+
+def make_md_engine(
+    linkifiers: List[LinkifierDict], zephyr_mirror: bool, email_gateway: bool
+) -> ZulipMarkdown:
+    tracing_memory = tracemalloc.is_tracing()
+    if tracing_memory:
+        memory_before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    md_engine = ZulipMarkdown(
         linkifiers=linkifiers,
-        linkifiers_key=linkifiers_key,
+        zephyr_mirror=zephyr_mirror,
         email_gateway=email_gateway,
     )
+    build_time = time.perf_counter() - start
+
+    md_engine_stats.builds += 1
+    md_engine_stats.build_time += build_time
+    md_engine_stats.last_build_time = build_time
+    md_engine_stats.last_build_memory_bytes = None
+    if tracing_memory:
+        build_memory = tracemalloc.get_traced_memory()[0] - memory_before
+        md_engine_stats.build_memory_bytes += build_memory
+        md_engine_stats.last_build_memory_bytes = build_memory
+    return md_engine
+
+
+def get_markdown_engine(
+    linkifiers_key: int, email_gateway: bool, linkifiers: Optional[List[LinkifierDict]] = None
+) -> ZulipMarkdown:
+    # Callers rendering in a worker process, without access to the
+    # database, pass the current linkifiers in.
+    if linkifiers is None:
+        linkifiers = linkifiers_for_realm(linkifiers_key)
+    zephyr_mirror = linkifiers_key == ZEPHYR_MIRROR_MARKDOWN_KEY
+    md_engine_key = (
+        tuple((linkifier["pattern"], linkifier["url_template"]) for linkifier in linkifiers),
+        zephyr_mirror,
+        email_gateway,
+    )
+    md_engine = md_engines.get(md_engine_key)
+    if md_engine is None:
+        md_engine = make_md_engine(linkifiers, zephyr_mirror, email_gateway)
+        md_engines[md_engine_key] = md_engine
+        if len(md_engines) > MARKDOWN_ENGINE_POOL_SIZE:
+            md_engines.popitem(last=False)
+            md_engine_stats.evictions += 1
+    md_engines.move_to_end(md_engine_key)
+    return md_engine
+
+
+def get_markdown_engine_stats() -> Dict[str, Any]:
+    return dict(asdict(md_engine_stats), engines=len(md_engines))
 
 
 # Split the topic name into multiple sections so that we can easily use
@@ -2323,20 +2458,23 @@ class TopicLinkMatch:
     precedence: Optional[int]
 
 
-# Security note: We don't do any HTML escaping in this
-# function on the URLs; they are expected to be HTML-escaped when
-# rendered by clients (just as links rendered into message bodies
-# are validated and escaped inside `url_to_a`).
-def topic_links(linkifiers_key: int, topic_name: str) -> List[Dict[str, str]]:
-    matches: List[TopicLinkMatch] = []
-    linkifiers = linkifiers_for_realm(linkifiers_key)
-    precedence = 0
-
+@dataclass
+class TopicLinkifiers:
+    # The compiled regex and URL template of each linkifier, in order
+    # of precedence, and a prefilter over their patterns.
+    linkifiers: List[Tuple[Pattern[str], uri_template.URITemplate]]
+    prefilter: LinkifierPrefilter
+
+
+@lru_cache(maxsize=100)
+def get_topic_linkifiers(linkifiers: Tuple[Tuple[str, str], ...]) -> TopicLinkifiers:
+    """Compiles a realm's (pattern, url_template) linkifiers, for
+    topic_links; realms with the same linkifiers share the result."""
+    compiled_linkifiers: List[Tuple[Pattern[str], uri_template.URITemplate]] = []
+    raw_patterns: List[str] = []
     options = re2.Options()
     options.log_errors = False
-    for linkifier in linkifiers:
-        raw_pattern = linkifier["pattern"]
-        prepared_url_template = uri_template.URITemplate(linkifier["url_template"])
+    for raw_pattern, url_template in linkifiers:
         try:
             pattern = re2.compile(prepare_linkifier_pattern(raw_pattern), options=options)
         except re2.error:
@@ -2344,6 +2482,30 @@ def topic_links(linkifiers_key: int, topic_name: str) -> List[Dict[str, str]]:
             # here on an invalid regex would spam the logs with every
             # message sent; simply move on.
             continue
+        compiled_linkifiers.append((pattern, uri_template.URITemplate(url_template)))
+        raw_patterns.append(raw_pattern)
+    return TopicLinkifiers(
+        linkifiers=compiled_linkifiers, prefilter=LinkifierPrefilter(raw_patterns)
+    )
+
+
+# Security note: We don't do any HTML escaping in this
+# function on the URLs; they are expected to be HTML-escaped when
+# rendered by clients (just as links rendered into message bodies
+# are validated and escaped inside `url_to_a`).
+def topic_links(linkifiers_key: int, topic_name: str) -> List[Dict[str, str]]:
+    matches: List[TopicLinkMatch] = []
+    topic_linkifiers = get_topic_linkifiers(
+        tuple(
+            (linkifier["pattern"], linkifier["url_template"])
+            for linkifier in linkifiers_for_realm(linkifiers_key)
+        )
+    )
+    candidates = topic_linkifiers.prefilter.candidates(topic_name)
+
+    for precedence, (pattern, prepared_url_template) in enumerate(topic_linkifiers.linkifiers):
+        if precedence not in candidates:
+            continue
         pos = 0
         while pos < len(topic_name):
             m = pattern.search(topic_name, pos)
@@ -2370,7 +2532,6 @@ def topic_links(linkifiers_key: int, topic_name: str) -> List[Dict[str, str]]:
                     precedence=precedence,
                 )
             ]
-        precedence += 1
 
     # Sort the matches beforehand so we favor the match with a higher priority and tie-break with the starting index.
     # Note that we sort it before processing the raw URLs so that linkifiers will be prioritized over them.
@@ -2433,22 +2594,6 @@ def topic_links(linkifiers_key: int, topic_name: str) -> List[Dict[str, str]]:
     return [{"url": match.url, "text": match.text} for match in applied_matches]
 
 
-def maybe_update_markdown_engines(linkifiers_key: int, email_gateway: bool) -> None:
-    linkifiers = linkifiers_for_realm(linkifiers_key)
-    if linkifiers_key not in linkifier_data or linkifier_data[linkifiers_key] != linkifiers:
-        # Linkifier data has changed, update `linkifier_data` and any
-        # of the existing Markdown engines using this set of linkifiers.
-        linkifier_data[linkifiers_key] = linkifiers
-        for email_gateway_flag in [True, False]:
-            if (linkifiers_key, email_gateway_flag) in md_engines:
-                # Update only existing engines(if any), don't create new one.
-                make_md_engine(linkifiers_key, email_gateway_flag)
-
-    if (linkifiers_key, email_gateway) not in md_engines:
-        # Markdown engine corresponding to this key doesn't exists so create one.
-        make_md_engine(linkifiers_key, email_gateway)
-
-
 # We want to log Markdown parser failures, but shouldn't log the actual input
 # message for privacy reasons.  The compromise is to replace all alphanumeric
 # characters with 'x'.
@@ -2462,7 +2607,28 @@ def privacy_clean_markdown(content: str) -> str:
     return repr(_privacy_re.sub("x", content))
 
 
-def do_convert(
+@dataclass
+class MarkdownRenderTask:
+    """Everything needed to render a message's content, with any
+    database queries already done; this can be pickled and rendered
+    in another process (see zerver.lib.markdown.render_pool)."""
+
+    content: str
+    linkifiers_key: int
+    linkifiers: List[LinkifierDict]
+    email_gateway: bool
+    message_realm: Optional[Realm]
+    db_data: Optional[DbData]
+    image_preview_enabled: bool
+    url_embed_preview_enabled: bool
+    url_embed_data: Optional[Dict[str, Optional[UrlEmbedData]]]
+    logging_message_id: str
+    # If set, a rendering which takes longer than this is abandoned
+    # for a degraded one; see render_degraded_markdown.
+    time_budget: Optional[float] = None
+
+
+def prepare_markdown_render(
     content: str,
     realm_alert_words_automaton: Optional[ahocorasick.Automaton] = None,
     message: Optional[Message] = None,
@@ -2473,8 +2639,8 @@ def do_convert(
     mention_data: Optional[MentionData] = None,
     email_gateway: bool = False,
     no_previews: bool = False,
-) -> MessageRenderingResult:
-    """Convert Markdown to HTML, with Zulip-specific settings and hacks."""
+    allow_degraded: bool = False,
+) -> MarkdownRenderTask:
     # This logic is a bit convoluted, but the overall goal is to support a range of use cases:
     # * Nothing is passed in other than content -> just run default options (e.g. for docs)
     # * message is passed, but no realm is -> look up realm from message
@@ -2501,35 +2667,7 @@ def do_convert(
         # delivered via zephyr_mirror
         linkifiers_key = ZEPHYR_MIRROR_MARKDOWN_KEY
 
-    maybe_update_markdown_engines(linkifiers_key, email_gateway)
-    md_engine_key = (linkifiers_key, email_gateway)
-    _md_engine = md_engines[md_engine_key]
-    # Reset the parser; otherwise it will get slower over time.
-    _md_engine.reset()
-
-    # Filters such as UserMentionPattern need a message.
-    rendering_result: MessageRenderingResult = MessageRenderingResult(
-        rendered_content="",
-        mentions_topic_wildcard=False,
-        mentions_stream_wildcard=False,
-        mentions_user_ids=set(),
-        mentions_user_group_ids=set(),
-        alert_words=set(),
-        links_for_preview=set(),
-        user_ids_with_alert_words=set(),
-        potential_attachment_path_ids=[],
-    )
-
-    _md_engine.zulip_message = message
-    _md_engine.zulip_rendering_result = rendering_result
-    _md_engine.zulip_realm = message_realm
-    _md_engine.zulip_db_data = None  # for now
-    _md_engine.image_preview_enabled = image_preview_enabled(message, message_realm, no_previews)
-    _md_engine.url_embed_preview_enabled = url_embed_preview_enabled(
-        message, message_realm, no_previews
-    )
-    _md_engine.url_embed_data = url_embed_data
-
+    db_data: Optional[DbData] = None
     # Pre-fetch data from the DB that is used in the Markdown thread
     if message_realm is not None:
         # Here we fetch the data structures needed to render
@@ -2550,7 +2688,7 @@ def do_convert(
         else:
             active_realm_emoji = {}
 
-        _md_engine.zulip_db_data = DbData(
+        db_data = DbData(
             realm_alert_words_automaton=realm_alert_words_automaton,
             mention_data=mention_data,
             active_realm_emoji=active_realm_emoji,
@@ -2560,13 +2698,76 @@ def do_convert(
             translate_emoticons=translate_emoticons,
         )
 
+    return MarkdownRenderTask(
+        content=content,
+        linkifiers_key=linkifiers_key,
+        linkifiers=linkifiers_for_realm(linkifiers_key),
+        email_gateway=email_gateway,
+        message_realm=message_realm,
+        db_data=db_data,
+        image_preview_enabled=image_preview_enabled(message, message_realm, no_previews),
+        url_embed_preview_enabled=url_embed_preview_enabled(message, message_realm, no_previews),
+        url_embed_data=url_embed_data,
+        logging_message_id=logging_message_id,
+        time_budget=settings.MARKDOWN_RENDER_BUDGET_SECONDS if allow_degraded else None,
+    )
+
+
+def render_markdown_task(
+    task: MarkdownRenderTask, message: Optional[Message] = None
+) -> MessageRenderingResult:
+    """Renders a task from prepare_markdown_render; this doesn't
+    access the database.  If `message` is passed, its has_link and
+    has_image flags are updated."""
+    _md_engine = get_markdown_engine(task.linkifiers_key, task.email_gateway, task.linkifiers)
+    # Reset the parser; otherwise it will get slower over time.
+    _md_engine.reset()
+
+    # Filters such as UserMentionPattern need a message.
+    rendering_result: MessageRenderingResult = MessageRenderingResult(
+        rendered_content="",
+        mentions_topic_wildcard=False,
+        mentions_stream_wildcard=False,
+        mentions_user_ids=set(),
+        mentions_user_group_ids=set(),
+        alert_words=set(),
+        links_for_preview=set(),
+        user_ids_with_alert_words=set(),
+        potential_attachment_path_ids=[],
+    )
+
+    _md_engine.zulip_message = message
+    _md_engine.zulip_rendering_result = rendering_result
+    _md_engine.zulip_realm = task.message_realm
+    _md_engine.zulip_db_data = task.db_data
+    _md_engine.image_preview_enabled = task.image_preview_enabled
+    _md_engine.url_embed_preview_enabled = task.url_embed_preview_enabled
+    _md_engine.url_embed_data = task.url_embed_data
+
+    content = task.content
+    start = time.perf_counter()
     try:
         # Spend at most 5 seconds rendering; this protects the backend
         # from being overloaded by bugs (e.g. Markdown logic that is
         # extremely inefficient in corner cases) as well as user
         # errors (e.g. a linkifier that makes some syntax
-        # infinite-loop).
-        rendering_result.rendered_content = timeout(5, lambda: _md_engine.convert(content))
+        # infinite-loop).  Callers which can make do with a degraded
+        # rendering may set a smaller budget.
+        render_timeout = 5 if task.time_budget is None else min(task.time_budget, 5)
+        try:
+            rendering_result.rendered_content = timeout(
+                render_timeout, lambda: _md_engine.convert(content)
+            )
+        except TimeoutExpiredError:
+            if task.time_budget is None:
+                raise
+            markdown_render_stats.over_budget += 1
+            markdown_logger.warning(
+                "Rendering message %s took over %ss; sending a degraded rendering",
+                task.logging_message_id,
+                render_timeout,
+            )
+            return render_degraded_markdown(task, message)
 
         # Throw an exception if the content is huge; this protects the
         # rest of the codebase from any bugs where we end up rendering
@@ -2574,7 +2775,7 @@ def do_convert(
         MAX_MESSAGE_LENGTH = settings.MAX_MESSAGE_LENGTH
         if len(rendering_result.rendered_content) > MAX_MESSAGE_LENGTH * 100:
             raise MarkdownRenderingError(
-                f"Rendered content exceeds {MAX_MESSAGE_LENGTH * 100} characters (message {logging_message_id})"
+                f"Rendered content exceeds {MAX_MESSAGE_LENGTH * 100} characters (message {task.logging_message_id})"
             )
         return rendering_result
     except Exception:
@@ -2582,11 +2783,12 @@ def do_convert(
         markdown_logger.exception(
             "Exception in Markdown parser; input (sanitized) was: %s\n (message %s)",
             cleaned,
-            logging_message_id,
+            task.logging_message_id,
         )
 
         raise MarkdownRenderingError
     finally:
+        markdown_render_stats.render_time_secs.observe(time.perf_counter() - start)
         # These next three lines are slightly paranoid, since
         # we always set these right before actually using the
         # engine, but better safe then sorry.
@@ -2595,6 +2797,228 @@ def do_convert(
         _md_engine.zulip_db_data = None
 
 
+INLINE_CODE_RE = re.compile(r"(?<!\\)(`+)(.+?)(?<!`)\1(?!`)", re.DOTALL)
+
+
+def remove_code_and_quotes(content: str) -> str:
+    """Approximately removes the code blocks, inline code and quotes
+    from Markdown `content`, without rendering it."""
+    lines: List[str] = []
+    fence: Optional[str] = None
+    keep_fenced_lines = False
+    for line in content.split("\n"):
+        if fence is not None:
+            if line.strip() == fence:
+                fence = None
+            elif keep_fenced_lines:
+                lines.append(line)
+            continue
+        m = FENCE_RE.match(line)
+        if m is not None:
+            fence = m.group("fence")
+            # Spoilers are the only fenced blocks whose content is
+            # rendered as Markdown, rather than as code or a quote.
+            keep_fenced_lines = m.group("lang") == "spoiler"
+            continue
+        if line.lstrip().startswith(">"):
+            continue
+        lines.append(line)
+    return INLINE_CODE_RE.sub("", "\n".join(lines))
+
+
+def render_degraded_markdown(
+    task: MarkdownRenderTask, message: Optional[Message] = None
+) -> MessageRenderingResult:
+    """A cheap rendering of a task's content, for messages which took too
+    long to render in full: paragraphs of escaped text, with links.
+
+    Sending the message depends on the mentions, alert words and
+    uploaded files in it, so we still look for those, leaving out
+    code and quotes, where mentions and alert words don't notify
+    anyone; but not for links to preview.  The caller should arrange
+    for the message to be rendered in full later, and its recipients'
+    flags updated to match.
+    """
+    rendering_result = MessageRenderingResult(
+        rendered_content="",
+        mentions_topic_wildcard=False,
+        mentions_stream_wildcard=False,
+        mentions_user_ids=set(),
+        mentions_user_group_ids=set(),
+        alert_words=set(),
+        links_for_preview=set(),
+        user_ids_with_alert_words=set(),
+        potential_attachment_path_ids=[],
+        degraded=True,
+    )
+    db_data = task.db_data
+    if db_data is not None:
+        notifying_content = remove_code_and_quotes(task.content)
+        for m in mention.MENTIONS_RE.finditer(notifying_content):
+            if m.group("silent") == "_":
+                continue
+            name = m.group("match")
+            if mention.user_mention_matches_stream_wildcard(name):
+                rendering_result.mentions_stream_wildcard = True
+            elif mention.user_mention_matches_topic_wildcard(name):
+                rendering_result.mentions_topic_wildcard = True
+            else:
+                user = get_mentioned_user(db_data.mention_data, name)
+                if user is not None:
+                    rendering_result.mentions_user_ids.add(user.id)
+        for m in mention.USER_GROUP_MENTIONS_RE.finditer(notifying_content):
+            if m.group("silent") == "_":
+                continue
+            user_group = db_data.mention_data.get_user_group(m.group("match"))
+            if user_group is not None:
+                rendering_result.mentions_user_group_ids.add(user_group.id)
+        if db_data.realm_alert_words_automaton is not None:
+            rendering_result.user_ids_with_alert_words = (
+                AlertWordNotificationProcessor.find_user_ids_with_alert_words(
+                    notifying_content, db_data.realm_alert_words_automaton
+                )
+            )
+
+    has_link = False
+    paragraphs = []
+    for paragraph in re.split(r"\n\s*\n", task.content.strip()):
+        parts = []
+        end = 0
+        for m in get_web_link_regex().finditer(paragraph):
+            link = url_to_a(db_data, m.group("url"))
+            if isinstance(link, str):
+                continue
+            href = link.get("href")
+            assert href is not None
+            has_link = True
+            path_id = get_attachment_path_id(href, task.message_realm)
+            if path_id is not None:
+                rendering_result.potential_attachment_path_ids.append(path_id)
+            parts.append(html.escape(paragraph[end : m.start("url")]))
+            parts.append(f'<a href="{html.escape(href)}">{html.escape(m.group("url"))}</a>')
+            end = m.end("url")
+        parts.append(html.escape(paragraph[end:]))
+        paragraphs.append("<p>" + "".join(parts).replace("\n", "<br>\n") + "</p>")
+    rendering_result.rendered_content = "\n".join(paragraphs)
+
+    if message is not None:
+        message.has_link = has_link
+        message.has_image = False
+    return rendering_result
+
+
+# How long to keep cached renderings of message content; see do_convert.
+RENDERED_CONTENT_CACHE_TIMEOUT = 3600 * 24
+
+
+def get_realm_rendering_version(realm_id: int) -> str:
+    key = realm_rendering_version_cache_key(realm_id)
+    cached = cache_get(key)
+    if cached is not None:
+        return cached[0]
+    # Flushing the version (see flush_realm_rendering_version) deletes
+    # it; whichever process next renders a message picks a new one.
+    rendering_version = secrets.token_hex(8)
+    cache_set(key, rendering_version)
+    return rendering_version
+
+
+def rendering_depends_on_db_data(
+    content: str, realm_alert_words_automaton: Optional[ahocorasick.Automaton]
+) -> bool:
+    """Whether rendering `content` might depend on more than the realm's
+    linkifiers, custom emoji and settings: on the users, user groups or
+    streams it might mention, or on users' alert words.  This only
+    looks at the syntax, so it's an overestimate."""
+    if mention.MENTIONS_RE.search(content) or mention.USER_GROUP_MENTIONS_RE.search(content):
+        return True
+    if possible_linked_stream_names(content):
+        return True
+    if realm_alert_words_automaton is not None:
+        return next(realm_alert_words_automaton.iter(content.lower()), None) is not None
+    return False
+
+
+def rendering_options_key(task: MarkdownRenderTask) -> str:
+    assert task.db_data is not None
+    options = [
+        version,
+        task.linkifiers_key,
+        task.email_gateway,
+        task.db_data.sent_by_bot,
+        task.db_data.translate_emoticons,
+        task.image_preview_enabled,
+        task.url_embed_preview_enabled,
+    ]
+    return ":".join(str(option) for option in options)
+
+
+def do_convert(
+    content: str,
+    realm_alert_words_automaton: Optional[ahocorasick.Automaton] = None,
+    message: Optional[Message] = None,
+    message_realm: Optional[Realm] = None,
+    sent_by_bot: bool = False,
+    translate_emoticons: bool = False,
+    url_embed_data: Optional[Dict[str, Optional[UrlEmbedData]]] = None,
+    mention_data: Optional[MentionData] = None,
+    email_gateway: bool = False,
+    no_previews: bool = False,
+    allow_degraded: bool = False,
+) -> MessageRenderingResult:
+    """Convert Markdown to HTML, with Zulip-specific settings and hacks."""
+    # Bots and integrations often send the same content many times, so
+    # we cache the renderings of messages whose content doesn't mention
+    # anything, per realm.  The cache is keyed on a version token which
+    # changes whenever the realm's linkifiers, custom emoji, or
+    # rendering settings do.  We read the token before
+    # prepare_markdown_render reads any of those, so that a change
+    # racing with us can't leave an outdated rendering cached under the
+    # new token.
+    rendering_version: Optional[str] = None
+    if (
+        settings.CACHE_RENDERED_MESSAGE_CONTENT
+        and message is not None
+        and message_realm is not None
+        and url_embed_data is None
+        and not rendering_depends_on_db_data(content, realm_alert_words_automaton)
+    ):
+        rendering_version = get_realm_rendering_version(message_realm.id)
+
+    task = prepare_markdown_render(
+        content,
+        realm_alert_words_automaton,
+        message,
+        message_realm,
+        sent_by_bot,
+        translate_emoticons,
+        url_embed_data,
+        mention_data,
+        email_gateway,
+        no_previews=no_previews,
+        allow_degraded=allow_degraded,
+    )
+    if rendering_version is None:
+        return render_markdown_task(task, message)
+
+    assert message is not None
+    cache_key = rendered_content_cache_key(rendering_version, rendering_options_key(task), content)
+    cached = cache_get(cache_key)
+    if cached is not None:
+        rendering_result, message.has_link, message.has_image = cached[0]
+        return rendering_result
+
+    rendering_result = render_markdown_task(task, message)
+    if rendering_result.degraded:
+        return rendering_result
+    cache_set(
+        cache_key,
+        (rendering_result, message.has_link, message.has_image),
+        timeout=RENDERED_CONTENT_CACHE_TIMEOUT,
+    )
+    return rendering_result
+
+
 markdown_time_start = 0.0
 markdown_total_time = 0.0
 markdown_total_requests = 0
@@ -2631,6 +3055,7 @@ def markdown_convert(
     mention_data: Optional[MentionData] = None,
     email_gateway: bool = False,
     no_previews: bool = False,
+    allow_degraded: bool = False,
 ) -> MessageRenderingResult:
     markdown_stats_start()
     ret = do_convert(
@@ -2644,6 +3069,7 @@ def markdown_convert(
         mention_data,
         email_gateway,
         no_previews=no_previews,
+        allow_degraded=allow_degraded,
     )
     markdown_stats_finish()
     return ret
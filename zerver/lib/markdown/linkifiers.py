@@ -0,0 +1,136 @@
+# Realms can have hundreds of linkifiers, and searching for each of
+# them separately in every text node of every message (and in every
+# topic name) gets expensive.  But most linkifier patterns contain some
+# literal text which any match must include, such as "ZBUG-" in
+# "ZBUG-(?P<id>[0-9]+)".  LinkifierPrefilter finds which of those
+# occur in a text with a single Aho-Corasick scan, so we only run the
+# regexes of the linkifiers which could match.
+from typing import List, Match, Optional, Pattern, Sequence, Set
+
+import ahocorasick
+
+# Characters with a special meaning in a (RE2) regular expression.
+REGEX_SPECIAL_CHARACTERS = set(".^$*+?{}[]()|\\")
+
+
+def linkifier_pattern_literal(pattern: str) -> Optional[str]:
+    """Returns the longest run of literal text which any match of the
+    linkifier `pattern` must contain, or None if we can't find one.
+
+    This is deliberately conservative: it only considers text outside
+    of groups and character classes, and gives up on patterns with a
+    top-level alternation.  Since patterns can set the case-insensitive
+    flag, matches only contain the text up to case.
+    """
+    runs: List[str] = []
+    current = ""
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        literal: Optional[str] = None
+        if char == "\\" and i + 1 < len(pattern):
+            escaped = pattern[i + 1]
+            i += 2
+            if depth == 0 and not escaped.isalnum():
+                literal = escaped
+        elif char == "{":
+            # Skip the repetition count; the preceding character is
+            # optional, if it may be repeated zero times.
+            end = pattern.find("}", i)
+            i = len(pattern) if end == -1 else end + 1
+            current = current[:-1]
+        elif char == "[":
+            # Skip the character class; a "]" first in it is literal.
+            i += 2 if pattern[i + 1 : i + 2] == "]" else 1
+            while i < len(pattern) and pattern[i] != "]":
+                i += 2 if pattern[i] == "\\" else 1
+            i += 1
+        else:
+            i += 1
+            if char == "(":
+                depth += 1
+            elif char == ")":
+                depth -= 1
+            elif char == "|" and depth == 0:
+                return None
+            elif char in "?*" and current:
+                # The preceding character is optional.
+                current = current[:-1]
+            elif char not in REGEX_SPECIAL_CHARACTERS and depth == 0:
+                literal = char
+
+        if literal is not None:
+            current += literal
+        else:
+            runs.append(current)
+            current = ""
+    runs.append(current)
+
+    longest = max(runs, key=len)
+    if longest == "":
+        return None
+    return longest
+
+
+class LinkifierPrefilter:
+    """Finds which of a list of linkifier patterns could match a text;
+    patterns are referred to by their index in the list."""
+
+    def __init__(self, patterns: Sequence[str]) -> None:
+        # Patterns without a literal we can look for could match any text.
+        self.unfiltered: Set[int] = set()
+        automaton = ahocorasick.Automaton()
+        for index, pattern in enumerate(patterns):
+            literal = linkifier_pattern_literal(pattern)
+            if literal is None:
+                self.unfiltered.add(index)
+                continue
+            # We compare case-folded text, since the pattern may be
+            # case-insensitive.
+            literal = literal.casefold()
+            if automaton.exists(literal):
+                automaton.get(literal).add(index)
+            else:
+                automaton.add_word(literal, {index})
+        automaton.make_automaton()
+        # As in get_alert_word_automaton, an automaton with no words
+        # can't be searched.
+        self.automaton: Optional[ahocorasick.Automaton] = (
+            automaton if automaton.kind == ahocorasick.AHOCORASICK else None
+        )
+
+        # The Markdown processor tries each linkifier in turn on the
+        # same text, so we remember the candidates for the last text.
+        self.last_text: Optional[str] = None
+        self.last_candidates: Set[int] = set()
+
+    def candidates(self, text: str) -> Set[int]:
+        """Returns the indexes of the patterns which could match somewhere
+        in `text`."""
+        if text != self.last_text:
+            candidates = set(self.unfiltered)
+            if self.automaton is not None:
+                for end_index, indexes in self.automaton.iter(text.casefold()):
+                    candidates |= indexes
+            self.last_text = text
+            self.last_candidates = candidates
+        return self.last_candidates
+
+
+class PrefilteredLinkifierRegex:
+    """Wraps a linkifier's compiled regex, for a LinkifierPattern: the
+    Markdown processor only calls search(), which skips running the
+    regex on text where the prefilter shows it can't match."""
+
+    def __init__(
+        self, compiled_re: Pattern[str], prefilter: LinkifierPrefilter, index: int
+    ) -> None:
+        self.compiled_re = compiled_re
+        self.prefilter = prefilter
+        self.index = index
+
+    def search(self, text: str, pos: int = 0) -> Optional[Match[str]]:
+        if self.index not in self.prefilter.candidates(text):
+            return None
+        return self.compiled_re.search(text, pos)
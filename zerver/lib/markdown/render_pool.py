@@ -0,0 +1,146 @@
+# Rendering Markdown is CPU-bound, so code which renders many messages
+# at once (sending several messages in one request, importing a realm,
+# or re-rendering a realm's existing messages) can spread the work
+# across a pool of worker processes.
+#
+# The database queries a render needs (mentions, stream names, custom
+# emoji, linkifiers) are done in the calling process, by
+# prepare_markdown_render; workers only run the Markdown engines, which
+# stay warm in each worker between batches.  Workers are started with
+# the "spawn" method, so they don't share the parent's database or
+# memcached connections.
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+import django
+from django.conf import settings
+
+from zerver.lib.exceptions import MarkdownRenderingError
+from zerver.lib.markdown import (
+    MarkdownRenderTask,
+    MessageRenderingResult,
+    markdown_stats_finish,
+    markdown_stats_start,
+    render_markdown_task,
+)
+from zerver.models import Message
+
+# Below this many messages, it's faster to render in-process than to
+# pickle the tasks over to the workers and back.
+MIN_PARALLEL_RENDER_BATCH = 8
+
+# Messages per call into a worker process.
+RENDER_CHUNK_SIZE = 50
+
+
+@dataclass
+class RenderedMessage:
+    rendering_result: MessageRenderingResult
+    # The message flags that rendering sets; see
+    # InlineInterestingLinkProcessor.
+    has_link: bool
+    has_image: bool
+
+
+# A task, and whether the caller has a Message whose flags should be
+# set from the rendering.
+RenderInput = Tuple[MarkdownRenderTask, bool]
+
+
+def initialize_render_worker() -> None:
+    django.setup()
+
+
+def render_in_worker(inputs: List[RenderInput]) -> List[Optional[RenderedMessage]]:
+    results: List[Optional[RenderedMessage]] = []
+    for task, has_message in inputs:
+        # The engine only sets flags, and collects attachment paths,
+        # when it's rendering a message; a placeholder that's never
+        # saved stands in for the caller's.
+        message = Message() if has_message else None
+        try:
+            rendering_result = render_markdown_task(task, message)
+        except MarkdownRenderingError:
+            # Already logged, by render_markdown_task.
+            results.append(None)
+            continue
+        results.append(
+            RenderedMessage(
+                rendering_result=rendering_result,
+                has_link=message is not None and message.has_link,
+                has_image=message is not None and message.has_image,
+            )
+        )
+    return results
+
+
+class MarkdownRenderPool:
+    """Renders batches of MarkdownRenderTasks, in `processes` worker
+    processes; with one process, renders in the calling process."""
+
+    def __init__(self, processes: int) -> None:
+        self.processes = processes
+        self.executor: Optional[Executor] = None
+
+    def __enter__(self) -> "MarkdownRenderPool":
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.shutdown()
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def get_executor(self) -> Executor:  # nocoverage
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=initialize_render_worker,
+            )
+        return self.executor
+
+    def render(
+        self, tasks: Sequence[Tuple[MarkdownRenderTask, Optional[Message]]]
+    ) -> List[Optional[RenderedMessage]]:
+        """Returns the rendering of each task, in order, or None where
+        rendering failed.  Each Message passed in gets its has_link
+        and has_image flags updated, as in do_convert."""
+        inputs = [(task, message is not None) for task, message in tasks]
+        if self.processes <= 1 or len(tasks) < MIN_PARALLEL_RENDER_BATCH:
+            results = []
+            for render_input in inputs:
+                markdown_stats_start()
+                results.extend(render_in_worker([render_input]))
+                markdown_stats_finish()
+        else:
+            chunks = [
+                inputs[i : i + RENDER_CHUNK_SIZE] for i in range(0, len(inputs), RENDER_CHUNK_SIZE)
+            ]
+            results = [
+                result
+                for chunk_results in self.get_executor().map(render_in_worker, chunks)
+                for result in chunk_results
+            ]
+
+        for (_, message), result in zip(tasks, results):
+            if message is not None and result is not None:
+                message.has_link = result.has_link
+                message.has_image = result.has_image
+        return results
+
+
+# Used for rendering in Django processes which serve requests, and
+# kept for their lifetime, so that its workers' engines stay warm.
+shared_render_pool: Optional[MarkdownRenderPool] = None
+
+
+def get_shared_render_pool() -> MarkdownRenderPool:
+    global shared_render_pool
+    if shared_render_pool is None:
+        shared_render_pool = MarkdownRenderPool(settings.MARKDOWN_RENDER_PROCESSES)
+    return shared_render_pool
@@ -0,0 +1,37 @@
+from typing import Any, Dict
+
+from zerver.lib.histogram import Histogram
+
+# Upper bounds of the histogram buckets for the time spent rendering
+# messages, and in each stage of rendering them.
+RENDER_TIME_SECS_BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5]
+
+
+class MarkdownRenderStats:
+    def __init__(self) -> None:
+        self.clear()
+
+    def clear(self) -> None:
+        self.render_time_secs = Histogram(RENDER_TIME_SECS_BUCKETS)
+        # Keyed by stage, e.g. "treeprocessor/InlineInterestingLinkProcessor";
+        # see ZulipMarkdown.time_stages.
+        self.stage_time_secs: Dict[str, Histogram] = {}
+        self.over_budget = 0
+
+    def record_stage(self, stage: str, time_secs: float) -> None:
+        histogram = self.stage_time_secs.get(stage)
+        if histogram is None:
+            histogram = self.stage_time_secs[stage] = Histogram(RENDER_TIME_SECS_BUCKETS)
+        histogram.observe(time_secs)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(
+            render_time_secs=self.render_time_secs.to_dict(),
+            stage_time_secs={
+                stage: histogram.to_dict() for stage, histogram in self.stage_time_secs.items()
+            },
+            over_budget=self.over_budget,
+        )
+
+
+markdown_render_stats = MarkdownRenderStats()
@@ -17,9 +17,10 @@ from typing import (
 )
 
 import ahocorasick
+import lxml.html
 import orjson
 from django.conf import settings
-from django.db import connection
+from django.db import connection, transaction
 from django.db.models import Max, Sum
 from django.utils.timezone import now as timezone_now
 from django.utils.translation import gettext as _
@@ -30,17 +31,26 @@ from analytics.lib.counts import COUNT_STATS
 from analytics.models import RealmCount
 from zerver.lib.avatar import get_avatar_field
 from zerver.lib.cache import (
+    cache_get_many,
     cache_set_many,
     cache_with_key,
     generic_bulk_cached_fetch,
     to_dict_cache_key,
     to_dict_cache_key_id,
+    translation_fill_cache_key,
 )
 from zerver.lib.display_recipient import bulk_fetch_display_recipients
 from zerver.lib.exceptions import JsonableError, MissingAuthenticationError
-from zerver.lib.markdown import MessageRenderingResult, markdown_convert, topic_links
+from zerver.lib.markdown import (
+    MessageRenderingResult,
+    markdown_convert,
+    prepare_markdown_render,
+    topic_links,
+)
 from zerver.lib.markdown import version as markdown_version
+from zerver.lib.markdown.render_pool import MarkdownRenderPool
 from zerver.lib.mention import MentionData
+from zerver.lib.queue import queue_json_publish
 from zerver.lib.request import RequestVariableConversionError
 from zerver.lib.stream_subscription import (
     get_stream_subscriptions_for_user,
@@ -57,6 +67,7 @@ from zerver.lib.user_topics import build_topic_mute_checker, topic_has_visibilit
 from zerver.models import (
     MAX_TOPIC_NAME_LENGTH,
     Message,
+    MessageTranslation,
     Reaction,
     Realm,
     Recipient,
@@ -207,6 +218,10 @@ class SendMessageRequest:
 # user has more older unread messages that were cut off.
 MAX_UNREAD_MESSAGES = 50000
 
+# How long after queuing the translation of a message for a user we
+# wait before queuing it again; see MessageDict.bulk_apply_translations.
+TRANSLATION_FILL_TIMEOUT = 300
+
 
 def truncate_content(content: str, max_length: int, truncation_message: str) -> str:
     if len(content) > max_length:
@@ -234,6 +249,7 @@ def messages_for_ids(
     apply_markdown: bool,
     client_gravatar: bool,
     allow_edit_history: bool,
+    user_profile: Optional[UserProfile] = None,
 ) -> List[Dict[str, Any]]:
     cache_transformer = MessageDict.build_dict_from_raw_db_row
     id_fetcher = lambda row: row["id"]
@@ -261,6 +277,9 @@ def messages_for_ids(
             del msg_dict["edit_history"]
         message_list.append(msg_dict)
 
+    if apply_markdown and user_profile is not None:
+        MessageDict.bulk_apply_translations(message_list, user_profile)
+
     MessageDict.post_process_dicts(message_list, apply_markdown, client_gravatar)
 
     return message_list
@@ -368,6 +387,75 @@ class MessageDict:
 
         return obj
 
+    @staticmethod
+    def bulk_apply_translations(objs: List[Dict[str, Any]], user_profile: UserProfile) -> None:
+        """
+        Replaces the rendered_content of each message with its
+        translation into the user's preferred language, fetching the
+        translations from MessageTranslation in a single query.
+
+        Messages that haven't been translated into that language yet
+        are sent as-is, and queued to be translated in the background;
+        the translation queue worker sends the user a `translation`
+        event for each of them, and later fetches will find the
+        translations in the database.  Messages already queued for the
+        user, within TRANSLATION_FILL_TIMEOUT, aren't queued again,
+        so that reloading a busy narrow doesn't flood the queue.
+        """
+        language = user_profile.preferred_language
+        if not settings.MESSAGE_TRANSLATION_ENABLED or language is None:
+            return
+
+        # Users read their own messages in the language they wrote them in.
+        objs = [
+            obj
+            for obj in objs
+            if obj["sender_id"] != user_profile.id and obj["rendered_content"] is not None
+        ]
+        if not objs:
+            return
+
+        translations = MessageTranslation.get_translations([obj["id"] for obj in objs], language)
+        missing_objs: List[Dict[str, Any]] = []
+        for obj in objs:
+            if obj["id"] in translations:
+                obj["rendered_content"] = translations[obj["id"]]
+            else:
+                missing_objs.append(obj)
+        if not missing_objs:
+            return
+
+        # Messages whose sender prefers the user's language are
+        # already written in it; see get_recipient_ids_by_language.
+        same_language_sender_ids = set(
+            UserProfile.objects.filter(
+                id__in={obj["sender_id"] for obj in missing_objs}, preferred_language=language
+            ).values_list("id", flat=True)
+        )
+        fill_keys = {
+            obj["id"]: translation_fill_cache_key(user_profile.id, obj["id"], language)
+            for obj in missing_objs
+            if obj["sender_id"] not in same_language_sender_ids
+        }
+        queued_keys = cache_get_many(list(fill_keys.values()))
+        missing_message_ids = [
+            message_id for message_id, key in fill_keys.items() if key not in queued_keys
+        ]
+        if not missing_message_ids:
+            return
+
+        cache_set_many(
+            {fill_keys[message_id]: True for message_id in missing_message_ids},
+            timeout=TRANSLATION_FILL_TIMEOUT,
+        )
+        event = {
+            "type": "fill",
+            "message_ids": missing_message_ids,
+            "language": language,
+            "user_id": user_profile.id,
+        }
+        queue_json_publish("translation", event)
+
     @staticmethod
     def post_process_dicts(
         objs: List[Dict[str, Any]], apply_markdown: bool, client_gravatar: bool
@@ -961,6 +1049,7 @@ def render_markdown(
     url_embed_data: Optional[Dict[str, Optional[UrlEmbedData]]] = None,
     mention_data: Optional[MentionData] = None,
     email_gateway: bool = False,
+    allow_degraded: bool = False,
 ) -> MessageRenderingResult:
     """
     This is basically just a wrapper for do_render_markdown.
@@ -983,6 +1072,7 @@ def render_markdown(
         url_embed_data=url_embed_data,
         mention_data=mention_data,
         email_gateway=email_gateway,
+        allow_degraded=allow_degraded,
     )
 
     return rendering_result
@@ -1699,3 +1789,113 @@ def update_to_dict_cache(
 
     cache_set_many(items_for_remote_cache)
     return message_ids
+
+
+@dataclass(frozen=True)
+class RenderingChange:
+    """A change to the realm's linkifiers or, if emoji_name is set, to
+    its custom emoji of that name, which affects how existing messages
+    render."""
+
+    emoji_name: Optional[str] = None
+
+    def strip_affected_markup(self, rendered_content: str) -> str:
+        """Replaces the markup in `rendered_content` which this change
+        can add or remove with its text: links which aren't mentions
+        or stream links, for linkifiers, or the emoji itself."""
+        fragment = lxml.html.fragment_fromstring(rendered_content, create_parent=True)
+        for element in list(fragment.iter("a", "img", "span")):
+            if self.emoji_name is None:
+                if element.tag == "a" and element.get("class") is None:
+                    element.drop_tag()
+            elif "emoji" in element.get("class", "").split():
+                text = element.get("alt") if element.tag == "img" else element.text_content()
+                if text == f":{self.emoji_name}:":
+                    element.text = text
+                    element.drop_tag()
+        return lxml.html.tostring(fragment, encoding="unicode")
+
+    def explains(self, old_rendered_content: str, new_rendered_content: str) -> bool:
+        return self.strip_affected_markup(old_rendered_content) == self.strip_affected_markup(
+            new_rendered_content
+        )
+
+
+def rerender_messages(
+    realm: Realm,
+    messages: List[Message],
+    render_pool: MarkdownRenderPool,
+    change: Optional[RenderingChange] = None,
+) -> List[Message]:
+    """Renders the content of existing `messages` again, with the
+    realm's current linkifiers, emoji, users, and so on, and saves
+    those whose rendered content changed, which are returned.
+
+    Rendering an old message again also picks up everything else that
+    has changed since it was sent: renamed or deactivated users and
+    streams it mentions, deleted emoji, and so on.  So if `change` is
+    passed, we only save new renderings which differ from the old one
+    just where that change could affect it, and otherwise leave the
+    message as it was.
+
+    The messages should have been fetched with their sender and
+    sending_client.
+    """
+    tasks = [
+        (
+            prepare_markdown_render(
+                message.content,
+                message=message,
+                message_realm=realm,
+                sent_by_bot=message.sender.is_bot,
+                translate_emoticons=message.sender.translate_emoticons,
+            ),
+            message,
+        )
+        for message in messages
+    ]
+    changed_messages = []
+    for message, rendered in zip(messages, render_pool.render(tasks)):
+        if rendered is None:
+            continue
+        rendered_content = rendered.rendering_result.rendered_content
+        if (
+            message.rendered_content == rendered_content
+            and message.rendered_content_version == markdown_version
+        ):
+            continue
+        if change is not None and (
+            message.rendered_content is None
+            or not change.explains(message.rendered_content, rendered_content)
+        ):
+            continue
+        message.rendered_content = rendered_content
+        message.rendered_content_version = markdown_version
+        changed_messages.append(message)
+
+    with transaction.atomic(savepoint=False):
+        # A message may have been edited while we were rendering it.
+        # Lock the messages (as editing them does), and skip any whose
+        # content has changed, rather than overwriting the rendering
+        # of the edit with one of the old content.
+        current_contents = dict(
+            Message.objects.select_for_update()
+            .filter(id__in=[message.id for message in changed_messages])
+            .order_by("id")
+            .values_list("id", "content")
+        )
+        changed_messages = [
+            message
+            for message in changed_messages
+            if current_contents.get(message.id) == message.content
+        ]
+        Message.objects.bulk_update(
+            changed_messages,
+            ["rendered_content", "rendered_content_version", "has_link", "has_image"],
+        )
+        # Stored translations are of the old rendered content.
+        MessageTranslation.objects.filter(
+            message_id__in=[message.id for message in changed_messages]
+        ).delete()
+    update_to_dict_cache(changed_messages, realm.id)
+    return changed_messages
@@ -1504,7 +1504,7 @@ Output:
     def simulated_markdown_failure(self) -> Iterator[None]:
         """
         This raises a failure inside of the try/except block of
-        markdown.__init__.do_convert.
+        markdown.__init__.render_markdown_task.
         """
         with mock.patch(
             "zerver.lib.markdown.timeout", side_effect=subprocess.CalledProcessError(1, [])
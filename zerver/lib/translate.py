@@ -1,43 +1,312 @@
-import re
+import abc
+import unicodedata
+from collections import OrderedDict
+from html import escape
+from typing import Any, Dict, List, Optional, Tuple, Type
+
+import lxml.html
+from django.conf import settings
 from translate import Translator
 
+from zerver.lib.cache import cache_get_many, cache_set_many, translation_cache_key
+from zerver.lib.outgoing_http import OutgoingSession
+
+# Translations of a given text don't change, so we can keep them in
+# the remote cache for a long time; the LRU bound on the local tier
+# is what keeps memory usage in check.
+TRANSLATION_CACHE_TIMEOUT = 3600 * 24 * 7
+
+
+class TranslationServiceError(Exception):
+    pass
+
+
+class TranslationBackend(metaclass=abc.ABCMeta):
+    """Interface for the services we can use to translate text.
+
+    Backends are given a batch of texts at a time, since the main cost
+    of translation is the round trip to the translation service; a
+    backend should translate as many texts per round trip as it can.
+    """
+
+    @abc.abstractmethod
+    def translate_batch(self, texts: List[str], target_language: str) -> List[str]:
+        """Returns the translations of `texts`, in the same order."""
+        raise NotImplementedError
+
+
+class LocalTranslationBackend(TranslationBackend):
+    """A deterministic, in-process stand-in for a translation service,
+    which returns texts unchanged.  Used in tests, and for servers
+    without access to a translation service."""
+
+    def translate_batch(self, texts: List[str], target_language: str) -> List[str]:
+        return list(texts)
+
+
+class TranslatePackageBackend(TranslationBackend):
+    """Uses the `translate` package, which supports only one text per
+    request to the translation service."""
+
+    def translate_batch(self, texts: List[str], target_language: str) -> List[str]:
+        translator = Translator(to_lang=target_language)
+        return [translator.translate(text) for text in texts]
+
+
+class HTTPTranslationBackend(TranslationBackend):
+    """Talks to a LibreTranslate-compatible translation service at
+    TRANSLATION_SERVICE_URL, sending up to TRANSLATION_BATCH_SIZE texts
+    per request over a single pooled session."""
+
+    def __init__(self) -> None:
+        assert settings.TRANSLATION_SERVICE_URL is not None
+        self.url = settings.TRANSLATION_SERVICE_URL
+        self.session = OutgoingSession(
+            role="translation",
+            timeout=settings.TRANSLATION_SERVICE_TIMEOUT_SECONDS,
+            max_retries=2,
+        )
+
+    def translate_batch(self, texts: List[str], target_language: str) -> List[str]:
+        translated: List[str] = []
+        batch_size = settings.TRANSLATION_BATCH_SIZE
+        for i in range(0, len(texts), batch_size):
+            batch = texts[i : i + batch_size]
+            request_data: Dict[str, Any] = {
+                "q": batch,
+                "source": "auto",
+                "target": target_language,
+                "format": "text",
+            }
+            if settings.TRANSLATION_SERVICE_API_KEY is not None:
+                request_data["api_key"] = settings.TRANSLATION_SERVICE_API_KEY
+            response = self.session.post(self.url, json=request_data)
+            response.raise_for_status()
+
+            result = response.json().get("translatedText")
+            if not isinstance(result, list) or len(result) != len(batch):
+                raise TranslationServiceError(
+                    f"Expected {len(batch)} translations from {self.url}, got: {result!r}"
+                )
+            translated.extend(result)
+        return translated
+
+
+TRANSLATION_BACKENDS: Dict[str, Type[TranslationBackend]] = {
+    "http": HTTPTranslationBackend,
+    "local": LocalTranslationBackend,
+    "translate": TranslatePackageBackend,
+}
+
+translation_backends: Dict[str, TranslationBackend] = {}
+
+
+def get_translation_backend() -> TranslationBackend:
+    # Backends are created lazily, and kept around so that e.g. the
+    # HTTP backend's connection pool is reused across translations.
+    backend_name = settings.TRANSLATION_BACKEND
+    if backend_name not in translation_backends:
+        translation_backends[backend_name] = TRANSLATION_BACKENDS[backend_name]()
+    return translation_backends[backend_name]
+
+
+class TranslationCache:
+    """A bounded, in-process LRU cache of translations, keyed on
+    (text, target_language).
+
+    This sits in front of the remote cache, so that repeated
+    translations of the same text (e.g. the same message fanned out to
+    many recipients with the same preferred language, or a bot sending
+    the same notification over and over) don't even need a memcached
+    round trip.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.entries: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.remote_hits = 0
+        self.remote_misses = 0
+
+    def get(self, key: Tuple[str, str]) -> Optional[str]:
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Tuple[str, str], value: str) -> None:
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+        self.remote_hits = 0
+        self.remote_misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        return dict(
+            size=len(self.entries),
+            maxsize=self.maxsize,
+            hits=self.hits,
+            misses=self.misses,
+            remote_hits=self.remote_hits,
+            remote_misses=self.remote_misses,
+        )
+
+
+translation_cache = TranslationCache(settings.TRANSLATION_CACHE_SIZE)
+
+
+def get_translation_cache_stats() -> Dict[str, int]:
+    return translation_cache.stats()
+
+
+def normalize_text_for_translation(text: str) -> str:
+    # Texts that differ only in Unicode normalization form or
+    # surrounding whitespace translate identically, so we translate
+    # (and cache) the normalized form.
+    return unicodedata.normalize("NFC", text).strip()
+
+
+def translate_texts(texts: List[str], target_language: str) -> List[str]:
+    """Translates `texts` into `target_language`, consulting the
+    in-process LRU cache and then the remote cache; whatever is left
+    is sent to the translation backend as a single batch."""
+    normalized_texts = [normalize_text_for_translation(text) for text in texts]
+
+    translations: Dict[str, str] = {"": ""}
+    for text in normalized_texts:
+        if text in translations:
+            continue
+        translated = translation_cache.get((text, target_language))
+        if translated is not None:
+            translations[text] = translated
+
+    remote_keys = {
+        translation_cache_key(text, target_language): text
+        for text in normalized_texts
+        if text not in translations
+    }
+    if remote_keys:
+        remote_translations = cache_get_many(list(remote_keys))
+        translation_cache.remote_hits += len(remote_translations)
+        for key, translated in remote_translations.items():
+            translations[remote_keys[key]] = translated
+            translation_cache.set((remote_keys[key], target_language), translated)
+
+    missing_texts = [text for text in remote_keys.values() if text not in translations]
+    if missing_texts:
+        translation_cache.remote_misses += len(missing_texts)
+        translated_texts = get_translation_backend().translate_batch(missing_texts, target_language)
+        for text, translated in zip(missing_texts, translated_texts):
+            translations[text] = translated
+            translation_cache.set((text, target_language), translated)
+        cache_set_many(
+            {
+                translation_cache_key(text, target_language): translations[text]
+                for text in missing_texts
+            },
+            timeout=TRANSLATION_CACHE_TIMEOUT,
+        )
+
+    return [translations[text] for text in normalized_texts]
+
+
+# Elements whose contents we never send to the translation service:
+# code, links, mentions, emoji, math, and timestamps are either not
+# prose or need to be preserved exactly.
+UNTRANSLATED_TAGS = {"a", "code", "pre", "time"}
+UNTRANSLATED_CLASSES = {
+    "emoji",
+    "katex",
+    "katex-display",
+    "stream",
+    "stream-topic",
+    "topic-mention",
+    "user-group-mention",
+    "user-mention",
+}
 
-def extract_emojis(text):
-    emoji_pattern = r'[^\u0000-\u007F]+'
-    return ''.join(c for c in text if re.match(emoji_pattern, c))
 
+def is_untranslated_element(elem: lxml.html.HtmlElement) -> bool:
+    if not isinstance(elem.tag, str):
+        # Comments and processing instructions.
+        return True
+    if elem.tag in UNTRANSLATED_TAGS:
+        return True
+    classes = elem.get("class")
+    return classes is not None and not UNTRANSLATED_CLASSES.isdisjoint(classes.split())
 
-def remove_links(message):
-    link_pattern = r'http[s]?://\S+'
-    return re.sub(link_pattern, '', message)
 
+def translate_rendered_contents(rendered_contents: List[str], target_language: str) -> List[str]:
+    """Translates the prose in several messages' rendered HTML,
+    preserving its structure.
 
-def translate_message(message, target_language):
-    # Extract emojis from the message
-    emojis = extract_emojis(message)
+    We walk each HTML tree once, collecting the text nodes outside of
+    untranslated elements (see is_untranslated_element), send the text
+    nodes of all of the messages to the translation backend as a
+    single batch, and splice the results back into the trees.
+    """
+    fragments = [
+        lxml.html.fragment_fromstring(rendered_content, create_parent=True)
+        for rendered_content in rendered_contents
+    ]
 
-    # Remove links from the message and replace them with placeholders
-    message_without_links = remove_links(message)
-    links = re.findall(r'http[s]?://\S+', message)
-    for link in links:
-        message_without_links = message_without_links.replace(link, f'<link_placeholder_{links.index(link)}>')
+    # Each text node is identified by its element, and whether it's
+    # the element's text or its tail.
+    text_nodes: List[Tuple[lxml.html.HtmlElement, str]] = []
 
-    # Remove <p> tags from the message and replace them with placeholders
-    message_without_p_tags = message_without_links.replace('<p>', '').replace('</p>', '<p_placeholder>')
+    def collect_text_nodes(elem: lxml.html.HtmlElement) -> None:
+        if elem.text and not elem.text.isspace():
+            text_nodes.append((elem, "text"))
+        for child in elem:
+            if not is_untranslated_element(child):
+                collect_text_nodes(child)
+            # An element's tail is part of its parent's content.
+            if child.tail and not child.tail.isspace():
+                text_nodes.append((child, "tail"))
 
-    # Translate the message without <p> tags using the translate module
-    translator = Translator(to_lang=target_language)
-    translated_message_without_p_tags = translator.translate(message_without_p_tags)
+    # Messages with nothing to translate are returned as they are.
+    has_text: List[bool] = []
+    for fragment in fragments:
+        num_text_nodes = len(text_nodes)
+        collect_text_nodes(fragment)
+        has_text.append(len(text_nodes) > num_text_nodes)
+    if not text_nodes:
+        return list(rendered_contents)
 
-    # Restore the <p> tags in the translated message
-    translated_message = translated_message_without_p_tags.replace('<p_placeholder>', '<p>')
+    # Translation backends don't preserve leading and trailing
+    # whitespace, which is significant next to inline elements.
+    texts = [getattr(elem, attr) for elem, attr in text_nodes]
+    translated_texts = translate_texts(texts, target_language)
+    for (elem, attr), text, translated in zip(text_nodes, texts, translated_texts):
+        leading = text[: len(text) - len(text.lstrip())]
+        trailing = text[len(text.rstrip()) :]
+        setattr(elem, attr, leading + translated + trailing)
 
-    # Reinsert emojis back into the translated message
-    for i, emoji_char in enumerate(emojis):
-        translated_message = translated_message.replace(f'<emoji_placeholder_{i}>', emoji_char)
+    # Because we were parsed with fragment_fromstring, we are
+    # guaranteed there is a top-level <div>; return its contents.
+    return [
+        escape(fragment.text or "", quote=False)
+        + "".join(lxml.html.tostring(child, encoding="unicode") for child in fragment)
+        if fragment_has_text
+        else rendered_content
+        for fragment, fragment_has_text, rendered_content in zip(
+            fragments, has_text, rendered_contents
+        )
+    ]
 
-    # Replace the placeholders with the original links
-    for i, link in enumerate(links):
-        translated_message = translated_message.replace(f'<link_placeholder_{i}>', link)
 
-    return translated_message
+def translate_rendered_content(rendered_content: str, target_language: str) -> str:
+    """Translates the prose in a message's rendered HTML; see
+    translate_rendered_contents."""
+    return translate_rendered_contents([rendered_content], target_language)[0]
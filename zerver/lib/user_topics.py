@@ -8,6 +8,7 @@ from django.utils.timezone import now as timezone_now
 from sqlalchemy.sql import ClauseElement, and_, column, not_, or_
 from sqlalchemy.types import Integer
 
+from zerver.lib.cache import flush_realm_delivery_snapshots, flush_stream_delivery_snapshots
 from zerver.lib.timestamp import datetime_to_timestamp
 from zerver.lib.topic import topic_match_sa
 from zerver.lib.types import UserTopicDict
@@ -90,6 +91,7 @@ def set_topic_visibility_policy(
         user_profile=user_profile,
         visibility_policy=visibility_policy,
     ).delete()
+    flush_realm_delivery_snapshots(user_profile.realm_id)
 
     if last_updated is None:
         last_updated = timezone_now()
@@ -138,11 +140,13 @@ def bulk_set_user_topic_visibility_policy_in_database(
                 "User %s tried to remove visibility_policy, which actually doesn't exist",
                 user_profile.id,
             )
+        flush_stream_delivery_snapshots({row.recipient_id for row in rows})
         rows.delete()
         return user_profiles_with_visibility_policy
 
     assert last_updated is not None
     assert recipient_id is not None
+    flush_stream_delivery_snapshots([recipient_id])
 
     user_profiles_seeking_visibility_policy_update: List[UserProfile] = []
     for row in rows:
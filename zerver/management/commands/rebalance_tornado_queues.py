@@ -0,0 +1,24 @@
+from typing import Any
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from zerver.tornado.event_queue import rebalance_event_queues
+
+
+class Command(BaseCommand):
+    help = """Moves the event queues saved by the Tornado processes to the Tornado
+ports that their users are sharded to, after a change to the sharding
+configuration, so that clients don't need to re-register.
+
+All Tornado processes must be stopped while this runs."""
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        if settings.TORNADO_PROCESSES == 1:
+            print("There is only one Tornado process; nothing to rebalance.")
+            return
+
+        moved = rebalance_event_queues(settings.TORNADO_PORTS)
+        for port, count in sorted(moved.items()):
+            print(f"Moved {count} event queues to port {port}")
+        print("Done")
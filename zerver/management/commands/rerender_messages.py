@@ -0,0 +1,70 @@
+from argparse import ArgumentParser
+from typing import Any
+
+from django.conf import settings
+from django.core.management.base import CommandError
+from django.db.models import Q
+
+from zerver.actions.message_rerender import do_rerender_messages
+from zerver.lib.management import ZulipBaseCommand
+from zerver.lib.markdown import version as markdown_version
+from zerver.lib.markdown.render_pool import MarkdownRenderPool
+from zerver.models import Message
+
+
+class Command(ZulipBaseCommand):
+    help = """Render the Markdown of a realm's existing messages again.
+
+By default, only messages rendered by an older version of the Markdown
+processor are re-rendered; use --all after changing something that
+affects how existing messages render.  (Changes to linkifiers and
+custom emoji already queue re-rendering the messages they affect.)"""
+
+    def add_arguments(self, parser: ArgumentParser) -> None:
+        self.add_realm_args(parser, required=True)
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Re-render all of the realm's messages, not just outdated ones",
+        )
+        parser.add_argument(
+            "--batch-size",
+            default=1000,
+            type=int,
+            help="Number of messages to fetch and save at once",
+        )
+        parser.add_argument(
+            "--processes",
+            default=settings.DEFAULT_DATA_EXPORT_IMPORT_PARALLELISM,
+            type=int,
+            help="Processes to use for rendering in parallel",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = self.get_realm(options)
+        assert realm is not None  # Should be ensured by parser
+        if options["processes"] < 1:
+            raise CommandError("You must have at least one process.")
+
+        query = Message.objects.filter(realm_id=realm.id)
+        if not options["all"]:
+            query = query.filter(
+                Q(rendered_content_version__lt=markdown_version) | Q(rendered_content_version=None)
+            )
+        query = query.select_related("sender", "sending_client").order_by("id")
+
+        rendered_count = 0
+        changed_count = 0
+        last_id = 0
+        with MarkdownRenderPool(options["processes"]) as render_pool:
+            while True:
+                messages = list(query.filter(id__gt=last_id)[: options["batch_size"]])
+                if not messages:
+                    break
+                changed_messages = do_rerender_messages(realm, messages, render_pool)
+                rendered_count += len(messages)
+                changed_count += len(changed_messages)
+                last_id = messages[-1].id
+                print(f"Re-rendered {rendered_count} messages, through ID {last_id}")
+
+        print(f"Done; {changed_count} of {rendered_count} messages changed.")
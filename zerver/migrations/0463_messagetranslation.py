@@ -0,0 +1,33 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("zerver", "0462_realm_preferred_language_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MessageTranslation",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+                    ),
+                ),
+                ("language", models.CharField(max_length=50)),
+                ("rendered_content", models.TextField()),
+                (
+                    "message",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="zerver.message"
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("message", "language")},
+            },
+        ),
+    ]
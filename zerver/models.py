@@ -69,8 +69,11 @@ from zerver.lib.cache import (
     flush_message,
     flush_muting_users_cache,
     flush_realm,
+    flush_realm_delivery_snapshots,
+    flush_realm_rendering_version,
     flush_stream,
     flush_submessage,
+    flush_subscription,
     flush_used_upload_space_cache,
     flush_user_profile,
     get_realm_used_upload_space_cache_key,
@@ -1219,6 +1222,7 @@ def flush_realm_emoji(*, instance: RealmEmoji, **kwargs: object) -> None:
         get_all_custom_emoji_for_realm_uncached(realm_id),
         timeout=3600 * 24 * 7,
     )
+    flush_realm_rendering_version(realm_id)
 
 
 post_save.connect(flush_realm_emoji, sender=RealmEmoji)
@@ -1347,6 +1351,7 @@ def flush_linkifiers(*, instance: RealmFilter, **kwargs: object) -> None:
     cache_delete(get_linkifiers_cache_key(realm_id))
     with suppress(KeyError):
         per_request_linkifiers_cache.pop(realm_id)
+    flush_realm_rendering_version(realm_id)
 
 
 post_save.connect(flush_linkifiers, sender=RealmFilter)
@@ -2951,7 +2956,6 @@ class AbstractMessage(models.Model):
     content = models.TextField()
 
     rendered_content = models.TextField(null=True)
-    # translated_content = models.TextField(null=True)
     rendered_content_version = models.IntegerField(null=True)
 
     date_sent = models.DateTimeField("date sent", db_index=True)
@@ -3046,9 +3050,6 @@ class Message(AbstractMessage):
     def save_rendered_content(self) -> None:
         self.save(update_fields=["rendered_content", "rendered_content_version"])
 
-    # def save_translated_content(self) -> None:
-    #     self.save(update_fields=["translated_content"])
-
     @staticmethod
     def need_to_render_content(
         rendered_content: Optional[str],
@@ -3130,6 +3131,32 @@ def get_context_for_message(message: Message) -> QuerySet[Message]:
 post_save.connect(flush_message, sender=Message)
 
 
+class MessageTranslation(models.Model):
+    """A translation of a message's rendered_content into a language
+    that some of its recipients prefer (UserProfile.preferred_language).
+
+    Rows are computed by the translation queue worker, either when the
+    message is sent or lazily, the first time a user who prefers
+    `language` fetches the message.  They're a cache: deleting them is
+    always safe, and they're deleted whenever the message's
+    rendered_content changes.
+    """
+
+    message = models.ForeignKey(Message, on_delete=CASCADE)
+    language = models.CharField(max_length=MAX_LANGUAGE_ID_LENGTH)
+    rendered_content = models.TextField()
+
+    class Meta:
+        unique_together = ("message", "language")
+
+    @staticmethod
+    def get_translations(needed_ids: List[int], language: str) -> Dict[int, str]:
+        query = MessageTranslation.objects.filter(
+            message_id__in=needed_ids, language=language
+        ).values_list("message_id", "rendered_content")
+        return dict(query)
+
+
 class AbstractSubMessage(models.Model):
     # We can send little text messages that are associated with a regular
     # Zulip message.  These can be used for experimental widgets like embedded
@@ -3820,6 +3847,10 @@ class Subscription(models.Model):
     ]
 
 
+post_save.connect(flush_subscription, sender=Subscription)
+post_delete.connect(flush_subscription, sender=Subscription)
+
+
 @cache_with_key(user_profile_by_id_cache_key, timeout=3600 * 24 * 7)
 def get_user_profile_by_id(user_profile_id: int) -> UserProfile:
     return UserProfile.objects.select_related("realm", "bot_owner").get(id=user_profile_id)
@@ -4357,7 +4388,6 @@ class ScheduledMessage(models.Model):
     subject = models.CharField(max_length=MAX_TOPIC_NAME_LENGTH)
     content = models.TextField()
     rendered_content = models.TextField()
-    # translated_content = models.TextField(null=True)
     sending_client = models.ForeignKey(Client, on_delete=CASCADE)
     stream = models.ForeignKey(Stream, null=True, on_delete=CASCADE)
     realm = models.ForeignKey(Realm, on_delete=CASCADE)
@@ -4981,6 +5011,7 @@ class AlertWord(models.Model):
 def flush_realm_alert_words(realm_id: int) -> None:
     cache_delete(realm_alert_words_cache_key(realm_id))
     cache_delete(realm_alert_words_automaton_cache_key(realm_id))
+    flush_realm_delivery_snapshots(realm_id)
 
 
 def flush_alert_word(*, instance: AlertWord, **kwargs: object) -> None:
@@ -1,5 +1,7 @@
+import os
+import tempfile
 import time
-from typing import Any, Callable, Collection, Dict, List
+from typing import Any, Callable, Collection, Dict, List, Set
 from unittest import mock
 
 import orjson
@@ -12,18 +14,31 @@ from zerver.actions.user_groups import check_add_user_group
 from zerver.actions.user_settings import do_change_user_setting
 from zerver.actions.user_topics import do_set_user_topic_visibility_policy
 from zerver.lib.cache import cache_delete, get_muting_users_cache_key
+from zerver.lib.notification_data import UserMessageNotificationsData
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import HostRequestMock, dummy_handler, mock_queue_publish
 from zerver.models import Recipient, Subscription, UserProfile, UserTopic, get_stream
+from zerver.tornado import event_queue
 from zerver.tornado.event_queue import (
     ClientDescriptor,
+    EventQueue,
     access_client_descriptor,
     allocate_client_descriptor,
+    clear_client_event_queues_for_testing,
+    dump_event_queues,
+    gc_event_queues,
+    get_client_descriptors_for_user,
+    get_wrapped_process_notification,
+    load_event_queues,
     maybe_enqueue_notifications,
     missedmessage_hook,
     persistent_queue_filename,
+    process_message_events,
     process_notification,
+    rebalance_event_queues,
 )
+from zerver.tornado.sharding import HashRing, get_user_id_tornado_port
+from zerver.tornado.stats import notification_batch_stats
 from zerver.tornado.views import cleanup_event_queue, get_events
 
 
@@ -1188,6 +1203,213 @@ class FileReloadLogicTest(ZulipTestCase):
                 "/home/zulip/tornado/event_queues.9800.last.json",
             )
 
+    def allocate_client_descriptors(self) -> List[ClientDescriptor]:
+        descriptors = []
+        for user_profile in [self.example_user("hamlet"), self.example_user("cordelia")]:
+            queue_data = dict(
+                all_public_streams=False,
+                apply_markdown=True,
+                client_gravatar=True,
+                client_type_name="website",
+                event_types=None,
+                last_connection_time=time.time(),
+                queue_timeout=600,
+                realm_id=user_profile.realm_id,
+                user_profile_id=user_profile.id,
+            )
+            descriptors.append(allocate_client_descriptor(queue_data))
+        return descriptors
+
+    def test_gc_event_queues(self) -> None:
+        hamlet = self.example_user("hamlet")
+        now = time.time()
+        with mock.patch("time.time", return_value=now):
+            hamlet_client, cordelia_client = self.allocate_client_descriptors()
+        cordelia_client.queue_timeout = 1200
+        self.assertEqual(get_client_descriptors_for_user(hamlet.id), {hamlet_client})
+
+        # Nothing is due yet, so the pass doesn't look at any queues.
+        with mock.patch("time.time", return_value=now + 599), mock.patch.object(
+            ClientDescriptor, "expired"
+        ) as mock_expired:
+            gc_event_queues(9800)
+        mock_expired.assert_not_called()
+        self.assertEqual(
+            set(event_queue.clients), {hamlet_client.event_queue.id, cordelia_client.event_queue.id}
+        )
+
+        # Hamlet's queue has expired; Cordelia's had its timeout
+        # extended after it was scheduled, and is rescheduled.
+        with mock.patch("time.time", return_value=now + 600):
+            gc_event_queues(9800)
+        self.assertEqual(list(event_queue.clients), [cordelia_client.event_queue.id])
+        self.assertEqual(get_client_descriptors_for_user(hamlet.id), set())
+        self.assertNotIn(hamlet.id, event_queue.user_clients)
+        self.assertEqual(event_queue.gc_heap, [(now + 1200, cordelia_client.event_queue.id)])
+
+        # A queue with a connected handler doesn't expire, and is
+        # checked again at the next pass.
+        cordelia_client.current_handler_id = 1
+        with mock.patch("time.time", return_value=now + 1200):
+            gc_event_queues(9800)
+        self.assertEqual(list(event_queue.clients), [cordelia_client.event_queue.id])
+        self.assertEqual(event_queue.gc_heap, [(now + 1200 + 60, cordelia_client.event_queue.id)])
+
+        cordelia_client.current_handler_id = None
+        with mock.patch("time.time", return_value=now + 1200 + 60):
+            gc_event_queues(9800)
+        self.assertEqual(event_queue.clients, {})
+        self.assertEqual(event_queue.user_clients, {})
+        self.assertEqual(event_queue.gc_heap, [])
+
+    def test_dump_and_load_event_queues(self) -> None:
+        hamlet_client, cordelia_client = self.allocate_client_descriptors()
+        message_event = dict(type="message", message=dict(id=1, content="a" * 1000), flags=[])
+        for client in [hamlet_client, cordelia_client]:
+            client.add_event(dict(type="typing", op="start"))
+            client.add_event(message_event)
+        cordelia_client.add_event(
+            dict(type="update_message_flags", operation="add", flag="read", messages=[1], all=False)
+        )
+        expected = {
+            client.event_queue.id: client.to_dict() for client in [hamlet_client, cordelia_client]
+        }
+
+        with tempfile.TemporaryDirectory() as tmpdir, self.settings(
+            JSON_PERSISTENT_QUEUE_FILENAME_PATTERN=os.path.join(tmpdir, "event_queues%s.json")
+        ):
+            dump_event_queues(9800)
+            # The message is only written out once.
+            with open(persistent_queue_filename(9800), "rb") as f:
+                self.assertEqual(f.read().count(b"a" * 1000), 1)
+
+            clear_client_event_queues_for_testing()
+            load_event_queues(9800)
+
+        loaded_clients = event_queue.clients
+        self.assertEqual(
+            {queue_id: client.to_dict() for queue_id, client in loaded_clients.items()}, expected
+        )
+        self.assert_length(get_client_descriptors_for_user(self.example_user("hamlet").id), 1)
+
+        # The events in each queue share the message's contents.
+        hamlet_events = loaded_clients[hamlet_client.event_queue.id].event_queue.contents(True)
+        cordelia_events = loaded_clients[cordelia_client.event_queue.id].event_queue.contents(True)
+        self.assertIs(hamlet_events[1]["message"], cordelia_events[1]["message"])
+
+    def test_dump_event_queues_memory_stats(self) -> None:
+        self.allocate_client_descriptors()
+        with tempfile.TemporaryDirectory() as tmpdir, self.settings(
+            JSON_PERSISTENT_QUEUE_FILENAME_PATTERN=os.path.join(tmpdir, "event_queues%s.json")
+        ):
+            # Walking every event is slow, so it's opt-in.
+            with mock.patch(
+                "zerver.tornado.event_queue.get_event_queue_memory_stats"
+            ) as stats_mock, self.assertLogs(level="INFO"):
+                dump_event_queues(9800)
+            stats_mock.assert_not_called()
+
+            with self.settings(EVENT_QUEUE_LOG_MEMORY_STATS=True), self.assertLogs(
+                level="INFO"
+            ) as logs:
+                dump_event_queues(9800)
+            self.assertIn("Tornado 9800 event queue memory usage", logs.output[0])
+
+    def test_load_legacy_event_queues(self) -> None:
+        hamlet_client, cordelia_client = self.allocate_client_descriptors()
+        hamlet_client.add_event(dict(type="typing", op="start"))
+        dumped = [
+            (client.event_queue.id, client.to_dict()) for client in [hamlet_client, cordelia_client]
+        ]
+        clear_client_event_queues_for_testing()
+
+        with tempfile.TemporaryDirectory() as tmpdir, self.settings(
+            JSON_PERSISTENT_QUEUE_FILENAME_PATTERN=os.path.join(tmpdir, "event_queues%s.json")
+        ):
+            with open(persistent_queue_filename(9800), "wb") as f:
+                f.write(orjson.dumps(dumped))
+            load_event_queues(9800)
+
+        self.assertEqual(
+            {queue_id: client.to_dict() for queue_id, client in event_queue.clients.items()},
+            dict(dumped),
+        )
+
+    def test_load_corrupt_event_queues(self) -> None:
+        self.allocate_client_descriptors()
+        with tempfile.TemporaryDirectory() as tmpdir, self.settings(
+            JSON_PERSISTENT_QUEUE_FILENAME_PATTERN=os.path.join(tmpdir, "event_queues%s.json")
+        ):
+            dump_event_queues(9800)
+            with open(persistent_queue_filename(9800), "r+b") as f:
+                f.truncate(os.path.getsize(persistent_queue_filename(9800)) - 10)
+
+            clear_client_event_queues_for_testing()
+            with self.assertLogs(level="ERROR") as logs:
+                load_event_queues(9800)
+        self.assertIn("Tornado 9800 could not deserialize event queues", logs.output[0])
+        self.assertEqual(event_queue.clients, {})
+
+    def test_rebalance_event_queues(self) -> None:
+        hamlet_client, cordelia_client = self.allocate_client_descriptors()
+        expected = {
+            client.event_queue.id: client.to_dict() for client in [hamlet_client, cordelia_client]
+        }
+        ports = [9800, 9801]
+
+        with tempfile.TemporaryDirectory() as tmpdir, self.settings(
+            JSON_PERSISTENT_QUEUE_FILENAME_PATTERN=os.path.join(tmpdir, "event_queues%s.json"),
+            TORNADO_PROCESSES=2,
+        ):
+            # All of the queues start out on one port.
+            dump_event_queues(9800)
+            with mock.patch(
+                "zerver.tornado.event_queue.get_realm_tornado_ports", return_value=ports
+            ):
+                moved = rebalance_event_queues(ports)
+
+            loaded: Dict[int, Dict[str, Dict[str, Any]]] = {}
+            for port in ports:
+                clear_client_event_queues_for_testing()
+                load_event_queues(port)
+                loaded[port] = {
+                    queue_id: client.to_dict() for queue_id, client in event_queue.clients.items()
+                }
+
+        # Each queue was moved, intact, to its user's port.
+        for queue_id, client_dict in expected.items():
+            port = get_user_id_tornado_port(ports, client_dict["user_profile_id"])
+            self.assertEqual(loaded[port][queue_id], client_dict)
+        self.assertEqual(sum(len(clients) for clients in loaded.values()), 2)
+        self.assertEqual(moved.get(9801, 0), len(loaded[9801]))
+
+
+class HashRingTest(ZulipTestCase):
+    def test_hash_ring(self) -> None:
+        user_ids = range(1, 10001)
+        ring = HashRing([9800, 9801, 9802])
+        ports = {user_id: ring.get_port(user_id) for user_id in user_ids}
+
+        # Users are spread roughly evenly, and the order of the ports
+        # doesn't matter.
+        for port in [9800, 9801, 9802]:
+            self.assertGreater(list(ports.values()).count(port), 2500)
+        reordered_ring = HashRing([9802, 9800, 9801])
+        self.assertTrue(
+            all(reordered_ring.get_port(user_id) == ports[user_id] for user_id in user_ids)
+        )
+
+        # Adding a port only moves users to that new port, and only
+        # about a quarter of them.
+        bigger_ring = HashRing([9800, 9801, 9802, 9803])
+        moved = [user_id for user_id in user_ids if bigger_ring.get_port(user_id) != ports[user_id]]
+        self.assertTrue(all(bigger_ring.get_port(user_id) == 9803 for user_id in moved))
+        self.assertGreater(len(moved), 1500)
+        self.assertLess(len(moved), 3500)
+
+        self.assertEqual(get_user_id_tornado_port([9800], 12), 9800)
+        self.assertEqual(get_user_id_tornado_port([9800, 9801, 9802], 12), ports[12])
+
 
 class PruneInternalDataTest(ZulipTestCase):
     def test_prune_internal_data(self) -> None:
@@ -1275,6 +1497,26 @@ class EventQueueTest(ZulipTestCase):
         self.assertEqual(queue.contents(), [out_dict])
         self.verify_to_dict_end_to_end(client)
 
+    def test_shared_events(self) -> None:
+        queues = [self.get_client_descriptor().event_queue for i in range(2)]
+        queues[1].push(dict(type="arbitrary", x="first"))
+        event = dict(type="arbitrary", x="a" * 1000)
+        for queue in queues:
+            queue.push(event)
+
+        # Each queue references the same event, with its own id.
+        self.assertIs(queues[0].queue[0][1], event)
+        self.assertIs(queues[1].queue[1][1], event)
+        self.assertEqual(queues[0].contents(), [dict(id=0, type="arbitrary", x="a" * 1000)])
+        self.assertEqual(queues[1].contents()[1], dict(id=1, type="arbitrary", x="a" * 1000))
+        self.assertNotIn("id", event)
+
+        # Memory accounting charges the shared event to one queue.
+        self.assertGreater(queues[0].memory_usage(), 1000)
+        seen: Set[int] = set()
+        self.assertGreater(queues[0].memory_usage(seen), 1000)
+        self.assertLess(queues[1].memory_usage(seen), 1000)
+
     def test_event_collapsing(self) -> None:
         client = self.get_client_descriptor()
         queue = client.event_queue
@@ -1445,6 +1687,109 @@ class EventQueueTest(ZulipTestCase):
         )
         self.verify_to_dict_end_to_end(client)
 
+    def test_flag_read_unread_collapsing(self) -> None:
+        client = self.get_client_descriptor()
+        queue = client.event_queue
+
+        def read_event(operation: str, messages: List[int], timestamp: str) -> Dict[str, Any]:
+            event: Dict[str, Any] = {
+                "type": "update_message_flags",
+                "flag": "read",
+                "operation": operation,
+                "all": False,
+                "messages": messages,
+                "timestamp": timestamp,
+            }
+            if operation == "remove":
+                event["message_details"] = {
+                    str(message_id): {"type": "stream", "stream_id": 1, "topic": "test"}
+                    for message_id in messages
+                }
+            return event
+
+        queue.push(read_event("add", [1, 2, 3], "1"))
+        queue.push(read_event("remove", [2, 4], "2"))
+        queue.push({"type": "unknown"})
+        queue.push(read_event("add", [4, 5], "3"))
+        queue.push(read_event("remove", [6], "4"))
+        self.verify_to_dict_end_to_end(client)
+
+        # Each message ends up with the latest operation on it, and
+        # the message_details of messages which are still unread.
+        details = {"type": "stream", "stream_id": 1, "topic": "test"}
+        self.assertEqual(
+            queue.contents(),
+            [
+                {"id": 2, "type": "unknown"},
+                {
+                    "id": 3,
+                    "type": "update_message_flags",
+                    "flag": "read",
+                    "operation": "add",
+                    "all": False,
+                    "messages": [1, 3, 4, 5],
+                    "timestamp": "3",
+                },
+                {
+                    "id": 4,
+                    "type": "update_message_flags",
+                    "flag": "read",
+                    "operation": "remove",
+                    "all": False,
+                    "messages": [2, 6],
+                    "message_details": {"2": details, "6": details},
+                    "timestamp": "4",
+                },
+            ],
+        )
+
+        # A message that was marked as read and then unread again
+        # doesn't appear in an add event at all.
+        queue.push(read_event("add", [7], "5"))
+        queue.push(read_event("remove", [7], "6"))
+        self.assertEqual(
+            queue.contents()[-1],
+            {
+                "id": 6,
+                "type": "update_message_flags",
+                "flag": "read",
+                "operation": "remove",
+                "all": False,
+                "messages": [7],
+                "message_details": {"7": details},
+                "timestamp": "6",
+            },
+        )
+
+    def test_flag_collapsing_around_all_messages_event(self) -> None:
+        client = self.get_client_descriptor()
+        queue = client.event_queue
+
+        def starred_event(operation: str, messages: List[int], all: bool = False) -> Dict[str, Any]:
+            return {
+                "type": "update_message_flags",
+                "flag": "starred",
+                "operation": operation,
+                "all": all,
+                "messages": messages,
+            }
+
+        queue.push(starred_event("add", [1]))
+        queue.push(starred_event("remove", [], all=True))
+        queue.push(starred_event("add", [2]))
+        self.verify_to_dict_end_to_end(client)
+
+        # Message 1 must be starred before the event for all messages,
+        # not folded into the event after it.
+        self.assertEqual(
+            queue.contents(),
+            [
+                {**starred_event("add", [1]), "id": 0},
+                {**starred_event("remove", [], all=True), "id": 1},
+                {**starred_event("add", [2]), "id": 2},
+            ],
+        )
+
     def test_collapse_event(self) -> None:
         """
         This mostly focuses on the internals of
@@ -1465,7 +1810,7 @@ class EventQueueTest(ZulipTestCase):
         self.verify_to_dict_end_to_end(client)
 
         queue.push({"type": "unknown", "timestamp": "1"})
-        self.assertEqual(list(queue.queue), [{"id": 1, "type": "unknown", "timestamp": "1"}])
+        self.assertEqual(list(queue.queue), [(1, {"type": "unknown", "timestamp": "1"})])
         self.assertEqual(
             queue.virtual_events,
             {"restart": {"id": 0, "type": "restart", "server_generation": 1, "timestamp": "1"}},
@@ -1489,6 +1834,80 @@ class EventQueueTest(ZulipTestCase):
         queue.prune(1)
         self.verify_to_dict_end_to_end(client)
 
+    def test_spill_to_disk(self) -> None:
+        client = self.get_client_descriptor()
+        queue = client.event_queue
+        events = [{"type": "unknown", "timestamp": str(i), "data": "x" * 100} for i in range(10)]
+        event_size = len(orjson.dumps(events[0]))
+
+        with tempfile.TemporaryDirectory() as spill_dir, self.settings(
+            EVENT_QUEUE_SPILL_DIR=spill_dir, EVENT_QUEUE_MEMORY_BUDGET_BYTES=4 * event_size
+        ):
+            for event in events[:4]:
+                queue.push(event)
+            self.assertIsNone(queue.spilled)
+            self.assertEqual(queue.memory_bytes, 4 * event_size)
+
+            # Going over the budget spills the oldest events, until
+            # we're down to half of the budget.
+            queue.push(events[4])
+            assert queue.spilled is not None
+            spill_path = queue.spilled.path
+            self.assertTrue(os.path.exists(spill_path))
+            self.assertEqual(len(queue.spilled), 3)
+            self.assertEqual([event_id for event_id, event in queue.queue], [3, 4])
+            self.assertEqual(queue.memory_bytes, 2 * event_size)
+
+            for event in events[5:]:
+                queue.push(event)
+            self.assertEqual(len(queue.spilled), 6)
+            self.assertEqual(
+                queue.contents(), [{**event, "id": i} for i, event in enumerate(events)]
+            )
+            self.verify_to_dict_end_to_end(client)
+
+            # Pruning reads through the spilled events first.
+            queue.prune(4)
+            self.assertEqual(queue.newest_pruned_id, 4)
+            self.assertEqual(len(queue.spilled), 1)
+            self.assertEqual([event["id"] for event in queue.contents()], [5, 6, 7, 8, 9])
+
+            queue.prune(5)
+            self.assertIsNone(queue.spilled)
+            self.assertFalse(os.path.exists(spill_path))
+            self.assertEqual([event["id"] for event in queue.contents()], [6, 7, 8, 9])
+            self.verify_to_dict_end_to_end(client)
+
+            # Garbage-collecting the queue deletes its spilled events.
+            for event in events:
+                queue.push(event)
+            assert queue.spilled is not None
+            self.assertTrue(os.path.exists(spill_path))
+            event_queue.do_gc_event_queues({client.event_queue.id})
+            self.assertFalse(os.path.exists(spill_path))
+
+    def test_spill_on_load(self) -> None:
+        client = self.get_client_descriptor()
+        queue = client.event_queue
+        events = [{"type": "unknown", "timestamp": str(i), "data": "x" * 100} for i in range(10)]
+        event_size = len(orjson.dumps(events[0]))
+        for event in events:
+            queue.push(event)
+        self.assertIsNone(queue.spilled)
+        queue_dict = queue.to_dict()
+
+        # A queue restored from a dump that's over the budget spills
+        # its oldest events straight away.
+        with tempfile.TemporaryDirectory() as spill_dir, self.settings(
+            EVENT_QUEUE_SPILL_DIR=spill_dir, EVENT_QUEUE_MEMORY_BUDGET_BYTES=4 * event_size
+        ):
+            new_queue = EventQueue.from_dict(queue_dict)
+            assert new_queue.spilled is not None
+            self.assertEqual(len(new_queue.spilled), 8)
+            self.assertEqual(new_queue.memory_bytes, 2 * event_size)
+            self.assertEqual(new_queue.contents(), queue.contents())
+            new_queue.delete_spilled_events()
+
 
 class SchemaMigrationsTests(ZulipTestCase):
     def test_reformat_legacy_send_message_event(self) -> None:
@@ -1552,3 +1971,164 @@ class SchemaMigrationsTests(ZulipTestCase):
             m.assert_called_once()
             self.assertDictEqual(m.call_args[0][0], expected_current_format_event)
             self.assertEqual(m.call_args[0][1], expected_current_format_users)
+
+
+class ProcessMessageEventsTest(ZulipTestCase):
+    def test_message_event_sizes(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        othello = self.example_user("othello")
+        for user_profile in [hamlet, cordelia, othello]:
+            self.subscribe(user_profile, "Verona")
+        with self.capture_send_event_calls(expected_num_events=1) as notices:
+            self.send_stream_message(hamlet, "Verona", "hello")
+
+        clients = []
+        for user_profile in [cordelia, othello]:
+            queue_data = dict(
+                all_public_streams=False,
+                apply_markdown=True,
+                client_gravatar=True,
+                client_type_name="website",
+                event_types=["message"],
+                last_connection_time=time.time(),
+                queue_timeout=600,
+                realm_id=user_profile.realm_id,
+                user_profile_id=user_profile.id,
+            )
+            clients.append(allocate_client_descriptor(queue_data))
+        message_events = [(notice["event"], notice["users"]) for notice in notices]
+
+        # Without a memory budget, events aren't measured at all.
+        with self.settings(EVENT_QUEUE_MEMORY_BUDGET_BYTES=None):
+            process_message_events(message_events)
+        self.assertEqual([client.event_queue.memory_bytes for client in clients], [0, 0])
+
+        # With one, the message payload the clients share is measured
+        # once, rather than each client's event.
+        with mock.patch(
+            "zerver.tornado.event_queue.get_event_size", wraps=event_queue.get_event_size
+        ) as mock_get_event_size, self.settings(EVENT_QUEUE_MEMORY_BUDGET_BYTES=10**6):
+            process_message_events(message_events)
+        mock_get_event_size.assert_called_once()
+        for client in clients:
+            events = client.event_queue.contents(include_internal_data=True)
+            self.assert_length(events, 2)
+            # The estimate is close to the event's actual size.
+            self.assertAlmostEqual(
+                client.event_queue.memory_bytes, len(orjson.dumps(events[1])), delta=200
+            )
+
+    def test_skip_users_without_clients_or_notifications(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        othello = self.example_user("othello")
+        for user_profile in [hamlet, cordelia, othello]:
+            self.subscribe(user_profile, "Verona")
+
+        with self.capture_send_event_calls(expected_num_events=2) as notices:
+            self.send_stream_message(hamlet, "Verona", "@**Cordelia, Lear's daughter** hello")
+            self.send_stream_message(hamlet, "Verona", "@**Cordelia, Lear's daughter** again")
+        self.assertGreater(len(notices[0]["users"]), 2)
+
+        queue_data = dict(
+            all_public_streams=False,
+            apply_markdown=True,
+            client_gravatar=True,
+            client_type_name="website",
+            event_types=["message"],
+            last_connection_time=time.time(),
+            queue_timeout=600,
+            realm_id=othello.realm_id,
+            user_profile_id=othello.id,
+        )
+        client = allocate_client_descriptor(queue_data)
+
+        with mock.patch.object(
+            UserMessageNotificationsData,
+            "from_user_id_sets",
+            wraps=UserMessageNotificationsData.from_user_id_sets,
+        ) as mock_from_user_id_sets, mock.patch(
+            "zerver.tornado.event_queue.receiver_is_off_zulip", return_value=True
+        ) as mock_receiver_is_off_zulip, mock_queue_publish(
+            "zerver.tornado.event_queue.queue_json_publish"
+        ) as mock_queue_json_publish:
+            process_message_events([(notice["event"], notice["users"]) for notice in notices])
+
+        # Only Cordelia, who was mentioned, could be notified, and
+        # only Othello has a client; nobody else's notifications
+        # data is even computed.
+        self.assertEqual(
+            {call.kwargs["user_id"] for call in mock_from_user_id_sets.call_args_list},
+            {cordelia.id, othello.id},
+        )
+        self.assertEqual(mock_from_user_id_sets.call_count, 4)
+
+        # Whether Cordelia is off Zulip is checked once for the batch.
+        mock_receiver_is_off_zulip.assert_called_once_with(cordelia.id)
+        self.assertEqual(
+            {call.args[1]["user_profile_id"] for call in mock_queue_json_publish.call_args_list},
+            {cordelia.id},
+        )
+
+        events = client.event_queue.contents(include_internal_data=True)
+        self.assert_length(events, 2)
+        for event in events:
+            self.assertFalse(event["internal_data"]["mention_push_notify"])
+
+    def test_batched_notification_processing(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        for user_profile in [hamlet, cordelia]:
+            self.subscribe(user_profile, "Verona")
+
+        with self.capture_send_event_calls(expected_num_events=3) as notices:
+            self.send_stream_message(hamlet, "Verona", "one")
+            self.send_stream_message(hamlet, "Verona", "two")
+            self.send_stream_message(hamlet, "Verona", "three")
+
+        queue_data = dict(
+            all_public_streams=False,
+            apply_markdown=True,
+            client_gravatar=True,
+            client_type_name="website",
+            event_types=None,
+            last_connection_time=time.time(),
+            queue_timeout=600,
+            realm_id=cordelia.realm_id,
+            user_profile_id=cordelia.id,
+        )
+        client = allocate_client_descriptor(queue_data)
+
+        # Two message events, then another kind of event, which ends
+        # the run of message events, then another message event.
+        items: List[Dict[str, Any]] = [
+            dict(notices=list(notices[:2]), published_at=time.time() - 2),
+            dict(event=dict(type="other"), users=[cordelia.id]),
+            dict(notices[2]),
+        ]
+        notification_batch_stats.clear()
+        with mock.patch(
+            "zerver.tornado.event_queue.get_client_descriptors_for_user",
+            wraps=get_client_descriptors_for_user,
+        ) as mock_get_client_descriptors_for_user:
+            get_wrapped_process_notification("notify_tornado")(items)
+
+        # The sender's clients were looked up once for each run of
+        # message events, not once per message.
+        looked_up_user_ids = [
+            call.args[0] for call in mock_get_client_descriptors_for_user.call_args_list
+        ]
+        self.assertEqual(looked_up_user_ids.count(hamlet.id), 2)
+        self.assertEqual(
+            [event["type"] for event in client.event_queue.contents()],
+            ["message", "message", "other", "message"],
+        )
+
+        stats = notification_batch_stats.to_dict()
+        self.assertEqual(stats["batch_size"]["count"], 1)
+        self.assertEqual(stats["batch_size"]["sum"], 4)
+        self.assertEqual(stats["batch_time_secs"]["count"], 1)
+        # Only the item published through RabbitMQ has a queue lag.
+        self.assertEqual(stats["queue_lag_secs"]["count"], 1)
+        self.assertGreaterEqual(stats["queue_lag_secs"]["sum"], 2)
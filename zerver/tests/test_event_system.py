@@ -1,13 +1,18 @@
+import threading
 import time
-from typing import Any, Callable, Dict, List, Optional
+from contextlib import suppress
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from unittest import mock
-from urllib.parse import urlsplit
+from urllib.parse import parse_qs, urlsplit
 
 import orjson
+import responses
 from django.conf import settings
+from django.db import connection, transaction
 from django.http import HttpRequest, HttpResponse
 from django.test import override_settings
 from django.utils.timezone import now as timezone_now
+from requests.models import PreparedRequest
 
 from version import API_FEATURE_LEVEL, ZULIP_MERGE_BASE, ZULIP_VERSION
 from zerver.actions.custom_profile_fields import try_update_realm_custom_profile_field
@@ -38,14 +43,23 @@ from zerver.models import (
     get_stream,
     get_system_bot,
 )
+from zerver.tornado.django_api import (
+    MAX_NOTIFICATION_BATCH_SIZE,
+    notification_batch_sizes,
+    publish_notices,
+    send_event_on_commit,
+    send_notifications_http,
+)
 from zerver.tornado.event_queue import (
     allocate_client_descriptor,
     clear_client_event_queues_for_testing,
     get_client_info_for_message_event,
+    get_wrapped_process_notification,
     process_message_event,
     send_restart_events,
 )
 from zerver.tornado.exceptions import BadEventQueueIdError
+from zerver.tornado.stats import notification_batch_stats
 from zerver.tornado.views import get_events, get_events_backend
 from zerver.views.events_register import (
     _default_all_public_streams,
@@ -265,6 +279,20 @@ class EventsEndpointTest(ZulipTestCase):
         result = self.client_post_request("/notify_tornado", req)
         self.assert_json_success(result)
 
+        # Several notices can be sent in one request.
+        post_data["data"] = orjson.dumps(
+            [
+                dict(event=dict(type="other"), users=[self.example_user("hamlet").id]),
+                dict(event=dict(type="other"), users=[self.example_user("cordelia").id]),
+            ]
+        ).decode()
+        req = HostRequestMock(post_data, tornado_handler=dummy_handler)
+        req.META["REMOTE_ADDR"] = "127.0.0.1"
+        with mock.patch("zerver.tornado.event_queue.process_notification") as m:
+            result = self.client_post_request("/notify_tornado", req)
+        self.assertFalse(self.assert_json_success(result)["slow_down"])
+        self.assertEqual(m.call_count, 2)
+
         post_data = dict(secret=settings.SHARED_SECRET)
         req = HostRequestMock(post_data, tornado_handler=dummy_handler)
         req.META["REMOTE_ADDR"] = "127.0.0.1"
@@ -274,6 +302,120 @@ class EventsEndpointTest(ZulipTestCase):
         self.assertEqual(context.exception.http_status_code, 400)
 
 
+class NotifyTornadoTest(ZulipTestCase):
+    def test_send_event_on_commit_coalesces_notices(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        realm = hamlet.realm
+
+        with self.capture_send_event_calls(expected_num_events=2) as events, mock.patch(
+            "zerver.tornado.django_api.publish_notices", wraps=publish_notices
+        ) as m:
+            with transaction.atomic(savepoint=False):
+                send_event_on_commit(realm, dict(type="other", n=1), [hamlet.id])
+                with suppress(RuntimeError), transaction.atomic():
+                    send_event_on_commit(realm, dict(type="other", n=2), [hamlet.id])
+                    raise RuntimeError("rolled back")
+                send_event_on_commit(realm, dict(type="other", n=3), [cordelia.id])
+
+        # The event from the rolled-back savepoint isn't sent, and the
+        # others are sent together.
+        self.assertEqual([event["event"]["n"] for event in events], [1, 3])
+        m.assert_called_once()
+        self.assert_length(m.call_args.args[1], 2)
+
+        # A lone event is published as a single notice, as before.
+        with self.capture_send_event_calls(expected_num_events=1), mock.patch(
+            "zerver.tornado.django_api.publish_notices", wraps=publish_notices
+        ) as m:
+            send_event_on_commit(realm, dict(type="other"), [hamlet.id])
+        m.assert_called_once()
+        self.assert_length(m.call_args.args[1], 1)
+
+    def test_send_event_on_commit_concurrent_rollback(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        realm = hamlet.realm
+
+        def rolled_back_transaction() -> None:
+            try:
+                with suppress(RuntimeError), transaction.atomic():
+                    send_event_on_commit(realm, dict(type="other", n=2), [cordelia.id])
+                    raise RuntimeError("rolled back")
+            finally:
+                connection.close()
+
+        with self.capture_send_event_calls(expected_num_events=1) as events, mock.patch(
+            "zerver.tornado.django_api.publish_notices", wraps=publish_notices
+        ) as m:
+            send_event_on_commit(realm, dict(type="other", n=1), [hamlet.id])
+            # Another thread, with its own database connection, sends
+            # an event in a transaction which is rolled back, while
+            # ours is still open.
+            thread = threading.Thread(target=rolled_back_transaction)
+            thread.start()
+            thread.join()
+
+        # Our event is still sent when our transaction commits.
+        self.assertEqual([event["event"]["n"] for event in events], [1])
+        m.assert_called_once()
+
+    def test_wrapped_process_notification(self) -> None:
+        notices = [
+            dict(event=dict(type="other", n=1), users=[1]),
+            dict(event=dict(type="other", n=2), users=[1]),
+            dict(event=dict(type="other", n=3), users=[1]),
+        ]
+        processed: List[Dict[str, Any]] = []
+        with mock.patch(
+            "zerver.tornado.event_queue.process_notification",
+            side_effect=lambda notice, batch: processed.append(notice),
+        ):
+            get_wrapped_process_notification("notify_tornado")(
+                [notices[0], dict(notices=notices[1:])]
+            )
+        self.assertEqual(processed, notices)
+
+    def test_notification_stats_endpoint(self) -> None:
+        notification_batch_stats.clear()
+        notification_batch_stats.record_batch(3, 0.002, [0.2])
+
+        req = HostRequestMock(dict(secret=settings.SHARED_SECRET), tornado_handler=dummy_handler)
+        req.META["REMOTE_ADDR"] = "127.0.0.1"
+        result = self.client_post_request("/notify_tornado/stats", req)
+        stats = self.assert_json_success(result)
+        self.assertEqual(stats["batch_size"]["count"], 1)
+        self.assertEqual(stats["batch_size"]["sum"], 3)
+        self.assertIn(dict(le=5, count=1), stats["batch_size"]["buckets"])
+        self.assertIn(dict(le=0.005, count=1), stats["batch_time_secs"]["buckets"])
+        self.assertIn(dict(le=0.5, count=1), stats["queue_lag_secs"]["buckets"])
+
+    @responses.activate
+    def test_send_notifications_http_backpressure(self) -> None:
+        notices = [dict(event=dict(type="other", n=n), users=[1]) for n in range(250)]
+        batches: List[List[Dict[str, Any]]] = []
+
+        def callback(request: PreparedRequest) -> Tuple[int, Dict[str, str], bytes]:
+            assert isinstance(request.body, str)
+            batch = orjson.loads(parse_qs(request.body)["data"][0])
+            batches.append(batch)
+            # Tornado falls behind while processing the first batch.
+            response = dict(result="success", msg="", slow_down=len(batches) == 1)
+            return (200, {}, orjson.dumps(response))
+
+        responses.add_callback(
+            responses.POST, "http://127.0.0.1:9800/notify_tornado", callback=callback
+        )
+        with self.settings(USING_TORNADO=True), mock.patch.dict(
+            notification_batch_sizes, clear=True
+        ):
+            send_notifications_http(9800, notices)
+            self.assertEqual(notification_batch_sizes[9800], MAX_NOTIFICATION_BATCH_SIZE)
+
+        self.assertEqual([len(batch) for batch in batches], [100, 50, 100])
+        self.assertEqual([notice for batch in batches for notice in batch], notices)
+
+
 class GetEventsTest(ZulipTestCase):
     def tornado_call(
         self,
@@ -50,6 +50,7 @@ from zerver.actions.invites import (
 from zerver.actions.message_delete import do_delete_messages
 from zerver.actions.message_edit import do_update_embedded_data, do_update_message
 from zerver.actions.message_flags import do_update_message_flags
+from zerver.actions.message_translation import do_send_message_translation
 from zerver.actions.muted_users import do_mute_user, do_unmute_user
 from zerver.actions.presence import do_update_user_presence
 from zerver.actions.reactions import do_add_reaction, do_remove_reaction
@@ -170,6 +171,7 @@ from zerver.lib.event_schema import (
     check_subscription_peer_remove,
     check_subscription_remove,
     check_subscription_update,
+    check_translation,
     check_typing_start,
     check_typing_stop,
     check_update_display_settings,
@@ -835,6 +837,18 @@ class NormalActionsTest(BaseAction):
         )
         check_submessage("events[0]", events[0])
 
+    def test_send_message_translation(self) -> None:
+        hamlet = self.example_user("hamlet")
+        message_id = self.send_personal_message(hamlet, self.user_profile, "hello")
+        message = Message.objects.get(id=message_id)
+        events = self.verify_action(
+            lambda: do_send_message_translation(
+                message, "es", "<p>hola</p>", [self.user_profile.id]
+            ),
+            state_change_expected=False,
+        )
+        check_translation("events[0]", events[0])
+
     def test_remove_reaction(self) -> None:
         message_id = self.send_stream_message(self.example_user("hamlet"), "Verona", "hello")
         message = Message.objects.get(id=message_id)
@@ -16,6 +16,7 @@ from django.utils.timezone import now as timezone_now
 from confirmation.models import RealmCreationKey, generate_realm_creation_url
 from zerver.actions.create_user import do_create_user
 from zerver.actions.reactions import do_add_reaction
+from zerver.actions.realm_linkifiers import do_add_linkifier
 from zerver.lib.management import ZulipBaseCommand, check_config
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import most_recent_message, stdout_suppressed
@@ -625,3 +626,38 @@ class TestSendCustomEmail(ZulipTestCase):
                     call("  hamlet@zulip.com (zulip)"),
                 ],
             )
+
+
+class TestRerenderMessages(ZulipTestCase):
+    COMMAND_NAME = "rerender_messages"
+
+    def test_rerender_after_adding_linkifier(self) -> None:
+        realm = get_realm("zulip")
+        message_id = self.send_stream_message(
+            self.example_user("hamlet"), "Denmark", "Fixed in ZBUG-123"
+        )
+        message = Message.objects.get(id=message_id)
+        self.assertEqual(message.rendered_content, "<p>Fixed in ZBUG-123</p>")
+        self.assertFalse(message.has_link)
+
+        do_add_linkifier(
+            realm,
+            "ZBUG-(?P<id>[0-9]+)",
+            "https://trac.example.com/ticket/{id}",
+            acting_user=None,
+        )
+
+        # Only outdated messages are re-rendered by default.
+        with patch("builtins.print"):
+            call_command(self.COMMAND_NAME, "-r=zulip", "--processes=1")
+        message.refresh_from_db()
+        self.assertEqual(message.rendered_content, "<p>Fixed in ZBUG-123</p>")
+
+        with patch("builtins.print"):
+            call_command(self.COMMAND_NAME, "-r=zulip", "--all", "--processes=1")
+        message.refresh_from_db()
+        self.assertEqual(
+            message.rendered_content,
+            '<p>Fixed in <a href="https://trac.example.com/ticket/123">ZBUG-123</a></p>',
+        )
+        self.assertTrue(message.has_link)
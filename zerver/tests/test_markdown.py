@@ -1,9 +1,11 @@
 import copy
 import os
+import pickle
 import re
+from concurrent.futures import Executor, Future
 from html import escape
 from textwrap import dedent
-from typing import Any, Dict, List, Optional, Set, Tuple, cast
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, cast
 from unittest import mock
 
 import orjson
@@ -14,10 +16,16 @@ from markdown import Markdown
 
 from zerver.actions.alert_words import do_add_alert_words
 from zerver.actions.create_realm import do_create_realm
+from zerver.actions.message_edit import do_rerender_degraded_message
 from zerver.actions.realm_emoji import do_remove_realm_emoji
+from zerver.actions.realm_linkifiers import (
+    do_add_linkifier,
+    do_remove_linkifier,
+    do_update_linkifier,
+)
 from zerver.actions.realm_settings import do_set_realm_property
 from zerver.actions.user_groups import check_add_user_group
-from zerver.actions.user_settings import do_change_user_setting
+from zerver.actions.user_settings import do_change_full_name, do_change_user_setting
 from zerver.actions.users import change_user_is_active
 from zerver.lib.alert_words import get_alert_word_automaton
 from zerver.lib.camo import get_camo_url
@@ -25,22 +33,36 @@ from zerver.lib.create_user import create_user
 from zerver.lib.emoji import get_emoji_url
 from zerver.lib.exceptions import JsonableError, MarkdownRenderingError
 from zerver.lib.markdown import (
+    ZEPHYR_MIRROR_MARKDOWN_KEY,
     InlineInterestingLinkProcessor,
     MarkdownListPreprocessor,
+    MarkdownRenderTask,
     MessageRenderingResult,
     clear_state_for_testing,
     content_has_emoji_syntax,
     fetch_tweet_data,
+    get_markdown_engine,
+    get_markdown_engine_stats,
     get_tweet_id,
     image_preview_enabled,
     markdown_convert,
-    maybe_update_markdown_engines,
+    md_engine_stats,
     possible_linked_stream_names,
+    prepare_markdown_render,
+    render_markdown_task,
     topic_links,
     url_embed_preview_enabled,
     url_to_a,
 )
 from zerver.lib.markdown.fenced_code import FencedBlockPreprocessor
+from zerver.lib.markdown.linkifiers import LinkifierPrefilter, linkifier_pattern_literal
+from zerver.lib.markdown.render_pool import (
+    MIN_PARALLEL_RENDER_BATCH,
+    MarkdownRenderPool,
+    RenderedMessage,
+    RenderInput,
+)
+from zerver.lib.markdown.stats import markdown_render_stats
 from zerver.lib.mdiff import diff_strings
 from zerver.lib.mention import (
     FullNameInfo,
@@ -53,9 +75,11 @@ from zerver.lib.mention import (
     stream_wildcards,
     topic_wildcards,
 )
-from zerver.lib.message import render_markdown
+from zerver.lib.message import render_markdown, rerender_messages
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.tex import render_tex
+from zerver.lib.timeout import TimeoutExpiredError
+from zerver.lib.types import LinkifierDict
 from zerver.models import (
     Message,
     RealmEmoji,
@@ -499,7 +523,7 @@ class MarkdownTest(ZulipTestCase):
         clear_state_for_testing()
         with self.settings(ENABLE_FILE_LINKS=False):
             realm = do_create_realm(string_id="file_links_test", name="file_links_test")
-            maybe_update_markdown_engines(realm.id, False)
+            get_markdown_engine(realm.id, False)
             self.assertEqual(
                 markdown_convert(msg, message_realm=realm).rendered_content,
                 "<p>Check out this file file:///Volumes/myserver/Users/Shared/pi.py</p>",
@@ -1489,6 +1513,335 @@ class MarkdownTest(ZulipTestCase):
         flush()
         self.assertFalse(realm_in_local_linkifiers_cache(realm.id))
 
+    def test_linkifier_pattern_literal(self) -> None:
+        self.assertEqual(linkifier_pattern_literal("ZBUG-(?P<id>[0-9]+)"), "ZBUG-")
+        self.assertEqual(
+            linkifier_pattern_literal(r"https://github\.com/(?P<org>[a-z]+)/issues"),
+            "https://github.com/",
+        )
+        self.assertEqual(linkifier_pattern_literal("ab?cd{2}efg"), "efg")
+        self.assertEqual(linkifier_pattern_literal("[A-Z]+-[0-9]+"), "-")
+        self.assertIsNone(linkifier_pattern_literal("[A-Z]+[0-9]+"))
+        self.assertIsNone(linkifier_pattern_literal("ZBUG-[0-9]+|ZTASK-[0-9]+"))
+
+    def test_linkifier_prefilter(self) -> None:
+        prefilter = LinkifierPrefilter(
+            [
+                "ZBUG-(?P<id>[0-9]+)",
+                "(?i)zgit-(?P<id>[0-9]+)",
+                "[A-Z]+[0-9]+",
+                "ZBUG-(?P<id>[a-z]+)",
+            ]
+        )
+        self.assertEqual(prefilter.candidates("Fixed in ZBUG-1 and ZGIT-2"), {0, 1, 2, 3})
+        self.assertEqual(prefilter.candidates("Fixed in zgit-2"), {1, 2})
+        self.assertEqual(prefilter.candidates("Nothing to see here"), {2})
+        # Literals are matched case-insensitively, since the
+        # patterns may be.
+        self.assertEqual(prefilter.candidates("zbug-1"), {0, 2, 3})
+
+        self.assertIsNone(LinkifierPrefilter(["[A-Z]+[0-9]+"]).automaton)
+        self.assertEqual(LinkifierPrefilter([]).candidates("ZBUG-1"), set())
+
+    def test_markdown_engine_pool(self) -> None:
+        pattern = "ZBUG-(?P<id>[0-9]+)"
+        url_template = "https://trac.example.com/ticket/{id}"
+        linkifiers = [LinkifierDict(pattern=pattern, url_template=url_template, id=1)]
+        builds = md_engine_stats.builds
+        md_engine = get_markdown_engine(1, False, linkifiers)
+        self.assertEqual(md_engine_stats.builds, builds + 1)
+
+        # Realms with the same linkifiers share an engine.
+        other_linkifiers = [LinkifierDict(pattern=pattern, url_template=url_template, id=2)]
+        self.assertIs(get_markdown_engine(2, False, other_linkifiers), md_engine)
+        self.assertIsNot(get_markdown_engine(1, True, linkifiers), md_engine)
+        self.assertIsNot(
+            get_markdown_engine(ZEPHYR_MIRROR_MARKDOWN_KEY, False, linkifiers), md_engine
+        )
+        self.assertEqual(md_engine_stats.builds, builds + 3)
+
+        # The least recently used engine is evicted.
+        evictions = md_engine_stats.evictions
+        with mock.patch("zerver.lib.markdown.MARKDOWN_ENGINE_POOL_SIZE", 3):
+            get_markdown_engine(1, False, linkifiers)
+            get_markdown_engine(1, False, [])
+        self.assertEqual(md_engine_stats.evictions, evictions + 1)
+        self.assertEqual(get_markdown_engine_stats()["engines"], 3)
+        self.assertIs(get_markdown_engine(1, False, linkifiers), md_engine)
+        self.assertEqual(md_engine_stats.builds, builds + 4)
+
+    def test_linkifier_change_rerenders_messages(self) -> None:
+        realm = get_realm("zulip")
+        hamlet = self.example_user("hamlet")
+        message_id = self.send_stream_message(hamlet, "Denmark", "Fixed in ZBUG-123")
+        other_message_id = self.send_stream_message(hamlet, "Denmark", "Fixed in 123")
+
+        with self.capture_send_event_calls(expected_num_events=2) as events:
+            linkifier_id = do_add_linkifier(
+                realm,
+                "ZBUG-(?P<id>[0-9]+)",
+                "https://trac.example.com/ticket/{id}",
+                acting_user=None,
+            )
+        [update_event] = [
+            event["event"] for event in events if event["event"]["type"] == "update_message"
+        ]
+        rendered_content = (
+            '<p>Fixed in <a href="https://trac.example.com/ticket/123">ZBUG-123</a></p>'
+        )
+        self.assertEqual(update_event["message_ids"], [message_id])
+        self.assertTrue(update_event["rendering_only"])
+        self.assertEqual(update_event["rendered_content"], rendered_content)
+        message = Message.objects.get(id=message_id)
+        self.assertEqual(message.rendered_content, rendered_content)
+        self.assertTrue(message.has_link)
+        self.assertEqual(
+            Message.objects.get(id=other_message_id).rendered_content, "<p>Fixed in 123</p>"
+        )
+
+        with self.capture_send_event_calls(expected_num_events=2):
+            do_update_linkifier(
+                realm,
+                linkifier_id,
+                "ZBUG-(?P<id>[0-9]+)",
+                "https://bugs.example.com/{id}",
+                acting_user=None,
+            )
+        self.assertEqual(
+            Message.objects.get(id=message_id).rendered_content,
+            '<p>Fixed in <a href="https://bugs.example.com/123">ZBUG-123</a></p>',
+        )
+
+        with self.capture_send_event_calls(expected_num_events=2):
+            do_remove_linkifier(realm, id=linkifier_id, acting_user=None)
+        self.assertEqual(
+            Message.objects.get(id=message_id).rendered_content, "<p>Fixed in ZBUG-123</p>"
+        )
+
+    def test_linkifier_change_keeps_other_changes(self) -> None:
+        realm = get_realm("zulip")
+        hamlet = self.example_user("hamlet")
+        othello = self.example_user("othello")
+        message_id = self.send_stream_message(
+            hamlet, "Denmark", "Fixed in ZBUG-123, thanks @**Othello, the Moor of Venice**"
+        )
+        rendered_content = Message.objects.get(id=message_id).rendered_content
+        do_change_full_name(othello, "Othello", acting_user=None)
+
+        # Rendering the message again would rename the mention, as
+        # well as linkify it; so it's left as it was.
+        with self.capture_send_event_calls(expected_num_events=1) as events:
+            do_add_linkifier(
+                realm,
+                "ZBUG-(?P<id>[0-9]+)",
+                "https://trac.example.com/ticket/{id}",
+                acting_user=None,
+            )
+        self.assertEqual(events[0]["event"]["type"], "realm_linkifiers")
+        self.assertEqual(Message.objects.get(id=message_id).rendered_content, rendered_content)
+
+    def test_rerender_skips_edited_messages(self) -> None:
+        realm = get_realm("zulip")
+        hamlet = self.example_user("hamlet")
+        message_id = self.send_stream_message(hamlet, "Denmark", "Fixed in ZBUG-123")
+        edited_message_id = self.send_stream_message(hamlet, "Denmark", "Fixed in ZBUG-456")
+        do_add_linkifier(
+            realm,
+            "ZBUG-(?P<id>[0-9]+)",
+            "https://trac.example.com/ticket/{id}",
+            acting_user=None,
+        )
+        messages = list(
+            Message.objects.filter(id__in=[message_id, edited_message_id])
+            .select_related("sender", "sending_client")
+            .order_by("id")
+        )
+
+        render = MarkdownRenderPool.render
+
+        def edit_while_rendering(
+            render_pool: MarkdownRenderPool, tasks: List[Tuple[Any, Optional[Message]]]
+        ) -> List[Any]:
+            Message.objects.filter(id=edited_message_id).update(
+                content="Fixed in ZBUG-789", rendered_content="<p>edited</p>"
+            )
+            return render(render_pool, tasks)
+
+        with MarkdownRenderPool(1) as render_pool, mock.patch.object(
+            MarkdownRenderPool, "render", autospec=True, side_effect=edit_while_rendering
+        ):
+            changed_messages = rerender_messages(realm, messages, render_pool)
+
+        # The edit's rendering isn't overwritten with one of the old content.
+        self.assertEqual([message.id for message in changed_messages], [message_id])
+        self.assertEqual(
+            Message.objects.get(id=edited_message_id).rendered_content, "<p>edited</p>"
+        )
+        self.assertTrue(Message.objects.get(id=message_id).has_link)
+
+    @override_settings(CACHE_RENDERED_MESSAGE_CONTENT=True)
+    def test_rendered_content_cache(self) -> None:
+        realm = get_realm("zulip")
+        message = Message(sender=self.example_user("hamlet"), realm=realm)
+
+        def render(content: str) -> str:
+            message.has_link = False
+            return markdown_convert(content, message=message, message_realm=realm).rendered_content
+
+        content = "Build failed: ZBUG-1 https://ci.example.com/builds/1"
+        with mock.patch(
+            "zerver.lib.markdown.render_markdown_task", wraps=render_markdown_task
+        ) as render_mock:
+            rendered_content = render(content)
+            self.assertEqual(render(content), rendered_content)
+            self.assertEqual(render_mock.call_count, 1)
+            self.assertTrue(message.has_link)
+
+            # Changing the realm's linkifiers invalidates its cached
+            # renderings.
+            do_add_linkifier(
+                realm,
+                "ZBUG-(?P<id>[0-9]+)",
+                "https://trac.example.com/ticket/{id}",
+                acting_user=None,
+            )
+            self.assertIn("https://trac.example.com/ticket/1", render(content))
+            self.assertEqual(render_mock.call_count, 2)
+
+            # Content which mentions anything isn't cached.
+            render_mock.reset_mock()
+            render("Ping @**King Hamlet**")
+            render("Ping @**King Hamlet**")
+            render("See #**Denmark**")
+            render("See #**Denmark**")
+            self.assertEqual(render_mock.call_count, 4)
+
+    def test_markdown_render_stats(self) -> None:
+        markdown_render_stats.clear()
+        markdown_convert("Check **https://zulip.com/**")
+
+        result = self.client_post("/markdown/stats", {"secret": settings.SHARED_SECRET})
+        stats = self.assert_json_success(result)
+        self.assertEqual(stats["render_time_secs"]["count"], 1)
+        for stage in [
+            "preprocessor/FencedBlockPreprocessor",
+            "block_parser",
+            "treeprocessor/InlineProcessor",
+            "treeprocessor/InlineInterestingLinkProcessor",
+            "postprocessor/RawHtmlPostprocessor",
+        ]:
+            self.assertEqual(stats["stage_time_secs"][stage]["count"], 1)
+        self.assertEqual(stats["over_budget"], 0)
+        self.assertIn("builds", stats["engines"])
+
+        result = self.client_post("/markdown/stats", {"secret": "wrong"})
+        self.assert_json_error(result, "Access denied", status_code=403)
+
+    def test_render_over_budget(self) -> None:
+        hamlet = self.example_user("hamlet")
+        othello = self.example_user("othello")
+        markdown_render_stats.clear()
+
+        def slow_timeout(seconds: float, func: Callable[[], str]) -> str:
+            # Only a full rendering, without a budget, finishes in time.
+            if seconds < 5:
+                raise TimeoutExpiredError
+            return func()
+
+        content = "**Deploy** failed, @**Othello, the Moor of Venice**:\nsee https://zulip.com/ <b>now</b>"
+        with override_settings(MARKDOWN_RENDER_BUDGET_SECONDS=0.5), mock.patch(
+            "zerver.lib.markdown.timeout", side_effect=slow_timeout
+        ), self.assertLogs(level="WARNING") as m, self.capture_send_event_calls(
+            expected_num_events=2
+        ) as events:
+            message_id = self.send_stream_message(hamlet, "Denmark", content)
+        self.assertIn("sending a degraded rendering", m.output[0])
+        self.assertEqual(markdown_render_stats.over_budget, 1)
+
+        # The message is sent with a degraded rendering, which still
+        # notifies the users it mentions ...
+        message_event = events[0]["event"]
+        self.assertEqual(message_event["type"], "message")
+        self.assertEqual(
+            message_event["message_dict"]["rendered_content"],
+            "<p>**Deploy** failed, @**Othello, the Moor of Venice**:<br>\n"
+            'see <a href="https://zulip.com/">https://zulip.com/</a> &lt;b&gt;now&lt;/b&gt;</p>',
+        )
+        um = UserMessage.objects.get(user_profile=othello, message_id=message_id)
+        self.assertIn("mentioned", um.flags_list())
+
+        # ... and then rendered in full.
+        update_event = events[1]["event"]
+        self.assertEqual(update_event["type"], "update_message")
+        self.assertEqual(update_event["message_ids"], [message_id])
+        message = Message.objects.get(id=message_id)
+        self.assertEqual(update_event["rendered_content"], message.rendered_content)
+        self.assertIn("<strong>Deploy</strong>", message.rendered_content)
+        self.assertTrue(message.has_link)
+
+        # Without a budget, such a message isn't sent.
+        with mock.patch(
+            "zerver.lib.markdown.timeout", side_effect=TimeoutExpiredError
+        ), self.assertLogs(level="ERROR"), self.assertRaisesRegex(
+            JsonableError, "Unable to render message"
+        ):
+            self.send_stream_message(hamlet, "Denmark", content)
+
+    def test_render_over_budget_flags(self) -> None:
+        hamlet = self.example_user("hamlet")
+        othello = self.example_user("othello")
+        cordelia = self.example_user("cordelia")
+        do_add_alert_words(cordelia, ["deploy"])
+
+        def slow_timeout(seconds: float, func: Callable[[], str]) -> str:
+            if seconds < 5:
+                raise TimeoutExpiredError
+            return func()
+
+        content = "**Deploy** failed:\n```\n@**Othello, the Moor of Venice**\n```"
+        with override_settings(MARKDOWN_RENDER_BUDGET_SECONDS=0.5), mock.patch(
+            "zerver.lib.markdown.timeout", side_effect=slow_timeout
+        ), self.assertLogs(level="WARNING"), self.capture_send_event_calls(expected_num_events=2):
+            message_id = self.send_stream_message(hamlet, "Denmark", content)
+
+        # The degraded rendering ignores mentions in code blocks, and
+        # matches alert words, like the full rendering does.
+        um = UserMessage.objects.get(user_profile=othello, message_id=message_id)
+        self.assertNotIn("mentioned", um.flags_list())
+        um = UserMessage.objects.get(user_profile=cordelia, message_id=message_id)
+        self.assertIn("has_alert_word", um.flags_list())
+
+        # Rendering the message in full fixes up the flags which the
+        # degraded rendering got wrong.
+        UserMessage.objects.filter(user_profile=othello, message_id=message_id).update(
+            flags=UserMessage.flags.mentioned
+        )
+        UserMessage.objects.filter(user_profile=cordelia, message_id=message_id).update(flags=0)
+        with self.capture_send_event_calls(expected_num_events=1) as events:
+            do_rerender_degraded_message(message_id)
+        self.assertTrue(events[0]["event"]["rendering_only"])
+        um = UserMessage.objects.get(user_profile=othello, message_id=message_id)
+        self.assertNotIn("mentioned", um.flags_list())
+        um = UserMessage.objects.get(user_profile=cordelia, message_id=message_id)
+        self.assertIn("has_alert_word", um.flags_list())
+
+        # If the full rendering fails too, the message keeps its
+        # degraded rendering, and we log that.
+        message = Message.objects.get(id=message_id)
+        with mock.patch(
+            "zerver.lib.markdown.timeout", side_effect=TimeoutExpiredError
+        ), self.assertLogs(level="WARNING") as m, self.capture_send_event_calls(
+            expected_num_events=0
+        ):
+            do_rerender_degraded_message(message_id)
+        self.assertIn(
+            f"Failed to render message {message_id} in full; it keeps its degraded rendering",
+            m.output[-1],
+        )
+        self.assertEqual(
+            Message.objects.get(id=message_id).rendered_content, message.rendered_content
+        )
+
     def test_linkifier_precedence(self) -> None:
         realm = self.example_user("hamlet").realm
         # The insertion order should not affect the fact that the linkifiers are ordered by id.
@@ -2763,7 +3116,7 @@ class MarkdownTest(ZulipTestCase):
         realm = do_create_realm(
             string_id="code_block_processor_test", name="code_block_processor_test"
         )
-        maybe_update_markdown_engines(realm.id, True)
+        get_markdown_engine(realm.id, True)
         rendering_result = markdown_convert(msg, message_realm=realm, email_gateway=True)
         expected_output = (
             "<p>Hello,</p>\n"
@@ -2926,6 +3279,72 @@ class MarkdownErrorTests(ZulipTestCase):
             with self.assertRaises(MarkdownRenderingError):
                 markdown_convert_wrapper("")
 
+    def test_render_pool(self) -> None:
+        realm = get_realm("zulip")
+        message = Message(sender=self.example_user("hamlet"), realm=realm)
+        tasks = [
+            (prepare_markdown_render("https://example.com", message_realm=realm), message),
+            (prepare_markdown_render("**bold**", message_realm=realm), None),
+        ]
+        with MarkdownRenderPool(1) as render_pool:
+            results = render_pool.render(tasks)
+            assert results[0] is not None and results[1] is not None
+            self.assertEqual(
+                results[0].rendering_result.rendered_content,
+                '<p><a href="https://example.com">https://example.com</a></p>',
+            )
+            self.assertTrue(results[0].has_link)
+            self.assertTrue(message.has_link)
+            self.assertEqual(
+                results[1].rendering_result.rendered_content, "<p><strong>bold</strong></p>"
+            )
+
+            with self.simulated_markdown_failure():
+                self.assertEqual(render_pool.render(tasks), [None, None])
+
+    def test_render_pool_parallel(self) -> None:
+        class PicklingExecutor(Executor):
+            # Stands in for a ProcessPoolExecutor, by pickling the
+            # arguments and results of each call like it would.
+            def submit(  # type: ignore[override] # Only as general as we need.
+                self,
+                fn: Callable[[List[RenderInput]], List[Optional[RenderedMessage]]],
+                /,
+                *args: Any,
+            ) -> "Future[List[Optional[RenderedMessage]]]":
+                future: "Future[List[Optional[RenderedMessage]]]" = Future()
+                results = fn(*pickle.loads(pickle.dumps(args)))  # noqa: S301
+                future.set_result(pickle.loads(pickle.dumps(results)))  # noqa: S301
+                return future
+
+        realm = get_realm("zulip")
+        messages = [
+            Message(sender=self.example_user("hamlet"), realm=realm)
+            for i in range(MIN_PARALLEL_RENDER_BATCH)
+        ]
+        tasks: List[Tuple[MarkdownRenderTask, Optional[Message]]] = [
+            (prepare_markdown_render(f"https://example.com/{i}", message_realm=realm), message)
+            for i, message in enumerate(messages)
+        ]
+        tasks.append((prepare_markdown_render("**bold**", message_realm=realm), None))
+        with MarkdownRenderPool(2) as render_pool, mock.patch(
+            "zerver.lib.markdown.render_pool.RENDER_CHUNK_SIZE", 3
+        ):
+            render_pool.executor = PicklingExecutor()
+            results = render_pool.render(tasks)
+        self.assert_length(results, MIN_PARALLEL_RENDER_BATCH + 1)
+        for i, (result, message) in enumerate(zip(results, messages)):
+            assert result is not None
+            self.assertEqual(
+                result.rendering_result.rendered_content,
+                f'<p><a href="https://example.com/{i}">https://example.com/{i}</a></p>',
+            )
+            self.assertTrue(message.has_link)
+        assert results[-1] is not None
+        self.assertEqual(
+            results[-1].rendering_result.rendered_content, "<p><strong>bold</strong></p>"
+        )
+
     def test_send_message_errors(self) -> None:
         message = "whatever"
         with self.simulated_markdown_failure():
@@ -1,6 +1,6 @@
 import datetime
 from email.headerregistry import Address
-from typing import Any, Optional, Set
+from typing import Any, Dict, Optional, Set
 from unittest import mock
 
 import orjson
@@ -33,6 +33,7 @@ from zerver.actions.users import do_change_can_forge_sender, do_deactivate_user
 from zerver.lib.addressee import Addressee
 from zerver.lib.exceptions import JsonableError
 from zerver.lib.message import MessageDict, get_raw_unread_data, get_recent_private_conversations
+from zerver.lib.rate_limiter import RateLimitedUser
 from zerver.lib.streams import create_stream_if_needed
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import (
@@ -41,9 +42,11 @@ from zerver.lib.test_helpers import (
     message_stream_count,
     most_recent_message,
     most_recent_usermessage,
+    ratelimit_rule,
     reset_email_visibility_to_everyone_in_zulip_realm,
 )
 from zerver.lib.timestamp import datetime_to_timestamp
+from zerver.lib.user_message import copy_user_message_rows
 from zerver.models import (
     MAX_TOPIC_NAME_LENGTH,
     Message,
@@ -62,7 +65,8 @@ from zerver.models import (
     get_system_bot,
     get_user,
 )
-from zerver.views.message_send import InvalidMirrorInputError
+from zerver.tornado.django_api import publish_notices
+from zerver.views.message_send import MAX_BULK_SEND_MESSAGES, InvalidMirrorInputError
 
 
 class MessagePOSTTest(ZulipTestCase):
@@ -111,6 +115,67 @@ class MessagePOSTTest(ZulipTestCase):
         )
         self.assert_json_success(result)
 
+    def test_send_messages_bulk(self) -> None:
+        user = self.example_user("hamlet")
+        othello = self.example_user("othello")
+        messages = [
+            {"type": "stream", "to": "Verona", "topic": "bulk", "content": "First"},
+            {"type": "stream", "to": "nonexistent_stream", "topic": "bulk", "content": "Lost"},
+            {"type": "direct", "to": [othello.id], "content": "Second", "local_id": "2"},
+        ]
+        with mock.patch("zerver.tornado.django_api.publish_notices", wraps=publish_notices) as m:
+            result = self.api_post(
+                user, "/api/v1/messages/bulk", {"messages": orjson.dumps(messages).decode()}
+            )
+        results = self.assert_json_success(result)["messages"]
+        # The events for both messages are sent to Tornado together.
+        m.assert_called_once()
+
+        self.assert_length(results, 3)
+        self.assertEqual(
+            results[1],
+            {
+                "result": "error",
+                "msg": "Stream 'nonexistent_stream' does not exist",
+                "code": "STREAM_DOES_NOT_EXIST",
+            },
+        )
+        stream_message = Message.objects.get(id=results[0]["id"])
+        self.assertEqual(stream_message.content, "First")
+        self.assertEqual(stream_message.topic_name(), "bulk")
+        direct_message = Message.objects.get(id=results[2]["id"])
+        self.assertEqual(direct_message.content, "Second")
+        self.assertEqual(direct_message.recipient_id, othello.recipient_id)
+
+        result = self.api_post(
+            user,
+            "/api/v1/messages/bulk",
+            {"messages": orjson.dumps(messages * (MAX_BULK_SEND_MESSAGES // 3 + 1)).decode()},
+        )
+        self.assert_json_error(result, "Too many messages; at most 100 may be sent at once.")
+
+    def test_send_messages_bulk_rate_limit(self) -> None:
+        user = self.example_user("hamlet")
+        RateLimitedUser(user).clear_history()
+        messages = [
+            {"type": "stream", "to": "Verona", "topic": "bulk", "content": f"Message {i}"}
+            for i in range(3)
+        ]
+
+        # Each message counts against the rate limit, not just the request.
+        with ratelimit_rule(60, 5, domain="api_by_user"):
+            result = self.api_post(
+                user, "/api/v1/messages/bulk", {"messages": orjson.dumps(messages).decode()}
+            )
+            self.assert_json_success(result)
+            self.assertEqual(result["X-RateLimit-Remaining"], "2")
+
+            result = self.api_post(
+                user, "/api/v1/messages/bulk", {"messages": orjson.dumps(messages).decode()}
+            )
+            self.assertEqual(result.status_code, 429)
+        self.assertEqual(Message.objects.filter(sender=user, subject="bulk").count(), 3)
+
     def test_message_to_stream_with_nonexistent_id(self) -> None:
         cordelia = self.example_user("cordelia")
         bot = self.create_test_bot(
@@ -1388,6 +1453,35 @@ class StreamMessagesTest(ZulipTestCase):
         self.assertEqual(old_non_subscriber_messages, new_non_subscriber_messages)
         self.assertEqual(new_subscriber_messages, [elt + 1 for elt in old_subscriber_messages])
 
+    def test_stream_message_usermessage_copy(self) -> None:
+        sender = self.example_user("hamlet")
+        content = "@**Cordelia, Lear's daughter** @**all** hello"
+
+        def get_user_message_flags(message_id: int) -> Dict[int, int]:
+            return dict(
+                UserMessage.objects.filter(message_id=message_id).values_list(
+                    "user_profile_id", "flags"
+                )
+            )
+
+        with mock.patch(
+            "zerver.lib.user_message.copy_user_message_rows", wraps=copy_user_message_rows
+        ) as mock_copy:
+            inserted_message_id = self.send_stream_message(sender, "Denmark", content)
+            mock_copy.assert_not_called()
+
+            with mock.patch("zerver.lib.user_message.BULK_INSERT_UMS_COPY_THRESHOLD", 1):
+                copied_message_id = self.send_stream_message(sender, "Denmark", content)
+            mock_copy.assert_called_once()
+
+        copied_flags = get_user_message_flags(copied_message_id)
+        self.assertEqual(copied_flags, get_user_message_flags(inserted_message_id))
+        cordelia = self.example_user("cordelia")
+        self.assertEqual(
+            UserMessage.flags_list_for_flags(copied_flags[cordelia.id]),
+            ["mentioned", "wildcard_mentioned"],
+        )
+
     def test_performance(self) -> None:
         """
         This test is part of the automated test suite, but
@@ -1472,7 +1566,7 @@ class StreamMessagesTest(ZulipTestCase):
         # persistent, so our test can also fail if cache is invalidated
         # during the course of the unit test.
         flush_per_request_caches()
-        with self.assert_database_query_count(13):
+        with self.assert_database_query_count(12):
             check_send_stream_message(
                 sender=sender,
                 client=sending_client,
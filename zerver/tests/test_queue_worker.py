@@ -779,6 +779,40 @@ class WorkerTest(ZulipTestCase):
                     "Timed out in timeout_worker after 1 seconds while fetching URLs for message 15: ['first', 'second']",
                 )
 
+    def test_translation_worker(self) -> None:
+        hamlet = self.example_user("hamlet")
+        othello = self.example_user("othello")
+        message_id = self.send_personal_message(hamlet, othello, "hello")
+
+        fake_client = FakeClient()
+        fake_client.enqueue(
+            "translation",
+            {
+                "message_id": message_id,
+                "message_content": "hello",
+            },
+        )
+        # A stale event, for a message that has since been edited.
+        fake_client.enqueue(
+            "translation",
+            {
+                "message_id": message_id,
+                "message_content": "goodbye",
+            },
+        )
+
+        with simulated_queue_client(fake_client):
+            worker = queue_processors.TranslationWorker()
+            worker.setup()
+            with patch(
+                "zerver.worker.queue_processors.do_translate_message", return_value={"es": "hola"}
+            ) as mock_translate:
+                with self.assertLogs(level="INFO"):
+                    worker.start()
+
+        mock_translate.assert_called_once()
+        self.assertEqual(mock_translate.call_args[0][0].id, message_id)
+
     def test_worker_noname(self) -> None:
         class TestWorker(queue_processors.QueueProcessingWorker):
             def __init__(self) -> None:
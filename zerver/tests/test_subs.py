@@ -5475,7 +5475,7 @@ class SubscriptionAPITest(ZulipTestCase):
         notifications_stream = get_stream(self.streams[0], self.test_realm)
         self.test_realm.notifications_stream_id = notifications_stream.id
         self.test_realm.save()
-        with self.assert_database_query_count(44):
+        with self.assert_database_query_count(43):
             self.common_subscribe_to_streams(
                 self.test_user,
                 [new_streams[2]],
@@ -0,0 +1,330 @@
+from typing import Any, Dict, List, Tuple
+from unittest import mock
+
+import orjson
+import requests
+import responses
+from django.test import override_settings
+
+from zerver.actions.message_translation import (
+    do_fill_message_translations,
+    do_translate_message,
+    get_recipient_ids_by_language,
+)
+from zerver.lib.test_classes import ZulipTestCase
+from zerver.lib.test_helpers import mock_queue_publish
+from zerver.lib.translate import (
+    HTTPTranslationBackend,
+    LocalTranslationBackend,
+    TranslationCache,
+    TranslationServiceError,
+    get_translation_cache_stats,
+    translate_rendered_content,
+    translate_texts,
+    translation_cache,
+)
+from zerver.models import Message, MessageTranslation, UserProfile
+
+
+def fake_translate_batch(texts: List[str], target_language: str) -> List[str]:
+    return [f"{text} ({target_language})" for text in texts]
+
+
+class TranslationCacheTest(ZulipTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        translation_cache.clear()
+
+    def test_lru_eviction(self) -> None:
+        cache = TranslationCache(maxsize=2)
+        cache.set(("one", "es"), "uno")
+        cache.set(("two", "es"), "dos")
+        self.assertEqual(cache.get(("one", "es")), "uno")
+        cache.set(("three", "es"), "tres")
+
+        # "two" was the least recently used entry.
+        self.assertIsNone(cache.get(("two", "es")))
+        self.assertEqual(cache.get(("one", "es")), "uno")
+        self.assertEqual(cache.get(("three", "es")), "tres")
+        self.assertEqual(cache.stats()["size"], 2)
+        self.assertEqual(cache.stats()["hits"], 3)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_translate_message_caching(self) -> None:
+        with mock.patch.object(
+            LocalTranslationBackend, "translate_batch", side_effect=fake_translate_batch
+        ) as mock_translate:
+            self.assertEqual(translate_texts(["hello"], "es"), ["hello (es)"])
+            # Differences in surrounding whitespace don't matter.
+            self.assertEqual(translate_texts([" hello\n"], "es"), ["hello (es)"])
+        mock_translate.assert_called_once_with(["hello"], "es")
+
+        stats = get_translation_cache_stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["remote_misses"], 1)
+
+        # Another process, with an empty local cache, can use the
+        # remote cache.
+        translation_cache.clear()
+        with mock.patch.object(LocalTranslationBackend, "translate_batch") as mock_translate:
+            self.assertEqual(translate_texts(["hello"], "es"), ["hello (es)"])
+        mock_translate.assert_not_called()
+        self.assertEqual(get_translation_cache_stats()["remote_hits"], 1)
+
+        # The target language is part of the key.
+        with mock.patch.object(
+            LocalTranslationBackend, "translate_batch", side_effect=fake_translate_batch
+        ) as mock_translate:
+            self.assertEqual(translate_texts(["hello"], "fr"), ["hello (fr)"])
+        mock_translate.assert_called_once_with(["hello"], "fr")
+
+    def test_translate_texts_batches_misses(self) -> None:
+        translate_texts(["one"], "es")
+        with mock.patch.object(
+            LocalTranslationBackend, "translate_batch", side_effect=fake_translate_batch
+        ) as mock_translate:
+            self.assertEqual(
+                translate_texts(["one", "two", "", "three", "two"], "es"),
+                ["one", "two (es)", "", "three (es)", "two (es)"],
+            )
+        # Only the uncached texts are sent, once each, in one batch.
+        mock_translate.assert_called_once_with(["two", "three"], "es")
+
+
+class TranslateRenderedContentTest(ZulipTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        translation_cache.clear()
+
+    def send_and_get_rendered_content(self, sender: UserProfile, content: str) -> str:
+        message_id = self.send_stream_message(sender, "Denmark", content)
+        rendered_content = Message.objects.get(id=message_id).rendered_content
+        assert rendered_content is not None
+        return rendered_content
+
+    def test_translate_rendered_content(self) -> None:
+        hamlet = self.example_user("hamlet")
+        content = (
+            "Hello @**Cordelia, Lear's daughter**, see [this link](https://example.com) "
+            "and `x = 1` :smile: ok\n"
+            "```\nprint('hi')\n```\n"
+            "> quoted **bold** text"
+        )
+        rendered_content = self.send_and_get_rendered_content(hamlet, content)
+
+        with mock.patch.object(
+            LocalTranslationBackend, "translate_batch", side_effect=fake_translate_batch
+        ) as mock_translate:
+            translated = translate_rendered_content(rendered_content, "es")
+
+        # All of the prose is sent in one batch; whitespace next to
+        # inline elements is preserved.
+        mock_translate.assert_called_once_with(
+            ["Hello", ", see", "and", "ok", "quoted", "bold", "text"], "es"
+        )
+        self.assertIn('<p>Hello (es) <span class="user-mention"', translated)
+        self.assertIn(">this link</a> and (es) <code>x = 1</code>", translated)
+        self.assertIn(":smile:</span> ok (es)</p>", translated)
+        self.assertIn("print('hi')", translated)
+        self.assertIn("<p>quoted (es) <strong>bold (es)</strong> text (es)</p>", translated)
+
+        # Content with no prose at all isn't sent to the backend.
+        rendered_content = self.send_and_get_rendered_content(hamlet, "```\ncode\n```")
+        with mock.patch.object(LocalTranslationBackend, "translate_batch") as mock_translate:
+            self.assertEqual(translate_rendered_content(rendered_content, "es"), rendered_content)
+        mock_translate.assert_not_called()
+
+
+class HTTPTranslationBackendTest(ZulipTestCase):
+    @override_settings(
+        TRANSLATION_SERVICE_URL="https://translate.example.com/translate",
+        TRANSLATION_SERVICE_API_KEY="secret",
+        TRANSLATION_BATCH_SIZE=2,
+    )
+    @responses.activate
+    def test_translate_batch(self) -> None:
+        def callback(request: requests.PreparedRequest) -> Tuple[int, Dict[str, str], bytes]:
+            assert request.body is not None
+            data = orjson.loads(request.body)
+            self.assertEqual(data["target"], "es")
+            self.assertEqual(data["api_key"], "secret")
+            return (200, {}, orjson.dumps({"translatedText": [f"<{q}>" for q in data["q"]]}))
+
+        responses.add_callback(
+            responses.POST, "https://translate.example.com/translate", callback=callback
+        )
+        backend = HTTPTranslationBackend()
+        self.assertEqual(
+            backend.translate_batch(["a", "b", "c"], "es"),
+            ["<a>", "<b>", "<c>"],
+        )
+        # Three texts, in batches of at most two, over one session.
+        self.assert_length(responses.calls, 2)
+
+        responses.replace(
+            responses.POST,
+            "https://translate.example.com/translate",
+            json={"translatedText": ["only one"]},
+        )
+        with self.assertRaises(TranslationServiceError):
+            backend.translate_batch(["a", "b"], "es")
+
+
+class MessageTranslationTest(ZulipTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        translation_cache.clear()
+
+    def test_translate_stream_message_once_per_language(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        othello = self.example_user("othello")
+        iago = self.example_user("iago")
+        for user_profile, language in [(cordelia, "es"), (othello, "es"), (iago, "fr")]:
+            user_profile.preferred_language = language
+            user_profile.save(update_fields=["preferred_language"])
+        for user_profile in [hamlet, cordelia, othello, iago]:
+            self.subscribe(user_profile, "Denmark")
+
+        message_id = self.send_stream_message(hamlet, "Denmark", "hello")
+        message = Message.objects.get(id=message_id)
+
+        with self.assert_database_query_count(1):
+            user_ids_by_language = get_recipient_ids_by_language(message)
+        # The sender doesn't need a translation of their own message.
+        for user_ids in user_ids_by_language.values():
+            self.assertNotIn(hamlet.id, user_ids)
+        self.assertEqual(sorted(user_ids_by_language["es"]), sorted([cordelia.id, othello.id]))
+        self.assertEqual(user_ids_by_language["fr"], [iago.id])
+        # Hamlet writes in English, so recipients who prefer English
+        # read the message as it is.
+        self.assertEqual(hamlet.preferred_language, "en")
+        self.assertNotIn("en", user_ids_by_language)
+
+        with mock.patch.object(
+            LocalTranslationBackend, "translate_batch", side_effect=fake_translate_batch
+        ) as mock_translate, self.capture_send_event_calls(
+            expected_num_events=len(user_ids_by_language)
+        ) as events:
+            translations = do_translate_message(message)
+
+        self.assertEqual(mock_translate.call_count, len(user_ids_by_language))
+        self.assertEqual(translations["es"], "<p>hello (es)</p>")
+        self.assertEqual(translations["fr"], "<p>hello (fr)</p>")
+        for event in events:
+            language = event["event"]["language"]
+            self.assertEqual(event["event"]["rendered_content"], f"<p>hello ({language})</p>")
+            self.assertEqual(sorted(event["users"]), sorted(user_ids_by_language[language]))
+
+        # Each translation is stored, for fetching messages later.
+        self.assertEqual(
+            MessageTranslation.get_translations([message_id], "es"),
+            {message_id: "<p>hello (es)</p>"},
+        )
+        self.assertEqual(
+            MessageTranslation.get_translations([message_id], "fr"),
+            {message_id: "<p>hello (fr)</p>"},
+        )
+
+    def fetch_message(self, message_id: int) -> Dict[str, Any]:
+        result = self.client_get(
+            "/json/messages",
+            dict(anchor=message_id, num_before=0, num_after=0, apply_markdown="true"),
+        )
+        (message,) = self.assert_json_success(result)["messages"]
+        return message
+
+    def test_fetch_messages_fills_translations_lazily(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        message_id = self.send_stream_message(hamlet, "Verona", "hello")
+
+        cordelia.preferred_language = "es"
+        cordelia.save(update_fields=["preferred_language"])
+        self.login_user(cordelia)
+
+        with self.settings(MESSAGE_TRANSLATION_ENABLED=True), mock.patch.object(
+            LocalTranslationBackend, "translate_batch", side_effect=fake_translate_batch
+        ) as mock_translate:
+            # The first fetch returns the original, and queues the
+            # message to be translated for Cordelia.
+            with self.capture_send_event_calls(expected_num_events=1) as events:
+                self.assertEqual(self.fetch_message(message_id)["content"], "<p>hello</p>")
+            self.assertEqual(events[0]["event"]["type"], "translation")
+            self.assertEqual(events[0]["event"]["rendered_content"], "<p>hello (es)</p>")
+            self.assertEqual(events[0]["users"], [cordelia.id])
+
+            # Later fetches use the stored translation.
+            with self.capture_send_event_calls(expected_num_events=0):
+                self.assertEqual(self.fetch_message(message_id)["content"], "<p>hello (es)</p>")
+            result = self.client_get(f"/json/messages/{message_id}")
+            self.assertEqual(
+                self.assert_json_success(result)["message"]["content"], "<p>hello (es)</p>"
+            )
+            self.assertEqual(mock_translate.call_count, 1)
+
+            # Raw Markdown is never translated.
+            result = self.client_get(
+                "/json/messages",
+                dict(anchor=message_id, num_before=0, num_after=0, apply_markdown="false"),
+            )
+            (message,) = self.assert_json_success(result)["messages"]
+            self.assertEqual(message["content"], "hello")
+
+            # Hamlet reads his own message as he wrote it.
+            self.login_user(hamlet)
+            with self.capture_send_event_calls(expected_num_events=0):
+                self.assertEqual(self.fetch_message(message_id)["content"], "<p>hello</p>")
+
+    def test_fill_translations_deduplicated_and_batched(self) -> None:
+        hamlet = self.example_user("hamlet")
+        iago = self.example_user("iago")
+        cordelia = self.example_user("cordelia")
+        for user_profile in [iago, cordelia]:
+            user_profile.preferred_language = "es"
+            user_profile.save(update_fields=["preferred_language"])
+        message_ids = [self.send_stream_message(hamlet, "Verona", f"hello {i}") for i in range(3)]
+        spanish_message_id = self.send_stream_message(iago, "Verona", "hola")
+
+        self.login_user(cordelia)
+        with self.settings(MESSAGE_TRANSLATION_ENABLED=True), mock_queue_publish(
+            "zerver.lib.message.queue_json_publish"
+        ) as m:
+            for i in range(2):
+                result = self.client_get(
+                    "/json/messages",
+                    dict(anchor=message_ids[0], num_before=0, num_after=10, apply_markdown="true"),
+                )
+                self.assert_json_success(result)
+        # Fetching the messages again doesn't queue them again, and
+        # Iago's message is already in Spanish.
+        m.assert_called_once()
+        self.assertEqual(
+            m.call_args[0][1],
+            {"type": "fill", "message_ids": message_ids, "language": "es", "user_id": cordelia.id},
+        )
+
+        with mock.patch.object(
+            LocalTranslationBackend, "translate_batch", side_effect=fake_translate_batch
+        ) as mock_translate, self.capture_send_event_calls(expected_num_events=3):
+            translations = do_fill_message_translations(
+                cordelia, [*message_ids, spanish_message_id], "es"
+            )
+        mock_translate.assert_called_once()
+        self.assertEqual(
+            translations,
+            {message_id: f"<p>hello {i} (es)</p>" for i, message_id in enumerate(message_ids)},
+        )
+
+    def test_edit_message_deletes_translations(self) -> None:
+        hamlet = self.example_user("hamlet")
+        message_id = self.send_stream_message(hamlet, "Verona", "hello")
+        MessageTranslation.objects.create(
+            message_id=message_id, language="es", rendered_content="<p>hola</p>"
+        )
+
+        self.login_user(hamlet)
+        result = self.client_patch(f"/json/messages/{message_id}", {"content": "goodbye"})
+        self.assert_json_success(result)
+        self.assertEqual(MessageTranslation.get_translations([message_id], "es"), {})
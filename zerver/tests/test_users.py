@@ -2126,6 +2126,50 @@ class RecipientInfoTest(ZulipTestCase):
         self.assertEqual(info.followed_topic_push_user_ids, set())
         self.assertEqual(info.stream_wildcard_mention_in_followed_topic_user_ids, set())
 
+    def test_stream_recipient_info_delivery_snapshot(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        realm = hamlet.realm
+
+        stream = self.make_stream("Test stream")
+        topic_name = "test topic"
+        for user in [hamlet, cordelia]:
+            self.subscribe(user, stream.name)
+        recipient = stream.recipient
+        assert recipient is not None
+
+        def get_info() -> RecipientInfoResult:
+            return get_recipient_info(
+                realm_id=realm.id,
+                recipient=recipient,
+                sender_id=hamlet.id,
+                stream_topic=StreamTopicTarget(stream_id=stream.id, topic_name=topic_name),
+                possible_topic_wildcard_mention=False,
+                possible_stream_wildcard_mention=False,
+            )
+
+        info = get_info()
+        self.assertEqual(info.active_user_ids, {hamlet.id, cordelia.id})
+        self.assertEqual(info.stream_push_user_ids, set())
+
+        # Another message to the same topic reuses the stream's
+        # snapshot, and the topic's visibility policies.
+        with self.assert_database_query_count(0):
+            self.assertEqual(get_info(), info)
+
+        # Changes to users' settings, topic visibility policies and
+        # subscriptions are all reflected in the next message.
+        do_change_user_setting(cordelia, "enable_stream_push_notifications", True, acting_user=None)
+        self.assertEqual(get_info().stream_push_user_ids, {cordelia.id})
+
+        do_set_user_topic_visibility_policy(
+            cordelia, stream, topic_name, visibility_policy=UserTopic.VisibilityPolicy.MUTED
+        )
+        self.assertEqual(get_info().stream_push_user_ids, set())
+
+        self.unsubscribe(cordelia, stream.name)
+        self.assertEqual(get_info().active_user_ids, {hamlet.id})
+
     def test_get_recipient_info_invalid_recipient_type(self) -> None:
         hamlet = self.example_user("hamlet")
         realm = hamlet.realm
@@ -18,6 +18,7 @@ def create_tornado_application() -> tornado.web.Application:
 
     urls = (
         r"/notify_tornado",
+        r"/notify_tornado/stats",
         r"/json/events",
         r"/api/v1/events",
         r"/api/v1/events/internal",
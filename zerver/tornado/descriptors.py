@@ -30,3 +30,7 @@ def is_current_port(port: int) -> Optional[int]:
 def set_current_port(port: int) -> None:
     global current_port
     current_port = port
+
+
+def get_current_port() -> Optional[int]:
+    return current_port
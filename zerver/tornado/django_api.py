@@ -1,6 +1,8 @@
+import threading
+import time
 from collections import defaultdict
 from functools import lru_cache
-from typing import Any, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple, Union
+from typing import Any, Dict, FrozenSet, Iterable, List, Mapping, Optional, Sequence, Tuple, Union
 from urllib.parse import urlparse
 
 import orjson
@@ -14,9 +16,9 @@ from urllib3.util import Retry
 from zerver.lib.queue import queue_json_publish
 from zerver.models import Client, Realm, UserProfile
 from zerver.tornado.sharding import (
+    get_hash_ring,
     get_realm_tornado_ports,
     get_tornado_url,
-    get_user_id_tornado_port,
     get_user_tornado_port,
     notify_tornado_queue_name,
 )
@@ -135,10 +137,21 @@ def get_user_events(
     return resp.json()["events"]
 
 
-def send_notification_http(port: int, data: Mapping[str, Any]) -> None:
+# The most notices we send to a Tornado process in one request; each
+# request has to be processed within TornadoAdapter's timeout.
+MAX_NOTIFICATION_BATCH_SIZE = 100
+
+# The number of notices we're currently sending to each Tornado port
+# per request.  When a Tornado process reports that it's falling
+# behind, we halve this, and we double it again (up to
+# MAX_NOTIFICATION_BATCH_SIZE) while it keeps up.
+notification_batch_sizes: Dict[int, int] = defaultdict(lambda: MAX_NOTIFICATION_BATCH_SIZE)
+
+
+def send_notifications_http(port: int, notices: Sequence[Mapping[str, Any]]) -> None:
     if not settings.USING_TORNADO or settings.RUNNING_INSIDE_TORNADO:
         # To allow the backend test suite to not require a separate
-        # Tornado process, we simply call the process_notification
+        # Tornado process, we simply call the process_notifications
         # handler directly rather than making the notify_tornado HTTP
         # request.  It would perhaps be better to instead implement
         # this via some sort of `responses` module configuration, but
@@ -146,15 +159,55 @@ def send_notification_http(port: int, data: Mapping[str, Any]) -> None:
         #
         # We use an import local to this function to prevent this hack
         # from creating import cycles.
-        from zerver.tornado.event_queue import process_notification
+        from zerver.tornado.event_queue import process_notifications
 
-        process_notification(data)
-    else:
-        tornado_url = get_tornado_url(port)
-        requests_client().post(
+        process_notifications(notices)
+        return
+
+    tornado_url = get_tornado_url(port)
+    start = 0
+    while start < len(notices):
+        batch_size = notification_batch_sizes[port]
+        batch = notices[start : start + batch_size]
+        resp = requests_client().post(
             tornado_url + "/notify_tornado",
-            data=dict(data=orjson.dumps(data), secret=settings.SHARED_SECRET),
+            data=dict(data=orjson.dumps(batch), secret=settings.SHARED_SECRET),
         )
+        start += len(batch)
+        if resp.json().get("slow_down", False):
+            notification_batch_sizes[port] = max(1, batch_size // 2)
+        else:
+            notification_batch_sizes[port] = min(MAX_NOTIFICATION_BATCH_SIZE, batch_size * 2)
+
+
+def publish_notices(port: int, notices: List[Dict[str, Any]]) -> None:
+    # Several notices are framed as a single queue item; see
+    # get_wrapped_process_notification.
+    item: Dict[str, Any] = notices[0] if len(notices) == 1 else dict(notices=notices)
+    if settings.USING_RABBITMQ:
+        # Lets Tornado measure how long items wait in its queue.
+        item["published_at"] = time.time()
+    queue_json_publish(
+        notify_tornado_queue_name(port),
+        item,
+        lambda item: send_notifications_http(port, item.get("notices", [item])),
+    )
+
+
+def get_port_notices(
+    realm: Realm, event: Mapping[str, Any], users: Union[Iterable[int], Iterable[Mapping[str, Any]]]
+) -> Dict[int, Dict[str, Any]]:
+    realm_ports = get_realm_tornado_ports(realm)
+    if len(realm_ports) == 1:
+        port_user_map = {realm_ports[0]: list(users)}
+    else:
+        hash_ring = get_hash_ring(tuple(realm_ports))
+        port_user_map = defaultdict(list)
+        for user in users:
+            user_id = user if isinstance(user, int) else user["id"]
+            port_user_map[hash_ring.get_port(user_id)].append(user)
+
+    return {port: dict(event=event, users=port_users) for port, port_users in port_user_map.items()}
 
 
 # The core function for sending an event from Django to Tornado (which
@@ -172,24 +225,89 @@ def send_event(
 ) -> None:
     """`users` is a list of user IDs, or in some special cases like message
     send/update or embeds, dictionaries containing extra data."""
-    realm_ports = get_realm_tornado_ports(realm)
-    if len(realm_ports) == 1:
-        port_user_map = {realm_ports[0]: list(users)}
-    else:
-        port_user_map = defaultdict(list)
-        for user in users:
-            user_id = user if isinstance(user, int) else user["id"]
-            port_user_map[get_user_id_tornado_port(realm_ports, user_id)].append(user)
+    for port, notice in get_port_notices(realm, event, users).items():
+        publish_notices(port, [notice])
 
-    for port, port_users in port_user_map.items():
-        queue_json_publish(
-            notify_tornado_queue_name(port),
-            dict(event=event, users=port_users),
-            lambda *args, **kwargs: send_notification_http(port, *args, **kwargs),
-        )
+
+def send_events(
+    events: Iterable[
+        Tuple[Realm, Mapping[str, Any], Union[Iterable[int], Iterable[Mapping[str, Any]]]]
+    ]
+) -> None:
+    """Like calling send_event for each (realm, event, users) tuple,
+    except that the notices for each Tornado port are published
+    together, as one queue item (or, without RabbitMQ, one request)."""
+    notices_by_port: Dict[int, List[Dict[str, Any]]] = defaultdict(list)
+    for realm, event, users in events:
+        for port, notice in get_port_notices(realm, event, users).items():
+            notices_by_port[port].append(notice)
+    for port, notices in notices_by_port.items():
+        publish_notices(port, notices)
+
+
+class PendingNotices(threading.local):
+    """State for send_event_on_commit.  Each thread has its own
+    database connection, and so its own transactions."""
+
+    def __init__(self) -> None:
+        # Notices from on-commit callbacks which have run, grouped by
+        # Tornado port, which haven't been published yet.
+        self.notices: Dict[int, List[Dict[str, Any]]] = defaultdict(list)
+        # For each on-commit callback which hasn't published yet, in
+        # order, the savepoints that were active when it was
+        # registered; it's discarded if any of them is rolled back.
+        self.callback_savepoints: List[FrozenSet[str]] = []
+        self.first_callback_id = 0
+
+
+pending_notices = PendingNotices()
+
+
+def flush_pending_notices(callback_id: int) -> None:
+    del pending_notices.callback_savepoints[: callback_id + 1 - pending_notices.first_callback_id]
+    pending_notices.first_callback_id = callback_id + 1
+    notices_by_port = dict(pending_notices.notices)
+    pending_notices.notices.clear()
+    for port, notices in notices_by_port.items():
+        publish_notices(port, notices)
 
 
 def send_event_on_commit(
     realm: Realm, event: Mapping[str, Any], users: Union[Iterable[int], Iterable[Mapping[str, Any]]]
 ) -> None:
-    transaction.on_commit(lambda: send_event(realm, event, users))
+    """Like send_event, but only once the current transaction commits.
+
+    All of the events sent this way in a transaction are coalesced
+    into one queue item (or, without RabbitMQ, one request) per
+    Tornado port, rather than one per event.
+    """
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        send_event(realm, event, users)
+        return
+
+    savepoint_ids = frozenset(connection.savepoint_ids)
+    callback_id = pending_notices.first_callback_id + len(pending_notices.callback_savepoints)
+    pending_notices.callback_savepoints.append(savepoint_ids)
+
+    def add_pending_notices() -> None:
+        for port, notice in get_port_notices(realm, event, users).items():
+            pending_notices.notices[port].append(notice)
+
+        # Since this callback ran, none of its savepoints were rolled
+        # back, so a later callback registered inside only some of
+        # them is sure to run too; leave publishing to it.  Otherwise,
+        # this may be the last callback to run, so publish now.  In
+        # the usual case, where events aren't sent from inside
+        # savepoints, only the transaction's last callback publishes.
+        callback_savepoints = pending_notices.callback_savepoints
+        start = callback_id + 1 - pending_notices.first_callback_id
+        for index in range(start, len(callback_savepoints)):
+            if callback_savepoints[index] <= savepoint_ids:
+                return
+        flush_pending_notices(callback_id)
+
+    # Each event is added with its own on-commit callback, so that
+    # events sent inside a savepoint which is rolled back are
+    # discarded, as usual.
+    transaction.on_commit(add_pending_notices)
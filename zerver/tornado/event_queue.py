@@ -1,14 +1,17 @@
 # See https://zulip.readthedocs.io/en/latest/subsystems/events-system.html for
 # high-level documentation on how this system works.
 import copy
+import heapq
 import logging
 import os
 import random
+import shutil
+import sys
 import time
 import traceback
 import uuid
-from collections import deque
-from contextlib import suppress
+from collections import defaultdict, deque
+from contextlib import ExitStack, suppress
 from functools import lru_cache
 from typing import (
     AbstractSet,
@@ -44,8 +47,13 @@ from zerver.lib.narrow_helpers import narrow_dataclasses_from_tuples
 from zerver.lib.notification_data import UserMessageNotificationsData
 from zerver.lib.queue import queue_json_publish, retry_event
 from zerver.middleware import async_request_timer_restart
-from zerver.models import CustomProfileField
-from zerver.tornado.descriptors import clear_descriptor_by_handler_id, set_descriptor_by_handler_id
+from zerver.models import CustomProfileField, Realm
+from zerver.tornado.descriptors import (
+    clear_descriptor_by_handler_id,
+    get_current_port,
+    set_descriptor_by_handler_id,
+)
+from zerver.tornado.event_spill import SpillSegment
 from zerver.tornado.exceptions import BadEventQueueIdError
 from zerver.tornado.handlers import (
     clear_handler_by_id,
@@ -53,13 +61,22 @@ from zerver.tornado.handlers import (
     get_handler_by_id,
     handler_stats_string,
 )
+from zerver.tornado.queue_snapshot import (
+    SnapshotWriter,
+    is_snapshot,
+    read_snapshot,
+    write_snapshot,
+)
+from zerver.tornado.sharding import get_realm_tornado_ports, get_user_id_tornado_port
+from zerver.tornado.stats import notification_batch_stats
 
 # The idle timeout used to be a week, but we found that in that
 # situation, queues from dead browser sessions would grow quite large
 # due to the accumulation of message data in those queues.
 DEFAULT_EVENT_QUEUE_TIMEOUT_SECS = 60 * 10
-# We garbage-collect every minute; this is totally fine given that the
-# GC scan takes ~2ms with 1000 event queues.
+# We garbage-collect every minute; each pass only looks at the queues
+# that were due to expire, using gc_heap, so it's cheap even with a
+# very large number of queues.
 EVENT_QUEUE_GC_FREQ_MSECS = 1000 * 60 * 1
 
 # Capped limit for how long a client can request an event queue
@@ -193,13 +210,13 @@ class ClientDescriptor:
         ret.last_connection_time = d["last_connection_time"]
         return ret
 
-    def add_event(self, event: Mapping[str, Any]) -> None:
+    def add_event(self, event: Mapping[str, Any], size: Optional[int] = None) -> None:
         if self.current_handler_id is not None:
             handler = get_handler_by_id(self.current_handler_id)
             assert handler._request is not None
             async_request_timer_restart(handler._request)
 
-        self.event_queue.push(event)
+        self.event_queue.push(event, size)
         self.finish_current_handler()
 
     def finish_current_handler(self) -> bool:
@@ -300,7 +317,7 @@ class ClientDescriptor:
         # invariant that event queues are idle when passed to
         # `do_gc_event_queues` is preserved.
         self.finish_current_handler()
-        do_gc_event_queues({self.event_queue.id}, {self.user_profile_id}, {self.realm_id})
+        do_gc_event_queues({self.event_queue.id})
 
 
 def compute_full_event_type(event: Mapping[str, Any]) -> str:
@@ -312,18 +329,85 @@ def compute_full_event_type(event: Mapping[str, Any]) -> str:
     return event["type"]
 
 
+def estimate_size(obj: object, seen: Set[int]) -> int:
+    """Approximates the memory used by a JSON-like object, in bytes.
+
+    Objects whose ids are in `seen` are assumed to have been counted
+    already, so objects shared between several events (or queues)
+    are only counted once; every object counted is added to `seen`.
+    """
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += estimate_size(key, seen) + estimate_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        for item in obj:
+            size += estimate_size(item, seen)
+    return size
+
+
+# Roughly the serialized size of a message event, apart from its
+# message payload and flags: mostly its internal_data.
+MESSAGE_EVENT_OVERHEAD_BYTES = 900
+
+
+def get_event_size(event: Mapping[str, Any]) -> Optional[int]:
+    """The size of `event` when serialized, in bytes; this is what it
+    costs to spill the event to disk, and a rough measure of the
+    memory it uses.  Returns None, without serializing the event, if
+    event queues have no memory budget.
+
+    The same event object is usually pushed to many queues; callers
+    which do so compute its size once, and pass it to each push."""
+    if settings.EVENT_QUEUE_MEMORY_BUDGET_BYTES is None:
+        return None
+    return len(orjson.dumps(event))
+
+
+def get_event_spill_dir() -> str:
+    return os.path.join(settings.EVENT_QUEUE_SPILL_DIR, str(get_current_port() or "default"))
+
+
 class EventQueue:
     def __init__(self, id: str) -> None:
         # When extending this list of properties, one must be sure to
         # update to_dict and from_dict.
 
-        self.queue: Deque[Dict[str, Any]] = deque()
+        # Each entry in the queue is an (event_id, event) pair.  The
+        # event is the object passed to push, which is typically
+        # shared between every queue it was pushed to, and so must not
+        # be mutated; the id is merged into it when the queue's
+        # contents are sent to the client.
+        self.queue: Deque[Tuple[int, Mapping[str, Any]]] = deque()
         self.next_event_id: int = 0
         # will only be None for migration from old versions
         self.newest_pruned_id: Optional[int] = -1
         self.id: str = id
         self.virtual_events: Dict[str, Dict[str, Any]] = {}
 
+        # update_message_flags events aren't stored in the queue;
+        # instead, we keep a log of the latest operation for each
+        # (flag, message_id) pair, which contents() turns back into
+        # at most one event per (flag, operation).  See push_flag_event.
+        self.flag_operations: Dict[Tuple[str, int], str] = {}
+        # Maps (flag, operation) to the latest such event, without its
+        # messages; its id is where the compressed event goes in the queue.
+        self.flag_events: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        # The latest message_details for messages marked as unread.
+        self.flag_message_details: Dict[int, Dict[str, Any]] = {}
+
+        # The approximate size of each event in self.queue, and their
+        # total; past settings.EVENT_QUEUE_MEMORY_BUDGET_BYTES, the
+        # oldest events are moved to disk, in self.spilled, and read
+        # back when the client fetches them.  Spilled events are all
+        # older than the events in self.queue.
+        self.event_sizes: Deque[int] = deque()
+        self.memory_bytes = 0
+        self.spilled: Optional[SpillSegment] = None
+
     def to_dict(self) -> Dict[str, Any]:
         # If you add a new key to this dict, make sure you add appropriate
         # migration code in from_dict or load_event_queues to account for
@@ -331,8 +415,10 @@ class EventQueue:
         d = dict(
             id=self.id,
             next_event_id=self.next_event_id,
-            queue=list(self.queue),
-            virtual_events=self.virtual_events,
+            queue=[{**event, "id": event_id} for event_id, event in self.entries()],
+            # Compressed flag events are stored as the virtual events
+            # they'll become, keyed by their full event type.
+            virtual_events={**self.virtual_events, **self.get_flag_virtual_events()},
         )
         if self.newest_pruned_id is not None:
             d["newest_pruned_id"] = self.newest_pruned_id
@@ -343,97 +429,247 @@ class EventQueue:
         ret = cls(d["id"])
         ret.next_event_id = d["next_event_id"]
         ret.newest_pruned_id = d.get("newest_pruned_id", None)
-        ret.queue = deque(d["queue"])
-        ret.virtual_events = d.get("virtual_events", {})
+        for event in d["queue"]:
+            ret.append_entry(event["id"], event)
+        virtual_events = sorted(d.get("virtual_events", {}).items(), key=lambda item: item[1]["id"])
+        for full_event_type, virtual_event in virtual_events:
+            if full_event_type.startswith("flags/"):
+                ret.push_flag_event(virtual_event["id"], virtual_event)
+            else:
+                ret.virtual_events[full_event_type] = virtual_event
+        # A queue dumped at shutdown includes any events it had
+        # spilled, so it may be well over the budget; spill it again
+        # now, rather than holding every restored queue in memory.
+        ret.enforce_memory_budget()
         return ret
 
-    def push(self, orig_event: Mapping[str, Any]) -> None:
-        # By default, we make a shallow copy of the event dictionary
-        # to push into the target event queue; this allows the calling
-        # code to send the same "event" object to multiple queues.
-        # This behavior is important because the event_queue system is
-        # about to mutate the event dictionary, minimally to add the
-        # event_id attribute.
-        event = dict(orig_event)
-        event["id"] = self.next_event_id
+    def push(self, orig_event: Mapping[str, Any], size: Optional[int] = None) -> None:
+        # We don't copy the event; this allows the calling code to
+        # send the same "event" object to many queues, with each
+        # queue only paying for a reference to it and its id here.
+        event_id = self.next_event_id
         self.next_event_id += 1
-        full_event_type = compute_full_event_type(event)
-        if full_event_type == "restart" or (
-            full_event_type.startswith("flags/")
-            and not full_event_type.startswith("flags/remove/read")
-        ):
+        full_event_type = compute_full_event_type(orig_event)
+        if full_event_type == "restart":
             # virtual_events are an optimization that allows certain
-            # simple events, such as update_message_flags events that
-            # simply contain a list of message IDs to operate on, to
-            # be compressed together. This is primarily useful for
-            # flags/add/read, where normal Zulip usage will result in
-            # many small flags/add/read events as users scroll.
-            #
-            # We need to exclude flags/remove/read, because it has an
-            # extra message_details field that cannot be compressed.
+            # simple events to be compressed together; for restart
+            # events, only the latest one matters.
             #
-            # BUG: This compression algorithm is incorrect in the
-            # presence of mark-as-unread, since it does not respect
-            # the ordering of "mark as read" and "mark as unread"
-            # updates for a given message.
+            # Virtual events are modified in place, so unlike other
+            # events, they're copied.
             if full_event_type not in self.virtual_events:
-                self.virtual_events[full_event_type] = copy.deepcopy(event)
+                self.virtual_events[full_event_type] = copy.deepcopy(dict(orig_event))
+                self.virtual_events[full_event_type]["id"] = event_id
                 return
 
             # Update the virtual event with the values from the event
             virtual_event = self.virtual_events[full_event_type]
-            virtual_event["id"] = event["id"]
-            if "timestamp" in event:
-                virtual_event["timestamp"] = event["timestamp"]
-
-            if full_event_type == "restart":
-                virtual_event["server_generation"] = event["server_generation"]
-            elif full_event_type.startswith("flags/"):
-                virtual_event["messages"] += event["messages"]
+            virtual_event["id"] = event_id
+            if "timestamp" in orig_event:
+                virtual_event["timestamp"] = orig_event["timestamp"]
+            virtual_event["server_generation"] = orig_event["server_generation"]
+        elif full_event_type.startswith("flags/"):
+            self.push_flag_event(event_id, orig_event)
         else:
-            self.queue.append(event)
+            if orig_event["type"] == "update_message_flags":
+                # An event for all messages (e.g. marking everything
+                # as read) must be applied after the compressed
+                # events that precede it, and before those that
+                # follow it, so we can't compress across it.
+                self.merge_virtual_events()
+            self.append_entry(event_id, orig_event, size)
+            self.enforce_memory_budget()
+
+    def append_entry(
+        self, event_id: int, event: Mapping[str, Any], size: Optional[int] = None
+    ) -> None:
+        """`size` is the event's size as computed by get_event_size,
+        if the caller already has it."""
+        if size is None:
+            size = get_event_size(event) or 0
+        self.queue.append((event_id, event))
+        self.event_sizes.append(size)
+        self.memory_bytes += size
+
+    def enforce_memory_budget(self) -> None:
+        budget = settings.EVENT_QUEUE_MEMORY_BUDGET_BYTES
+        if budget is not None and self.memory_bytes > budget:
+            self.spill(budget // 2)
+
+    def spill(self, target_bytes: int) -> None:
+        """Moves the oldest events to disk, until the events left in
+        memory take up at most `target_bytes`.  We spill down to well
+        under the budget, so that we write to disk in chunks, rather
+        than on every push.
+
+        This does blocking file I/O on the IOLoop; that's acceptable
+        because it's rare (at most once per budget/2 bytes of events
+        pushed to a given queue) and is a single sequential append to
+        a local file, which costs about as much as serializing the
+        events for a client would."""
+        # Pending virtual events may be older than the events we're
+        # about to spill, so they have to be spilled in order too.
+        self.merge_virtual_events()
+        entries: List[Tuple[int, Mapping[str, Any]]] = []
+        while self.queue and self.memory_bytes > target_bytes:
+            entries.append(self.pop())
+        if self.spilled is None:
+            self.spilled = SpillSegment(os.path.join(get_event_spill_dir(), f"{self.id}.events"))
+        self.spilled.extend(entries)
+
+    def entries(self) -> List[Tuple[int, Mapping[str, Any]]]:
+        """The (event_id, event) pairs in the queue, including any
+        which have been spilled to disk."""
+        if self.spilled is None:
+            return list(self.queue)
+        return [*self.spilled.read(), *self.queue]
+
+    def delete_spilled_events(self) -> None:
+        if self.spilled is not None:
+            self.spilled.delete()
+            self.spilled = None
+
+    def push_flag_event(self, event_id: int, event: Mapping[str, Any]) -> None:
+        """Records an update_message_flags event for specific messages.
+
+        Scrolling through messages generates many small flags/add/read
+        events, which we'd like to send to the client as a single
+        event.  Simply concatenating events of the same type would be
+        incorrect, though: if a message is marked as read, then as
+        unread, the client must end up seeing it as unread.
+
+        Since only the latest operation on a given flag of a given
+        message matters, we only keep the latest one; the compressed
+        events for different (flag, operation) pairs then cover
+        disjoint sets of messages, and so can be sent in any order.
+        """
+        flag = event["flag"]
+        operation = event["operation"]
+        previous = self.flag_events.get((flag, operation))
+        template = {
+            key: value for key, value in event.items() if key not in ("messages", "message_details")
+        }
+        template["id"] = event_id
+        if "message_details" in event or (previous is not None and "message_details" in previous):
+            # Filled in by get_flag_virtual_events.
+            template["message_details"] = {}
+        self.flag_events[(flag, operation)] = template
+
+        message_details = event.get("message_details", {})
+        for message_id in event["messages"]:
+            # Re-inserting moves the message to the end, since it was
+            # updated most recently.
+            self.flag_operations.pop((flag, message_id), None)
+            self.flag_operations[(flag, message_id)] = operation
+            if flag == "read":
+                details = message_details.get(str(message_id))
+                if details is not None:
+                    self.flag_message_details[message_id] = details
+                else:
+                    self.flag_message_details.pop(message_id, None)
+
+    def get_flag_virtual_events(self) -> Dict[str, Dict[str, Any]]:
+        """Turns the compressed flag operations back into events, with
+        at most one event for each (flag, operation) pair."""
+        message_ids: Dict[Tuple[str, str], List[int]] = {}
+        for (flag, message_id), operation in self.flag_operations.items():
+            message_ids.setdefault((flag, operation), []).append(message_id)
+
+        virtual_events: Dict[str, Dict[str, Any]] = {}
+        for (flag, operation), messages in message_ids.items():
+            event = dict(self.flag_events[(flag, operation)])
+            event["messages"] = messages
+            if "message_details" in event:
+                event["message_details"] = {
+                    str(message_id): self.flag_message_details[message_id]
+                    for message_id in messages
+                    if message_id in self.flag_message_details
+                }
+            virtual_events[f"flags/{operation}/{flag}"] = event
+        return virtual_events
+
+    def merge_virtual_events(self) -> None:
+        """Puts the virtual events into their final places in the queue."""
+        virtual_events = [*self.virtual_events.values(), *self.get_flag_virtual_events().values()]
+        self.virtual_events = {}
+        self.flag_operations = {}
+        self.flag_events = {}
+        self.flag_message_details = {}
+        if not virtual_events:
+            return
+
+        virtual_events.sort(key=lambda event: event["id"])
+        entries = list(zip(self.queue, self.event_sizes))
+        self.queue = deque()
+        self.event_sizes = deque()
+        self.memory_bytes = 0
+        index = 0
+        length = len(virtual_events)
+        for (event_id, event), size in entries:
+            while index < length and virtual_events[index]["id"] < event_id:
+                self.append_entry(virtual_events[index]["id"], virtual_events[index])
+                index += 1
+            self.queue.append((event_id, event))
+            self.event_sizes.append(size)
+            self.memory_bytes += size
+        while index < length:
+            self.append_entry(virtual_events[index]["id"], virtual_events[index])
+            index += 1
 
     # Note that pop ignores virtual events.  This is fine in our
     # current usage since virtual events should always be resolved to
     # a real event before being given to users.
-    def pop(self) -> Dict[str, Any]:
+    def pop(self) -> Tuple[int, Mapping[str, Any]]:
+        self.memory_bytes -= self.event_sizes.popleft()
         return self.queue.popleft()
 
     def empty(self) -> bool:
-        return len(self.queue) == 0 and len(self.virtual_events) == 0
+        return (
+            len(self.queue) == 0
+            and self.spilled is None
+            and len(self.virtual_events) == 0
+            and len(self.flag_operations) == 0
+        )
 
     # See the comment on pop; that applies here as well
     def prune(self, through_id: int) -> None:
-        while len(self.queue) != 0 and self.queue[0]["id"] <= through_id:
-            self.newest_pruned_id = self.queue[0]["id"]
+        if self.spilled is not None:
+            newest_pruned_id = self.spilled.prune(through_id)
+            if newest_pruned_id is not None:
+                self.newest_pruned_id = newest_pruned_id
+            if len(self.spilled) == 0:
+                self.spilled = None
+        while len(self.queue) != 0 and self.queue[0][0] <= through_id:
+            self.newest_pruned_id = self.queue[0][0]
             self.pop()
 
     def contents(self, include_internal_data: bool = False) -> List[Dict[str, Any]]:
-        contents: List[Dict[str, Any]] = []
-        virtual_id_map: Dict[str, Dict[str, Any]] = {}
-        for event_type in self.virtual_events:
-            virtual_id_map[self.virtual_events[event_type]["id"]] = self.virtual_events[event_type]
-        virtual_ids = sorted(virtual_id_map.keys())
-
-        # Merge the virtual events into their final place in the queue
-        index = 0
-        length = len(virtual_ids)
-        for event in self.queue:
-            while index < length and virtual_ids[index] < event["id"]:
-                contents.append(virtual_id_map[virtual_ids[index]])
-                index += 1
-            contents.append(event)
-        while index < length:
-            contents.append(virtual_id_map[virtual_ids[index]])
-            index += 1
-
-        self.virtual_events = {}
-        self.queue = deque(contents)
-
+        self.merge_virtual_events()
+        contents = [{**event, "id": event_id} for event_id, event in self.entries()]
         if include_internal_data:
             return contents
         return prune_internal_data(contents)
 
+    def memory_usage(self, seen: Optional[Set[int]] = None) -> int:
+        """Approximates the memory used by this queue's events, in bytes.
+
+        Pass the same `seen` set for every queue to count events (and
+        parts of events) shared between queues only once, charged to
+        the first queue that references them.
+        """
+        if seen is None:
+            seen = set()
+        return sum(
+            estimate_size(data, seen)
+            for data in [
+                self.queue,
+                self.virtual_events,
+                self.flag_operations,
+                self.flag_events,
+                self.flag_message_details,
+            ]
+        )
+
 
 def prune_internal_data(events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """Prunes the internal_data data structures, which are not intended to
@@ -448,10 +684,16 @@ def prune_internal_data(events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
 
 # maps queue ids to client descriptors
 clients: Dict[str, ClientDescriptor] = {}
-# maps user id to list of client descriptors
-user_clients: Dict[int, List[ClientDescriptor]] = {}
-# maps realm id to list of client descriptors with all_public_streams=True
-realm_clients_all_streams: Dict[int, List[ClientDescriptor]] = {}
+# maps user id to set of client descriptors
+user_clients: Dict[int, Set[ClientDescriptor]] = {}
+# maps realm id to set of client descriptors with all_public_streams=True
+realm_clients_all_streams: Dict[int, Set[ClientDescriptor]] = {}
+# A heap of (time, queue id) pairs, with an entry for each client
+# descriptor, at or after the time it could next expire.  A client
+# that has reconnected since its entry was pushed has its entry
+# replaced with a later one when it comes due; entries for queues
+# which have already been removed are skipped.
+gc_heap: List[Tuple[float, str]] = []
 
 # list of registered gc hooks.
 # each one will be called with a user profile id, queue, and bool
@@ -466,6 +708,7 @@ def clear_client_event_queues_for_testing() -> None:
     clients.clear()
     user_clients.clear()
     realm_clients_all_streams.clear()
+    gc_heap.clear()
     gc_hooks.clear()
 
 
@@ -488,18 +731,40 @@ def access_client_descriptor(user_id: int, queue_id: str) -> ClientDescriptor:
     raise BadEventQueueIdError(queue_id)
 
 
-def get_client_descriptors_for_user(user_profile_id: int) -> List[ClientDescriptor]:
-    return user_clients.get(user_profile_id, [])
+def get_client_descriptors_for_user(user_profile_id: int) -> AbstractSet[ClientDescriptor]:
+    return user_clients.get(user_profile_id, frozenset())
+
 
+def get_client_descriptors_for_realm_all_streams(realm_id: int) -> AbstractSet[ClientDescriptor]:
+    return realm_clients_all_streams.get(realm_id, frozenset())
 
-def get_client_descriptors_for_realm_all_streams(realm_id: int) -> List[ClientDescriptor]:
-    return realm_clients_all_streams.get(realm_id, [])
+
+def schedule_gc(client: ClientDescriptor, now: float) -> None:
+    expiry_time = client.last_connection_time + client.queue_timeout
+    if expiry_time <= now:
+        # The client has a handler connected, and so can't expire
+        # until some time after it disconnects; check on it again at
+        # the next GC pass.
+        expiry_time = now + EVENT_QUEUE_GC_FREQ_MSECS / 1000
+    heapq.heappush(gc_heap, (expiry_time, client.event_queue.id))
 
 
 def add_to_client_dicts(client: ClientDescriptor) -> None:
-    user_clients.setdefault(client.user_profile_id, []).append(client)
+    user_clients.setdefault(client.user_profile_id, set()).add(client)
     if client.all_public_streams or client.narrow != []:
-        realm_clients_all_streams.setdefault(client.realm_id, []).append(client)
+        realm_clients_all_streams.setdefault(client.realm_id, set()).add(client)
+    schedule_gc(client, time.time())
+
+
+def remove_from_client_dicts(client: ClientDescriptor) -> None:
+    for client_dict, key in [
+        (user_clients, client.user_profile_id),
+        (realm_clients_all_streams, client.realm_id),
+    ]:
+        if key in client_dict:
+            client_dict[key].discard(client)
+            if not client_dict[key]:
+                del client_dict[key]
 
 
 def allocate_client_descriptor(new_queue_data: MutableMapping[str, Any]) -> ClientDescriptor:
@@ -511,28 +776,13 @@ def allocate_client_descriptor(new_queue_data: MutableMapping[str, Any]) -> Clie
     return client
 
 
-def do_gc_event_queues(
-    to_remove: AbstractSet[str], affected_users: AbstractSet[int], affected_realms: AbstractSet[int]
-) -> None:
-    def filter_client_dict(
-        client_dict: MutableMapping[int, List[ClientDescriptor]], key: int
-    ) -> None:
-        if key not in client_dict:
-            return
-
-        new_client_list = [c for c in client_dict[key] if c.event_queue.id not in to_remove]
-        if len(new_client_list) == 0:
-            del client_dict[key]
-        else:
-            client_dict[key] = new_client_list
-
-    for user_id in affected_users:
-        filter_client_dict(user_clients, user_id)
-
-    for realm_id in affected_realms:
-        filter_client_dict(realm_clients_all_streams, realm_id)
+def do_gc_event_queues(to_remove: AbstractSet[str]) -> None:
+    # Their entries in gc_heap are skipped once they come due.
+    for id in to_remove:
+        remove_from_client_dicts(clients[id])
 
     for id in to_remove:
+        clients[id].event_queue.delete_spilled_events()
         for cb in gc_hooks:
             cb(
                 clients[id].user_profile_id,
@@ -546,17 +796,21 @@ def gc_event_queues(port: int) -> None:
     start = time.time()
     to_remove: Set[str] = set()
     affected_users: Set[int] = set()
-    affected_realms: Set[int] = set()
-    for id, client in clients.items():
+    while gc_heap and gc_heap[0][0] <= start:
+        _, id = heapq.heappop(gc_heap)
+        client = clients.get(id)
+        if client is None:
+            continue
         if client.expired(start):
             to_remove.add(id)
             affected_users.add(client.user_profile_id)
-            affected_realms.add(client.realm_id)
+        else:
+            schedule_gc(client, start)
 
     # We don't need to call e.g. finish_current_handler on the clients
     # being removed because they are guaranteed to be idle (because
     # they are expired) and thus not have a current handler.
-    do_gc_event_queues(to_remove, affected_users, affected_realms)
+    do_gc_event_queues(to_remove)
 
     if settings.PRODUCTION:
         logging.info(
@@ -571,6 +825,25 @@ def gc_event_queues(port: int) -> None:
         )
 
 
+def get_event_queue_memory_stats() -> Dict[str, int]:
+    """Approximate memory usage of all of this process's event queues,
+    for sizing Tornado shards.  This walks every event, so it's too
+    slow to run frequently on a large server."""
+    seen: Set[int] = set()
+    queue_sizes = [client.event_queue.memory_usage(seen) for client in clients.values()]
+    return dict(
+        queues=len(queue_sizes),
+        events=sum(len(client.event_queue.queue) for client in clients.values()),
+        spilled_events=sum(
+            len(client.event_queue.spilled)
+            for client in clients.values()
+            if client.event_queue.spilled is not None
+        ),
+        total_bytes=sum(queue_sizes),
+        max_queue_bytes=max(queue_sizes, default=0),
+    )
+
+
 def persistent_queue_filename(port: int, last: bool = False) -> str:
     if settings.TORNADO_PROCESSES == 1:
         # Use non-port-aware, legacy version.
@@ -584,25 +857,46 @@ def persistent_queue_filename(port: int, last: bool = False) -> str:
 
 def dump_event_queues(port: int) -> None:
     start = time.time()
+    if settings.EVENT_QUEUE_LOG_MEMORY_STATS:
+        # This walks every queued event, so it's off by default, to
+        # keep shutdown (and so restarts) fast.
+        logging.info(
+            "Tornado %d event queue memory usage: %s", port, get_event_queue_memory_stats()
+        )
 
+    # The snapshot is written one queue at a time, so we never hold a
+    # serialized copy of every queue in memory.
     with open(persistent_queue_filename(port), "wb") as stored_queues:
-        stored_queues.write(
-            orjson.dumps([(qid, client.to_dict()) for (qid, client) in clients.items()])
+        num_payloads = write_snapshot(
+            stored_queues, ((qid, client.to_dict()) for (qid, client) in clients.items())
         )
 
     if len(clients) > 0 or settings.PRODUCTION:
         logging.info(
-            "Tornado %d dumped %d event queues in %.3fs", port, len(clients), time.time() - start
+            "Tornado %d dumped %d event queues (%d distinct events) in %.3fs",
+            port,
+            len(clients),
+            num_payloads,
+            time.time() - start,
         )
 
 
+def read_event_queues(filename: str) -> Iterable[Tuple[str, MutableMapping[str, Any]]]:
+    if is_snapshot(filename):
+        return read_snapshot(filename)
+    # TODO/compatibility: Before the snapshot format, event queues
+    # were dumped as a single JSON list.  Remove this once one can no
+    # longer directly upgrade from 8.x to main.
+    with open(filename, "rb") as stored_queues:
+        return orjson.loads(stored_queues.read())
+
+
 def load_event_queues(port: int) -> None:
     global clients
     start = time.time()
 
     try:
-        with open(persistent_queue_filename(port), "rb") as stored_queues:
-            data = orjson.loads(stored_queues.read())
+        data = read_event_queues(persistent_queue_filename(port))
     except FileNotFoundError:
         pass
     except orjson.JSONDecodeError:
@@ -626,6 +920,59 @@ def load_event_queues(port: int) -> None:
         )
 
 
+def rebalance_event_queues(ports: List[int]) -> Dict[int, int]:
+    """Moves the event queues dumped by the (stopped) Tornado processes
+    on `ports` into the dump files for the ports that their users are
+    sharded to now, so that after a change to the sharding
+    configuration, clients can keep using their event queues rather
+    than having to re-register.  Returns the number of queues moved
+    to each port.
+
+    This must only be run while all of those Tornado processes are
+    stopped; a running process would overwrite its dump file on
+    shutdown.
+    """
+    realm_ports: Dict[int, Optional[List[int]]] = {}
+
+    def get_target_port(source_port: int, client_dict: Mapping[str, Any]) -> int:
+        realm_id = client_dict["realm_id"]
+        if realm_id not in realm_ports:
+            realm = Realm.objects.filter(id=realm_id).first()
+            realm_ports[realm_id] = None if realm is None else get_realm_tornado_ports(realm)
+        target_ports = realm_ports[realm_id]
+        if target_ports is None:
+            # The realm is gone; leave the queue for garbage collection.
+            return source_port
+        target_port = get_user_id_tornado_port(target_ports, client_dict["user_profile_id"])
+        return target_port if target_port in ports else source_port
+
+    moved: Dict[int, int] = defaultdict(int)
+    with ExitStack() as stack:
+        writers = {
+            port: SnapshotWriter(
+                stack.enter_context(open(persistent_queue_filename(port) + ".tmp", "wb"))
+            )
+            for port in ports
+        }
+        for source_port in ports:
+            try:
+                data = read_event_queues(persistent_queue_filename(source_port))
+            except FileNotFoundError:
+                continue
+            for queue_id, client_dict in data:
+                target_port = get_target_port(source_port, client_dict)
+                if target_port != source_port:
+                    moved[target_port] += 1
+                writers[target_port].write_queue(queue_id, client_dict)
+
+    # Only replace the dump files once every queue has been written
+    # out to its new home.
+    for port in ports:
+        os.replace(persistent_queue_filename(port) + ".tmp", persistent_queue_filename(port))
+    logging.info("Rebalanced event queues between Tornado ports: %s", dict(moved))
+    return moved
+
+
 def send_restart_events(immediate: bool = False) -> None:
     event: Dict[str, Any] = dict(
         type="restart",
@@ -636,12 +983,17 @@ def send_restart_events(immediate: bool = False) -> None:
     )
     if immediate:
         event["immediate"] = True
+    event_size = get_event_size(event)
     for client in clients.values():
         if client.accepts_event(event):
-            client.add_event(event)
+            client.add_event(event, event_size)
 
 
 async def setup_event_queue(server: tornado.httpserver.HTTPServer, port: int) -> None:
+    # Events spilled to disk by a previous process were written back
+    # into its dump of the event queues, and are loaded from there.
+    shutil.rmtree(get_event_spill_dir(), ignore_errors=True)
+
     if not settings.TEST_SUITE:
         load_event_queues(port)
         autoreload.add_reload_hook(lambda: dump_event_queues(port))
@@ -920,8 +1272,46 @@ class ClientInfo(TypedDict):
     is_sender: bool
 
 
+class MessageEventBatch:
+    """State shared while processing a run of consecutive message
+    events; see process_message_events.
+
+    Processing a message event can't add or remove any client
+    descriptors, so within a batch, we look up each user's clients,
+    and whether the user is off Zulip, at most once.
+    """
+
+    def __init__(self) -> None:
+        self.user_clients: Dict[int, AbstractSet[ClientDescriptor]] = {}
+        self.realm_clients_all_streams: Dict[int, AbstractSet[ClientDescriptor]] = {}
+        self.off_zulip_user_ids: Dict[int, bool] = {}
+
+    def get_client_descriptors_for_user(
+        self, user_profile_id: int
+    ) -> AbstractSet[ClientDescriptor]:
+        if user_profile_id not in self.user_clients:
+            self.user_clients[user_profile_id] = get_client_descriptors_for_user(user_profile_id)
+        return self.user_clients[user_profile_id]
+
+    def get_client_descriptors_for_realm_all_streams(
+        self, realm_id: int
+    ) -> AbstractSet[ClientDescriptor]:
+        if realm_id not in self.realm_clients_all_streams:
+            self.realm_clients_all_streams[realm_id] = get_client_descriptors_for_realm_all_streams(
+                realm_id
+            )
+        return self.realm_clients_all_streams[realm_id]
+
+    def receiver_is_off_zulip(self, user_profile_id: int) -> bool:
+        if user_profile_id not in self.off_zulip_user_ids:
+            self.off_zulip_user_ids[user_profile_id] = receiver_is_off_zulip(user_profile_id)
+        return self.off_zulip_user_ids[user_profile_id]
+
+
 def get_client_info_for_message_event(
-    event_template: Mapping[str, Any], users: Iterable[Mapping[str, Any]]
+    event_template: Mapping[str, Any],
+    users: Iterable[Mapping[str, Any]],
+    batch: Optional[MessageEventBatch] = None,
 ) -> Dict[str, ClientInfo]:
     """
     Return client info for all the clients interested in a message.
@@ -930,6 +1320,9 @@ def get_client_info_for_message_event(
     to all streams, plus users who may be mentioned, etc.
     """
 
+    if batch is None:
+        batch = MessageEventBatch()
+
     send_to_clients: Dict[str, ClientInfo] = {}
 
     sender_queue_id: Optional[str] = event_template.get("sender_queue_id", None)
@@ -941,7 +1334,7 @@ def get_client_info_for_message_event(
     # bots) that are registered to get events for ALL streams.
     if "stream_name" in event_template and not event_template.get("invite_only"):
         realm_id = event_template["realm_id"]
-        for client in get_client_descriptors_for_realm_all_streams(realm_id):
+        for client in batch.get_client_descriptors_for_realm_all_streams(realm_id):
             send_to_clients[client.event_queue.id] = dict(
                 client=client,
                 flags=[],
@@ -952,7 +1345,7 @@ def get_client_info_for_message_event(
         user_profile_id: int = user_data["id"]
         flags: Collection[str] = user_data.get("flags", [])
 
-        for client in get_client_descriptors_for_user(user_profile_id):
+        for client in batch.get_client_descriptors_for_user(user_profile_id):
             send_to_clients[client.event_queue.id] = dict(
                 client=client,
                 flags=flags,
@@ -962,48 +1355,118 @@ def get_client_info_for_message_event(
     return send_to_clients
 
 
+# Usermessage flags which can, on their own, make a stream message
+# notifiable; see UserMessageNotificationsData.from_user_id_sets.
+NOTIFIABLE_MESSAGE_FLAGS = frozenset(["mentioned", "wildcard_mentioned"])
+
+
+def get_message_event_user_id_sets(event_template: Mapping[str, Any]) -> Dict[str, Set[int]]:
+    """
+    Returns the sets of user IDs passed in a message event, keyed by
+    the names of the UserMessageNotificationsData.from_user_id_sets
+    parameters they're passed as.
+    """
+    # TODO/compatibility: Translation code for the rename of
+    # `wildcard_mention_user_ids` to `stream_wildcard_mention_user_ids`.
+    # Remove this when one can no longer directly upgrade from 7.x to main.
+    if "stream_wildcard_mention_user_ids" in event_template:
+        stream_wildcard_mention_user_ids = event_template["stream_wildcard_mention_user_ids"]
+    else:
+        stream_wildcard_mention_user_ids = event_template.get("wildcard_mention_user_ids", [])
+
+    return dict(
+        online_push_user_ids=set(event_template.get("online_push_user_ids", [])),
+        pm_mention_push_disabled_user_ids=set(
+            event_template.get("pm_mention_push_disabled_user_ids", [])
+        ),
+        pm_mention_email_disabled_user_ids=set(
+            event_template.get("pm_mention_email_disabled_user_ids", [])
+        ),
+        stream_push_user_ids=set(event_template.get("stream_push_user_ids", [])),
+        stream_email_user_ids=set(event_template.get("stream_email_user_ids", [])),
+        topic_wildcard_mention_user_ids=set(
+            event_template.get("topic_wildcard_mention_user_ids", [])
+        ),
+        stream_wildcard_mention_user_ids=set(stream_wildcard_mention_user_ids),
+        followed_topic_push_user_ids=set(event_template.get("followed_topic_push_user_ids", [])),
+        followed_topic_email_user_ids=set(event_template.get("followed_topic_email_user_ids", [])),
+        topic_wildcard_mention_in_followed_topic_user_ids=set(
+            event_template.get("topic_wildcard_mention_in_followed_topic_user_ids", [])
+        ),
+        stream_wildcard_mention_in_followed_topic_user_ids=set(
+            event_template.get("stream_wildcard_mention_in_followed_topic_user_ids", [])
+        ),
+        muted_sender_user_ids=set(event_template.get("muted_sender_user_ids", [])),
+        all_bot_user_ids=set(event_template.get("all_bot_user_ids", [])),
+    )
+
+
+def get_notification_candidate_user_ids(
+    users: Iterable[Mapping[str, Any]],
+    user_id_sets: Mapping[str, Set[int]],
+    sender_id: int,
+    private_message: bool,
+    disable_external_notifications: bool,
+) -> Set[int]:
+    """
+    Returns a superset of the recipients of a message who could be
+    notified about it, were they idle, computed with set algebra.
+
+    In a large stream, this is a tiny fraction of the recipients,
+    which lets process_message_event skip building
+    UserMessageNotificationsData for everyone else.  This must be
+    kept in sync with the notification triggers in
+    UserMessageNotificationsData; the exact checks still happen there.
+    """
+    if disable_external_notifications:
+        return set()
+
+    if private_message:
+        candidate_user_ids = {user_data["id"] for user_data in users}
+    else:
+        candidate_user_ids = {
+            user_data["id"]
+            for user_data in users
+            if not NOTIFIABLE_MESSAGE_FLAGS.isdisjoint(user_data.get("flags", []))
+        }
+        candidate_user_ids |= user_id_sets["stream_push_user_ids"]
+        candidate_user_ids |= user_id_sets["stream_email_user_ids"]
+        candidate_user_ids |= user_id_sets["followed_topic_push_user_ids"]
+        candidate_user_ids |= user_id_sets["followed_topic_email_user_ids"]
+
+    candidate_user_ids -= user_id_sets["all_bot_user_ids"]
+    candidate_user_ids -= user_id_sets["muted_sender_user_ids"]
+    candidate_user_ids.discard(sender_id)
+    return candidate_user_ids
+
+
+def process_message_events(
+    message_events: Iterable[Tuple[Mapping[str, Any], Collection[Mapping[str, Any]]]]
+) -> None:
+    """
+    Processes a batch of (event_template, users) message events,
+    sharing a MessageEventBatch between them.
+    """
+    batch = MessageEventBatch()
+    for event_template, users in message_events:
+        process_message_event(event_template, users, batch=batch)
+
+
 def process_message_event(
-    event_template: Mapping[str, Any], users: Collection[Mapping[str, Any]]
+    event_template: Mapping[str, Any],
+    users: Collection[Mapping[str, Any]],
+    batch: Optional[MessageEventBatch] = None,
 ) -> None:
     """See
     https://zulip.readthedocs.io/en/latest/subsystems/sending-messages.html
     for high-level documentation on this subsystem.
     """
-    send_to_clients = get_client_info_for_message_event(event_template, users)
+    if batch is None:
+        batch = MessageEventBatch()
+    send_to_clients = get_client_info_for_message_event(event_template, users, batch)
 
     presence_idle_user_ids = set(event_template.get("presence_idle_user_ids", []))
-    online_push_user_ids = set(event_template.get("online_push_user_ids", []))
-    pm_mention_push_disabled_user_ids = set(
-        event_template.get("pm_mention_push_disabled_user_ids", [])
-    )
-    pm_mention_email_disabled_user_ids = set(
-        event_template.get("pm_mention_email_disabled_user_ids", [])
-    )
-    stream_push_user_ids = set(event_template.get("stream_push_user_ids", []))
-    stream_email_user_ids = set(event_template.get("stream_email_user_ids", []))
-    topic_wildcard_mention_user_ids = set(event_template.get("topic_wildcard_mention_user_ids", []))
-
-    # TODO/compatibility: Translation code for the rename of
-    # `wildcard_mention_user_ids` to `stream_wildcard_mention_user_ids`.
-    # Remove this when one can no longer directly upgrade from 7.x to main.
-    stream_wildcard_mention_user_ids = set()
-    if "stream_wildcard_mention_user_ids" in event_template:
-        stream_wildcard_mention_user_ids = set(
-            event_template.get("stream_wildcard_mention_user_ids", [])
-        )
-    elif "wildcard_mention_user_ids" in event_template:
-        stream_wildcard_mention_user_ids = set(event_template.get("wildcard_mention_user_ids", []))
-
-    followed_topic_push_user_ids = set(event_template.get("followed_topic_push_user_ids", []))
-    followed_topic_email_user_ids = set(event_template.get("followed_topic_email_user_ids", []))
-    topic_wildcard_mention_in_followed_topic_user_ids = set(
-        event_template.get("topic_wildcard_mention_in_followed_topic_user_ids", [])
-    )
-    stream_wildcard_mention_in_followed_topic_user_ids = set(
-        event_template.get("stream_wildcard_mention_in_followed_topic_user_ids", [])
-    )
-    muted_sender_user_ids = set(event_template.get("muted_sender_user_ids", []))
-    all_bot_user_ids = set(event_template.get("all_bot_user_ids", []))
+    user_id_sets = get_message_event_user_id_sets(event_template)
     disable_external_notifications = event_template.get("disable_external_notifications", False)
 
     wide_dict: Dict[str, Any] = event_template["message_dict"]
@@ -1021,6 +1484,7 @@ def process_message_event(
     message_id: int = wide_dict["id"]
     recipient_type_name: str = wide_dict["type"]
     sending_client: str = wide_dict["client"]
+    private_message = recipient_type_name == "private"
 
     @lru_cache(maxsize=None)
     def get_client_payload(apply_markdown: bool, client_gravatar: bool) -> Dict[str, Any]:
@@ -1030,40 +1494,49 @@ def process_message_event(
             client_gravatar=client_gravatar,
         )
 
+    @lru_cache(maxsize=None)
+    def get_client_payload_size(apply_markdown: bool, client_gravatar: bool) -> Optional[int]:
+        return get_event_size(get_client_payload(apply_markdown, client_gravatar))
+
+    # We only need per-user notifications data for users who have a
+    # client on this server to send it to, or who might need to be
+    # notified about the message.
+    client_user_ids = {
+        client_data["client"].user_profile_id for client_data in send_to_clients.values()
+    }
+    notification_candidate_user_ids = get_notification_candidate_user_ids(
+        users, user_id_sets, sender_id, private_message, disable_external_notifications
+    )
+
     # Extra user-specific data to include
     extra_user_data: Dict[int, Any] = {}
 
     for user_data in users:
         user_profile_id: int = user_data["id"]
+        if (
+            user_profile_id not in notification_candidate_user_ids
+            and user_profile_id not in client_user_ids
+        ):
+            continue
+
         flags: Collection[str] = user_data.get("flags", [])
         mentioned_user_group_id: Optional[int] = user_data.get("mentioned_user_group_id")
 
         # If the recipient was offline and the message was a (1:1 or group) direct message
         # to them or they were @-notified potentially notify more immediately
-        private_message = recipient_type_name == "private"
         user_notifications_data = UserMessageNotificationsData.from_user_id_sets(
             user_id=user_profile_id,
             flags=flags,
             private_message=private_message,
             disable_external_notifications=disable_external_notifications,
-            online_push_user_ids=online_push_user_ids,
-            pm_mention_push_disabled_user_ids=pm_mention_push_disabled_user_ids,
-            pm_mention_email_disabled_user_ids=pm_mention_email_disabled_user_ids,
-            stream_push_user_ids=stream_push_user_ids,
-            stream_email_user_ids=stream_email_user_ids,
-            topic_wildcard_mention_user_ids=topic_wildcard_mention_user_ids,
-            stream_wildcard_mention_user_ids=stream_wildcard_mention_user_ids,
-            followed_topic_push_user_ids=followed_topic_push_user_ids,
-            followed_topic_email_user_ids=followed_topic_email_user_ids,
-            topic_wildcard_mention_in_followed_topic_user_ids=topic_wildcard_mention_in_followed_topic_user_ids,
-            stream_wildcard_mention_in_followed_topic_user_ids=stream_wildcard_mention_in_followed_topic_user_ids,
-            muted_sender_user_ids=muted_sender_user_ids,
-            all_bot_user_ids=all_bot_user_ids,
+            **user_id_sets,
         )
 
         # Calling asdict would be slow, as it does a deep copy; pull
-        # the attributes out directly and perform a shallow copy, as
-        # we do intend to adjust the dict.
+        # the attributes out directly into a new dict, which we adjust
+        # below.  It ends up in the events for all of the user's
+        # clients, which their queues share rather than copy (see
+        # EventQueue.push), so it must not change once they're pushed.
         internal_data = {**vars(user_notifications_data)}
 
         # Remove fields sent through other pipes to save some space.
@@ -1075,10 +1548,13 @@ def process_message_event(
         # shouldn't receive notifications even if they were online. In that case we can
         # avoid the more expensive `receiver_is_off_zulip` call, and move on to process
         # the next user.
+        if user_profile_id not in notification_candidate_user_ids:
+            continue
         if not user_notifications_data.is_notifiable(acting_user_id=sender_id, idle=True):
             continue
 
-        idle = receiver_is_off_zulip(user_profile_id) or (user_profile_id in presence_idle_user_ids)
+        off_zulip = batch.receiver_is_off_zulip(user_profile_id)
+        idle = off_zulip or (user_profile_id in presence_idle_user_ids)
 
         extra_user_data[user_profile_id]["internal_data"].update(
             maybe_enqueue_notifications(
@@ -1126,7 +1602,14 @@ def process_message_event(
         if "mirror" in sending_client and sending_client.lower() == client.client_type_name.lower():
             continue
 
-        client.add_event(user_event)
+        # Serializing each client's event just to measure it would be
+        # slow for messages with many recipients; the message payload
+        # is shared between clients, so we measure it once, and
+        # estimate the rest.
+        event_size = get_client_payload_size(client.apply_markdown, client.client_gravatar)
+        if event_size is not None:
+            event_size += MESSAGE_EVENT_OVERHEAD_BYTES + sum(len(flag) + 3 for flag in flags)
+        client.add_event(user_event, event_size)
 
 
 def process_presence_event(event: Mapping[str, Any], users: Iterable[int]) -> None:
@@ -1151,23 +1634,27 @@ def process_presence_event(event: Mapping[str, Any], users: Iterable[int]) -> No
         presence=event["presence"],
     )
 
+    slim_event_size = get_event_size(slim_event)
+    legacy_event_size = get_event_size(legacy_event)
     for user_profile_id in users:
         for client in get_client_descriptors_for_user(user_profile_id):
             if client.accepts_event(event):
                 if client.slim_presence:
-                    client.add_event(slim_event)
+                    client.add_event(slim_event, slim_event_size)
                 else:
-                    client.add_event(legacy_event)
+                    client.add_event(legacy_event, legacy_event_size)
 
 
 def process_event(event: Mapping[str, Any], users: Iterable[int]) -> None:
+    event_size = get_event_size(event)
     for user_profile_id in users:
         for client in get_client_descriptors_for_user(user_profile_id):
             if client.accepts_event(event):
-                client.add_event(event)
+                client.add_event(event, event_size)
 
 
 def process_deletion_event(event: Mapping[str, Any], users: Iterable[int]) -> None:
+    event_size = get_event_size(event)
     for user_profile_id in users:
         for client in get_client_descriptors_for_user(user_profile_id):
             if not client.accepts_event(event):
@@ -1179,7 +1666,7 @@ def process_deletion_event(event: Mapping[str, Any], users: Iterable[int]) -> No
             # required to support bulk_message_deletion in the future;
             # this logic is intended for backwards-compatibility only.
             if client.bulk_message_deletion:
-                client.add_event(event)
+                client.add_event(event, event_size)
                 continue
 
             for message_id in event["message_ids"]:
@@ -1260,7 +1747,9 @@ def process_message_update_event(
     for user_data in users:
         user_profile_id = user_data["id"]
 
-        user_event = dict(event_template)  # shallow copy, but deep enough for our needs
+        # Each user gets their own shallow copy, with their flags; it's
+        # shared by the queues of all of the user's clients.
+        user_event = dict(event_template)
         for key in user_data:
             if key != "id":
                 user_event[key] = user_data[key]
@@ -1306,11 +1795,12 @@ def process_message_update_event(
                 prior_mentioned=(user_profile_id in prior_mention_user_ids),
             )
 
+        user_event_size = get_event_size(user_event)
         for client in get_client_descriptors_for_user(user_profile_id):
             if client.accepts_event(user_event):
-                # We need to do another shallow copy, or we risk
-                # sending the same event to multiple clients.
-                client.add_event(user_event)
+                # Queues don't copy or modify the events pushed to
+                # them, so each client's queue can share user_event.
+                client.add_event(user_event, user_event_size)
 
 
 def process_custom_profile_fields_event(event: Mapping[str, Any], users: Iterable[int]) -> None:
@@ -1323,13 +1813,17 @@ def process_custom_profile_fields_event(event: Mapping[str, Any], users: Iterabl
         type="custom_profile_fields", fields=pronouns_type_unsupported_fields
     )
 
+    event_size = get_event_size(event)
+    pronouns_type_unsupported_event_size = get_event_size(pronouns_type_unsupported_event)
     for user_profile_id in users:
         for client in get_client_descriptors_for_user(user_profile_id):
             if client.accepts_event(event):
                 if not client.pronouns_field_type_supported:
-                    client.add_event(pronouns_type_unsupported_event)
+                    client.add_event(
+                        pronouns_type_unsupported_event, pronouns_type_unsupported_event_size
+                    )
                     continue
-                client.add_event(event)
+                client.add_event(event, event_size)
 
 
 def maybe_enqueue_notifications_for_message_update(
@@ -1440,7 +1934,9 @@ def reformat_legacy_send_message_event(
     return (modern_event, user_dicts)
 
 
-def process_notification(notice: Mapping[str, Any]) -> None:
+def process_notification(
+    notice: Mapping[str, Any], batch: Optional[MessageEventBatch] = None
+) -> None:
     event: Mapping[str, Any] = notice["event"]
     users: Union[List[int], List[Mapping[str, Any]]] = notice["users"]
     start_time = time.time()
@@ -1450,9 +1946,9 @@ def process_notification(notice: Mapping[str, Any]) -> None:
             # TODO/compatibility: Remove this whole block once one can no
             # longer directly upgrade directly from 4.x to 5.0-dev.
             modern_event, user_dicts = reformat_legacy_send_message_event(event, users)
-            process_message_event(modern_event, user_dicts)
+            process_message_event(modern_event, user_dicts, batch)
         else:
-            process_message_event(event, cast(List[Mapping[str, Any]], users))
+            process_message_event(event, cast(List[Mapping[str, Any]], users), batch)
     elif event["type"] == "update_message":
         process_message_update_event(event, cast(List[Mapping[str, Any]], users))
     elif event["type"] == "delete_message":
@@ -1494,6 +1990,11 @@ def process_notification(notice: Mapping[str, Any]) -> None:
     )
 
 
+def process_notifications(notices: Iterable[Mapping[str, Any]]) -> None:
+    for notice in notices:
+        process_notification(notice)
+
+
 def get_wrapped_process_notification(queue_name: str) -> Callable[[List[Dict[str, Any]]], None]:
     def failure_processor(notice: Dict[str, Any]) -> None:
         logging.error(
@@ -1502,11 +2003,32 @@ def get_wrapped_process_notification(queue_name: str) -> Callable[[List[Dict[str
             traceback.format_exc(),
         )
 
-    def wrapped_process_notification(notices: List[Dict[str, Any]]) -> None:
+    def wrapped_process_notification(items: List[Dict[str, Any]]) -> None:
+        start = time.time()
+        notices: List[Dict[str, Any]] = []
+        queue_lags: List[float] = []
+        for item in items:
+            if "published_at" in item:
+                queue_lags.append(start - item["published_at"])
+            # An item is a single notice, or several notices framed
+            # together by publish_notices.
+            notices.extend(item.get("notices", [item]))
+
+        # Runs of consecutive message events share a
+        # MessageEventBatch; any other event may change the set of
+        # clients, and so ends the run.
+        batch: Optional[MessageEventBatch] = None
         for notice in notices:
+            if notice["event"]["type"] == "message":
+                if batch is None:
+                    batch = MessageEventBatch()
+            else:
+                batch = None
             try:
-                process_notification(notice)
+                process_notification(notice, batch)
             except Exception:
                 retry_event(queue_name, notice, failure_processor)
 
+        notification_batch_stats.record_batch(len(notices), time.time() - start, queue_lags)
+
     return wrapped_process_notification
@@ -0,0 +1,72 @@
+# On-disk storage for the oldest events of large event queues.
+#
+# A client that isn't fetching events (e.g. a mobile app in the
+# background) can accumulate a lot of them before its queue is
+# garbage-collected.  Rather than keeping all of that in Tornado's
+# memory, an EventQueue which goes over its memory budget moves its
+# oldest events into a SpillSegment: an append-only file of
+# length-prefixed, orjson-encoded [event_id, event] records, which are
+# read back when the client fetches its events.
+import os
+import struct
+from collections import deque
+from contextlib import suppress
+from typing import Any, Deque, Dict, Iterable, List, Mapping, Optional, Tuple
+
+import orjson
+
+RECORD_HEADER = struct.Struct("!I")
+
+
+class SpillSegment:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        # (event_id, offset, length) for each event in the file which
+        # hasn't been pruned, in order.
+        self.index: Deque[Tuple[int, int, int]] = deque()
+        self.end_offset = 0
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def extend(self, entries: Iterable[Tuple[int, Mapping[str, Any]]]) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "ab") as f:
+            for event_id, event in entries:
+                data = orjson.dumps([event_id, event])
+                f.write(RECORD_HEADER.pack(len(data)))
+                f.write(data)
+                self.index.append((event_id, self.end_offset + RECORD_HEADER.size, len(data)))
+                self.end_offset += RECORD_HEADER.size + len(data)
+
+    def read(self) -> List[Tuple[int, Dict[str, Any]]]:
+        if not self.index:
+            return []
+        start = self.index[0][1]
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            data = f.read(self.end_offset - start)
+        events: List[Tuple[int, Dict[str, Any]]] = []
+        for event_id, offset, length in self.index:
+            stored_id, event = orjson.loads(data[offset - start : offset - start + length])
+            assert stored_id == event_id
+            events.append((event_id, event))
+        return events
+
+    def prune(self, through_id: int) -> Optional[int]:
+        """Forgets the events with ids up to `through_id`, and returns
+        the id of the newest one, if any."""
+        newest_pruned_id = None
+        while self.index and self.index[0][0] <= through_id:
+            newest_pruned_id = self.index.popleft()[0]
+        if not self.index:
+            # The space used by pruned events is only reclaimed once
+            # they've all been pruned.
+            self.delete()
+        return newest_pruned_id
+
+    def delete(self) -> None:
+        self.index.clear()
+        self.end_offset = 0
+        with suppress(FileNotFoundError):
+            os.unlink(self.path)
@@ -0,0 +1,154 @@
+# Serialization of Tornado's event queues across restarts.
+#
+# When Tornado shuts down, it writes out every ClientDescriptor (and
+# its EventQueue), so that clients can resume their event queues
+# after the restart, without having to re-register.  On a large
+# server, that can be hundreds of thousands of queues, and the same
+# event (e.g. a message sent to a large stream) is typically in many
+# of them.
+#
+# The snapshot format is a header followed by a sequence of
+# length-prefixed records:
+#
+#   header:  SNAPSHOT_MAGIC, then the format version (unsigned short)
+#   record:  record type (1 byte), payload length (unsigned int), payload
+#
+# There are two types of record, both with orjson-encoded payloads:
+#
+# * PAYLOAD_RECORD: An event, without its (per-queue) "id".  Payload
+#   records are numbered from 0 in the order they appear, and each
+#   distinct event is written only once, before the first queue that
+#   references it.
+#
+# * QUEUE_RECORD: A [queue_id, client_dict] pair, where client_dict is
+#   ClientDescriptor.to_dict(), except that the events in the queue
+#   are replaced by a list of [event_id, payload_index] pairs.
+#
+# This lets us write the snapshot one queue at a time, rather than
+# building one giant list in memory, and read it back one queue at a
+# time from an mmap of the file, decoding each shared payload once.
+import hashlib
+import mmap
+import os
+import struct
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Tuple
+
+import orjson
+
+SNAPSHOT_MAGIC = b"ZULIPEVQ"
+SNAPSHOT_VERSION = 1
+
+HEADER = struct.Struct(f"!{len(SNAPSHOT_MAGIC)}sH")
+RECORD_HEADER = struct.Struct("!cI")
+
+PAYLOAD_RECORD = b"P"
+QUEUE_RECORD = b"Q"
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def write_record(f: BinaryIO, record_type: bytes, data: bytes) -> None:
+    f.write(RECORD_HEADER.pack(record_type, len(data)))
+    f.write(data)
+
+
+class SnapshotWriter:
+    """Writes a snapshot to `f`, one queue at a time."""
+
+    def __init__(self, f: BinaryIO) -> None:
+        self.f = f
+        # Maps a digest of each payload we've written to its index.
+        self.payload_indexes: Dict[bytes, int] = {}
+        f.write(HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION))
+
+    def write_queue(self, queue_id: str, client_dict: Dict[str, Any]) -> None:
+        event_queue = dict(client_dict["event_queue"])
+        queue_refs: List[Tuple[int, int]] = []
+        for event in event_queue.pop("queue"):
+            payload = orjson.dumps({key: value for key, value in event.items() if key != "id"})
+            digest = hashlib.blake2b(payload, digest_size=16).digest()
+            if digest not in self.payload_indexes:
+                self.payload_indexes[digest] = len(self.payload_indexes)
+                write_record(self.f, PAYLOAD_RECORD, payload)
+            queue_refs.append((event["id"], self.payload_indexes[digest]))
+        event_queue["queue_refs"] = queue_refs
+
+        write_record(
+            self.f,
+            QUEUE_RECORD,
+            orjson.dumps([queue_id, {**client_dict, "event_queue": event_queue}]),
+        )
+
+    @property
+    def num_payloads(self) -> int:
+        return len(self.payload_indexes)
+
+
+def write_snapshot(f: BinaryIO, clients: Iterable[Tuple[str, Dict[str, Any]]]) -> int:
+    """Writes (queue_id, client_dict) pairs to `f`, and returns the
+    number of distinct event payloads written."""
+    writer = SnapshotWriter(f)
+    for queue_id, client_dict in clients:
+        writer.write_queue(queue_id, client_dict)
+    return writer.num_payloads
+
+
+def is_snapshot(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+
+
+def read_snapshot(path: str) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Yields the (queue_id, client_dict) pairs in the snapshot at
+    `path`, in the order they were written.
+
+    Events which were in several queues are decoded once, and share
+    their contents (though not the top-level dict, which has the
+    per-queue event "id") between those queues, as they did before
+    they were written out.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < HEADER.size:
+            raise SnapshotError("Truncated event queue snapshot")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as snapshot:
+            magic, version = HEADER.unpack_from(snapshot, 0)
+            if magic != SNAPSHOT_MAGIC:
+                raise SnapshotError("Not an event queue snapshot")
+            if version != SNAPSHOT_VERSION:
+                raise SnapshotError(f"Unsupported event queue snapshot version {version}")
+
+            # Payloads are decoded lazily, the first time a queue
+            # references them.
+            payload_offsets: List[Tuple[int, int]] = []
+            payloads: Dict[int, Dict[str, Any]] = {}
+
+            def get_payload(index: int) -> Dict[str, Any]:
+                if index not in payloads:
+                    start, end = payload_offsets[index]
+                    payloads[index] = orjson.loads(snapshot[start:end])
+                return payloads[index]
+
+            offset = HEADER.size
+            while offset < len(snapshot):
+                if offset + RECORD_HEADER.size > len(snapshot):
+                    raise SnapshotError("Truncated event queue snapshot")
+                record_type, length = RECORD_HEADER.unpack_from(snapshot, offset)
+                start = offset + RECORD_HEADER.size
+                offset = start + length
+                if offset > len(snapshot):
+                    raise SnapshotError("Truncated event queue snapshot")
+
+                if record_type == PAYLOAD_RECORD:
+                    payload_offsets.append((start, offset))
+                elif record_type == QUEUE_RECORD:
+                    queue_id, client_dict = orjson.loads(snapshot[start:offset])
+                    event_queue = client_dict["event_queue"]
+                    event_queue["queue"] = [
+                        {**get_payload(index), "id": event_id}
+                        for event_id, index in event_queue.pop("queue_refs")
+                    ]
+                    yield queue_id, client_dict
+                else:
+                    raise SnapshotError(f"Unknown event queue snapshot record {record_type!r}")
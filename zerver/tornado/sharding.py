@@ -1,7 +1,10 @@
+import bisect
+import hashlib
 import json
 import os
 import re
-from typing import Dict, List, Pattern, Tuple, Union
+from functools import lru_cache
+from typing import Dict, List, Pattern, Sequence, Tuple, Union
 
 from django.conf import settings
 
@@ -33,8 +36,55 @@ def get_realm_tornado_ports(realm: Realm) -> List[int]:
     return [settings.TORNADO_PORTS[0]]
 
 
+# The number of points each port has on a HashRing.  More points
+# spread users more evenly between ports, at the cost of a larger
+# ring to search.
+HASH_RING_VNODES = 160
+
+
+def ring_hash(key: str) -> int:
+    # This must be stable across processes (unlike Python's hash()),
+    # since Django and every Tornado process must agree on the port
+    # for each user.
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """A consistent-hashing ring, assigning users to the Tornado ports
+    which serve their realm.
+
+    Each port is placed at HASH_RING_VNODES pseudo-random points on
+    the ring, and a user is assigned to the port at the first point
+    after the user's own hash.  Adding a port to a realm only moves
+    the users that the new port's points take over -- about 1/N of
+    them -- from the other ports, rather than reshuffling nearly every
+    user, as `user_id % len(ports)` would; this keeps the number of
+    event queues that have to move between processes small (see
+    rebalance_event_queues).
+    """
+
+    def __init__(self, ports: Sequence[int], vnodes: int = HASH_RING_VNODES) -> None:
+        points = sorted(
+            (ring_hash(f"{port}-{vnode}"), port) for port in set(ports) for vnode in range(vnodes)
+        )
+        self.hashes = [point_hash for point_hash, port in points]
+        self.ports = [port for point_hash, port in points]
+
+    def get_port(self, user_id: int) -> int:
+        index = bisect.bisect(self.hashes, ring_hash(str(user_id)))
+        # Wrap around past the last point on the ring.
+        return self.ports[index % len(self.ports)]
+
+
+@lru_cache(None)
+def get_hash_ring(realm_ports: Tuple[int, ...]) -> HashRing:
+    return HashRing(realm_ports)
+
+
 def get_user_id_tornado_port(realm_ports: List[int], user_id: int) -> int:
-    return realm_ports[user_id % len(realm_ports)]
+    if len(realm_ports) == 1:
+        return realm_ports[0]
+    return get_hash_ring(tuple(realm_ports)).get_port(user_id)
 
 
 def get_user_tornado_port(user: UserProfile) -> int:
@@ -0,0 +1,35 @@
+from typing import Any, Dict, Sequence
+
+from zerver.lib.histogram import Histogram
+
+# Upper bounds of the histogram buckets for the batches of notices
+# that Tornado processes from its notify_tornado queue.
+BATCH_SIZE_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500]
+BATCH_TIME_SECS_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5]
+QUEUE_LAG_SECS_BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60]
+
+
+class NotificationBatchStats:
+    def __init__(self) -> None:
+        self.clear()
+
+    def clear(self) -> None:
+        self.batch_size = Histogram(BATCH_SIZE_BUCKETS)
+        self.batch_time_secs = Histogram(BATCH_TIME_SECS_BUCKETS)
+        self.queue_lag_secs = Histogram(QUEUE_LAG_SECS_BUCKETS)
+
+    def record_batch(self, size: int, wall_time_secs: float, queue_lags: Sequence[float]) -> None:
+        self.batch_size.observe(size)
+        self.batch_time_secs.observe(wall_time_secs)
+        for queue_lag in queue_lags:
+            self.queue_lag_secs.observe(queue_lag)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(
+            batch_size=self.batch_size.to_dict(),
+            batch_time_secs=self.batch_time_secs.to_dict(),
+            queue_lag_secs=self.queue_lag_secs.to_dict(),
+        )
+
+
+notification_batch_stats = NotificationBatchStats()
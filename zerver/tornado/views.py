@@ -1,5 +1,5 @@
 import time
-from typing import Any, Callable, Mapping, Optional, Sequence, TypeVar
+from typing import Any, Callable, List, Mapping, Optional, Sequence, TypeVar, Union
 
 from asgiref.sync import async_to_sync
 from django.conf import settings
@@ -18,12 +18,18 @@ from zerver.lib.validator import (
     check_int,
     check_list,
     check_string,
+    check_union,
     to_non_negative_int,
 )
 from zerver.models import Client, UserProfile, get_client, get_user_profile_by_id
 from zerver.tornado.descriptors import is_current_port
-from zerver.tornado.event_queue import access_client_descriptor, fetch_events, process_notification
+from zerver.tornado.event_queue import (
+    access_client_descriptor,
+    fetch_events,
+    process_notifications,
+)
 from zerver.tornado.sharding import get_user_tornado_port, notify_tornado_queue_name
+from zerver.tornado.stats import notification_batch_stats
 
 P = ParamSpec("P")
 T = TypeVar("T")
@@ -36,13 +42,32 @@ def in_tornado_thread(f: Callable[P, T]) -> Callable[P, T]:
     return async_to_sync(wrapped)
 
 
+# If processing a batch of notices takes longer than this, we ask
+# Django to send us smaller batches; see send_notifications_http.
+SLOW_NOTIFY_BATCH_SECS = 0.1
+
+
 @internal_notify_view(True)
 @has_request_variables
 def notify(
-    request: HttpRequest, data: Mapping[str, Any] = REQ(json_validator=check_dict([]))
+    request: HttpRequest,
+    data: Union[Mapping[str, Any], List[Mapping[str, Any]]] = REQ(
+        json_validator=check_union([check_dict([]), check_list(check_dict([]))])
+    ),
 ) -> HttpResponse:
-    in_tornado_thread(process_notification)(data)
-    return json_success(request)
+    # `data` is either a single notice, or a list of them.
+    notices = data if isinstance(data, list) else [data]
+    start = time.time()
+    in_tornado_thread(process_notifications)(notices)
+    return json_success(request, data={"slow_down": time.time() - start > SLOW_NOTIFY_BATCH_SECS})
+
+
+@internal_notify_view(True)
+def get_notification_stats(request: HttpRequest) -> HttpResponse:
+    """Histograms of the size, processing time, and queueing delay of
+    the batches of notices this Tornado process has processed from its
+    notify_tornado queue."""
+    return json_success(request, data=notification_batch_stats.to_dict())
 
 
 @has_request_variables
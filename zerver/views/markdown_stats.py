@@ -0,0 +1,21 @@
+from django.http import HttpRequest, HttpResponse
+
+from zerver.decorator import internal_notify_view
+from zerver.lib.markdown import get_markdown_engine_stats
+from zerver.lib.markdown.stats import markdown_render_stats
+from zerver.lib.response import json_success
+
+
+@internal_notify_view(False)
+def get_markdown_stats(request: HttpRequest) -> HttpResponse:
+    """Histograms of the time this Django process has spent rendering
+    messages, in total and in each stage of the Markdown processor, and
+    statistics on the Markdown engines it has built.
+
+    These are not aggregated across processes: with several uwsgi
+    workers, each request reports the stats of whichever worker
+    happens to serve it."""
+    return json_success(
+        request,
+        data=dict(markdown_render_stats.to_dict(), engines=get_markdown_engine_stats()),
+    )
@@ -200,9 +200,12 @@ def json_fetch_raw_message(
         (message, user_message) = access_message(maybe_user_profile, message_id)
 
     flags = ["read"]
+    user_profile: Optional[UserProfile] = None
     if not maybe_user_profile.is_authenticated:
         allow_edit_history = realm.allow_edit_history
     else:
+        assert isinstance(maybe_user_profile, UserProfile)
+        user_profile = maybe_user_profile
         if user_message:
             flags = user_message.flags_list()
         else:
@@ -219,6 +222,7 @@ def json_fetch_raw_message(
         apply_markdown=apply_markdown,
         client_gravatar=True,
         allow_edit_history=allow_edit_history,
+        user_profile=user_profile,
     )
     response = dict(
         message=message_dict_list[0],
@@ -1,25 +1,41 @@
 from email.headerregistry import Address
-from typing import Iterable, Optional, Sequence, Union, cast
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Union, cast
 
+import orjson
 from django.core import validators
 from django.core.exceptions import ValidationError
 from django.http import HttpRequest, HttpResponse
 from django.utils.translation import gettext as _
 
 from zerver.actions.message_send import (
+    check_message,
     check_send_message,
     compute_irc_user_fullname,
     compute_jabber_user_fullname,
     create_mirror_user_if_needed,
+    do_send_messages,
     extract_private_recipients,
     extract_stream_indicator,
+    render_incoming_messages,
 )
+from zerver.lib.addressee import Addressee
 from zerver.lib.exceptions import JsonableError
-from zerver.lib.message import render_markdown
+from zerver.lib.mention import MentionBackend
+from zerver.lib.message import SendMessageRequest, render_markdown
+from zerver.lib.rate_limiter import rate_limit_user
 from zerver.lib.request import REQ, RequestNotes, has_request_variables
 from zerver.lib.response import json_success
 from zerver.lib.topic import REQ_topic
-from zerver.lib.validator import check_string_in, to_float
+from zerver.lib.validator import (
+    Validator,
+    check_dict_only,
+    check_int,
+    check_list,
+    check_string,
+    check_string_in,
+    check_union,
+    to_float,
+)
 from zerver.lib.zcommand import process_zcommands
 from zerver.lib.zephyr import compute_mit_user_fullname
 from zerver.models import (
@@ -106,7 +122,7 @@ def same_realm_irc_user(user_profile: UserProfile, email: str) -> bool:
 
     domain = Address(addr_spec=email).domain.lower()
     if domain.startswith("irc."):
-        domain = domain[len("irc."):]
+        domain = domain[len("irc.") :]
 
     # Assumes allow_subdomains=False for all RealmDomain's corresponding to
     # these realms.
@@ -128,6 +144,33 @@ def same_realm_jabber_user(user_profile: UserProfile, email: str) -> bool:
     return RealmDomain.objects.filter(realm=user_profile.realm, domain=domain).exists()
 
 
+def extract_message_to(
+    recipient_type_name: str, req_to: Optional[str]
+) -> Union[Sequence[int], Sequence[str]]:
+    # If req_to is None, then we default to an
+    # empty list of recipients.
+    message_to: Union[Sequence[int], Sequence[str]] = []
+
+    if req_to is not None:
+        if recipient_type_name == "stream":
+            stream_indicator = extract_stream_indicator(req_to)
+
+            # For legacy reasons check_send_message expects
+            # a list of streams, instead of a single stream.
+            #
+            # Also, mypy can't detect that a single-item
+            # list populated from a Union[int, str] is actually
+            # a Union[Sequence[int], Sequence[str]].
+            if isinstance(stream_indicator, int):
+                message_to = [stream_indicator]
+            else:
+                message_to = [stream_indicator]
+        else:
+            message_to = extract_private_recipients(req_to)
+
+    return message_to
+
+
 @has_request_variables
 def send_message_backend(
     request: HttpRequest,
@@ -151,26 +194,7 @@ def send_message_backend(
         # message (created, schdeduled, drafts) objects/dicts.
         recipient_type_name = "private"
 
-    # If req_to is None, then we default to an
-    # empty list of recipients.
-    message_to: Union[Sequence[int], Sequence[str]] = []
-
-    if req_to is not None:
-        if recipient_type_name == "stream":
-            stream_indicator = extract_stream_indicator(req_to)
-
-            # For legacy reasons check_send_message expects
-            # a list of streams, instead of a single stream.
-            #
-            # Also, mypy can't detect that a single-item
-            # list populated from a Union[int, str] is actually
-            # a Union[Sequence[int], Sequence[str]].
-            if isinstance(stream_indicator, int):
-                message_to = [stream_indicator]
-            else:
-                message_to = [stream_indicator]
-        else:
-            message_to = extract_private_recipients(req_to)
+    message_to = extract_message_to(recipient_type_name, req_to)
 
     # Temporary hack: We're transitioning `forged` from accepting
     # `yes` to accepting `true` like all of our normal booleans.
@@ -246,6 +270,115 @@ def send_message_backend(
     return json_success(request, data={"id": ret})
 
 
+MAX_BULK_SEND_MESSAGES = 100
+
+check_bulk_messages: Validator[
+    List[Dict[str, Union[int, str, List[Union[int, str]]]]]
+] = check_list(
+    check_dict_only(
+        [
+            ("type", check_string_in(Message.API_RECIPIENT_TYPES)),
+            ("content", check_string),
+        ],
+        [
+            (
+                "to",
+                check_union(
+                    [check_string, check_int, check_list(check_union([check_int, check_string]))]
+                ),
+            ),
+            ("topic", check_string),
+            ("local_id", check_string),
+            ("queue_id", check_string),
+        ],
+    )
+)
+
+
+@has_request_variables
+def send_messages_bulk_backend(
+    request: HttpRequest,
+    user_profile: UserProfile,
+    messages: List[Dict[str, Any]] = REQ(json_validator=check_bulk_messages),
+) -> HttpResponse:
+    """Sends several messages from the current user, with a single
+    do_send_messages call, so that they're saved in one transaction
+    and delivered to Tornado in one batch of notices.
+
+    Each message is validated separately; the response has a result
+    for each message, in order, and an invalid message doesn't
+    prevent the others from being sent.
+    """
+    if len(messages) > MAX_BULK_SEND_MESSAGES:
+        raise JsonableError(
+            _("Too many messages; at most {max_messages} may be sent at once.").format(
+                max_messages=MAX_BULK_SEND_MESSAGES
+            )
+        )
+
+    # The request itself has been charged against the user's rate
+    # limit once already; charge it once for each further message, so
+    # that sending messages in bulk doesn't get around the limit.
+    for i in range(len(messages) - 1):
+        rate_limit_user(request, user_profile, domain="api_by_user")
+
+    client = RequestNotes.get_notes(request).client
+    assert client is not None
+    if client.name in ["zephyr_mirror", "irc_mirror", "jabber_mirror", "JabberMirror"]:
+        raise JsonableError(_("Mirrored messages cannot be sent in bulk"))
+
+    realm = user_profile.realm
+    # Shared between the messages, so that users and groups mentioned
+    # in several of them are only looked up once.
+    mention_backend = MentionBackend(realm.id)
+    # Rendering dominates the cost of checking a message, so we render
+    # them all up front, in parallel.
+    prerendered_messages = render_incoming_messages(
+        realm, user_profile, [message["content"] for message in messages], mention_backend
+    )
+
+    results: List[Dict[str, Any]] = []
+    send_requests: List[SendMessageRequest] = []
+    for message, prerendered in zip(messages, prerendered_messages):
+        recipient_type_name = message["type"]
+        if recipient_type_name == "direct":
+            recipient_type_name = "private"
+        req_to = message.get("to")
+        if req_to is not None and not isinstance(req_to, str):
+            req_to = orjson.dumps(req_to).decode()
+
+        try:
+            message_to = extract_message_to(recipient_type_name, req_to)
+            addressee = Addressee.legacy_build(
+                user_profile, recipient_type_name, message_to, message.get("topic")
+            )
+            send_request = check_message(
+                user_profile,
+                client,
+                addressee,
+                message["content"],
+                realm,
+                forwarder_user_profile=user_profile,
+                local_id=message.get("local_id"),
+                sender_queue_id=message.get("queue_id"),
+                mention_backend=mention_backend,
+                prerendered=prerendered,
+            )
+        except JsonableError as e:
+            results.append(dict(result="error", msg=e.msg, code=e.code.name))
+            continue
+
+        results.append(dict(result="success"))
+        send_requests.append(send_request)
+
+    message_ids = iter(do_send_messages(send_requests) if send_requests else [])
+    for result in results:
+        if result["result"] == "success":
+            result["id"] = next(message_ids)
+
+    return json_success(request, data={"messages": results})
+
+
 @has_request_variables
 def zcommand_backend(
     request: HttpRequest, user_profile: UserProfile, command: str = REQ("command")
@@ -47,9 +47,14 @@ from sentry_sdk import add_breadcrumb, configure_scope
 from zulip_bots.lib import extract_query_without_mention
 
 from zerver.actions.invites import do_send_confirmation_email
-from zerver.actions.message_edit import do_update_embedded_data
+from zerver.actions.message_edit import do_rerender_degraded_message, do_update_embedded_data
 from zerver.actions.message_flags import do_mark_stream_messages_as_read
+from zerver.actions.message_rerender import process_rerender_messages_event
 from zerver.actions.message_send import internal_send_private_message, render_incoming_message
+from zerver.actions.message_translation import (
+    do_fill_message_translations,
+    do_translate_message,
+)
 from zerver.actions.presence import do_update_user_presence
 from zerver.actions.realm_export import notify_realm_export
 from zerver.actions.user_activity import do_update_user_activity, do_update_user_activity_interval
@@ -912,6 +917,65 @@ class FetchLinksEmbedData(QueueProcessingWorker):
         raise InterruptConsumeError
 
 
+@assign_queue("translation")
+class TranslationWorker(QueueProcessingWorker):
+    # Like embed_links, this is a slow queue with network requests to
+    # the translation service, so a disk write is negligible.
+    CONSUME_ITERATIONS_BEFORE_UPDATE_STATS_NUM = 1
+
+    def consume(self, event: Mapping[str, Any]) -> None:
+        if event.get("type") == "fill":
+            # A user fetched messages which haven't been translated
+            # into their preferred language yet.
+            user_profile = get_user_profile_by_id(event["user_id"])
+            start_time = time.time()
+            filled = do_fill_message_translations(
+                user_profile, event["message_ids"], event["language"]
+            )
+            logging.info(
+                "Time spent filling %s translations into %s for user %s: %s",
+                len(filled),
+                event["language"],
+                user_profile.id,
+                time.time() - start_time,
+            )
+            return
+
+        try:
+            message = Message.objects.select_related("realm").get(id=event["message_id"])
+        except Message.DoesNotExist:
+            # Message may have been deleted
+            return
+
+        # If the message was edited before we got to it, the
+        # translation we'd compute is already stale.
+        if message.content != event["message_content"]:
+            return
+
+        start_time = time.time()
+        translations = do_translate_message(message)
+        logging.info(
+            "Time spent translating message %s into %s languages: %s",
+            message.id,
+            len(translations),
+            time.time() - start_time,
+        )
+
+    def timer_expired(
+        self, limit: int, events: List[Dict[str, Any]], signal: int, frame: FrameType
+    ) -> None:
+        assert len(events) == 1
+        event = events[0]
+
+        logging.warning(
+            "Timed out in %s after %s seconds while translating messages %s",
+            self.queue_name,
+            limit,
+            event.get("message_ids", [event.get("message_id")]),
+        )
+        raise InterruptConsumeError
+
+
 @assign_queue("outgoing_webhooks")
 class OutgoingWebhookWorker(QueueProcessingWorker):
     def consume(self, event: Dict[str, Any]) -> None:
@@ -1128,6 +1192,15 @@ class DeferredWorker(QueueProcessingWorker):
             )
             user_profile = get_user_profile_by_id(event["user_profile_id"])
             reactivate_user_if_soft_deactivated(user_profile)
+        elif event["type"] == "rerender_messages":
+            # Queued after changes, such as to linkifiers, which affect
+            # how a realm's existing messages render.  Each event
+            # handles part of the job, and queues the rest.
+            process_rerender_messages_event(event)
+        elif event["type"] == "rerender_degraded_message":
+            # Queued when a message is sent with a degraded rendering,
+            # because it took too long to render in full.
+            do_rerender_degraded_message(event["message_id"])
 
         end = time.time()
         logger.info(
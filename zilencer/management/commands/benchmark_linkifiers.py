@@ -0,0 +1,116 @@
+from timeit import default_timer as timer
+from typing import Any, Callable, List
+
+import re2
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.lib.markdown import (
+    DEFAULT_MARKDOWN_KEY,
+    MarkdownRenderTask,
+    md_engine_stats,
+    prepare_linkifier_pattern,
+    render_markdown_task,
+)
+from zerver.lib.markdown.linkifiers import LinkifierPrefilter
+from zerver.lib.types import LinkifierDict
+
+CONTENT = """\
+Deploy of build 4521 failed on staging; see PROJ{last}-8812 for the
+rollback plan.  The flaky test is tracked in PROJ0-77, and
+https://ci.example.com/builds/4521 has the full logs.
+
+* Retry the migration once the lock is released
+* Check the **replica lag** before re-enabling writes
+"""
+
+
+def make_linkifiers(count: int) -> List[LinkifierDict]:
+    return [
+        LinkifierDict(
+            pattern=f"PROJ{i}-(?P<id>[0-9]+)",
+            url_template=f"https://tracker.example.com/proj{i}/{{id}}",
+            id=i,
+        )
+        for i in range(count)
+    ]
+
+
+def best_time(function: Callable[[], object], reps: int) -> float:
+    best = float("inf")
+    for _ in range(reps):
+        start = timer()
+        function()
+        best = min(best, timer() - start)
+    return best
+
+
+class Command(BaseCommand):
+    help = """Times matching realm linkifiers against a typical message.
+
+Compares searching with each linkifier's regex in turn against the
+LinkifierPrefilter, which scans the text once and only runs the
+regexes of linkifiers which could match, and times building a
+Markdown engine with that many linkifiers, and rendering the message
+with it."""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--linkifiers",
+            help="Numbers of linkifiers to benchmark with",
+            default=[10, 100, 1000],
+            nargs="+",
+            type=int,
+        )
+        parser.add_argument("--reps", help="Iterations of each measurement", default=20, type=int)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        options_re2 = re2.Options()
+        options_re2.log_errors = False
+
+        print(
+            f"{'Linkifiers':>10} {'Each regex (us)':>16} {'Prefiltered (us)':>17}"
+            f" {'Speedup':>8} {'Build (ms)':>11} {'Render (ms)':>12}"
+        )
+        for count in options["linkifiers"]:
+            linkifiers = make_linkifiers(count)
+            content = CONTENT.format(last=count - 1)
+            patterns = [linkifier["pattern"] for linkifier in linkifiers]
+            compiled = [
+                re2.compile(prepare_linkifier_pattern(pattern), options=options_re2)
+                for pattern in patterns
+            ]
+            prefilter = LinkifierPrefilter(patterns)
+
+            def search_each() -> None:
+                for regex in compiled:
+                    regex.search(content)
+
+            def search_prefiltered() -> None:
+                # Clear the prefilter's memo of the last text it saw.
+                prefilter.last_text = None
+                for index in prefilter.candidates(content):
+                    compiled[index].search(content)
+
+            task = MarkdownRenderTask(
+                content=content,
+                linkifiers_key=DEFAULT_MARKDOWN_KEY,
+                linkifiers=linkifiers,
+                email_gateway=False,
+                message_realm=None,
+                db_data=None,
+                image_preview_enabled=False,
+                url_embed_preview_enabled=False,
+                url_embed_data=None,
+                logging_message_id="benchmark",
+            )
+            # Build the engine before timing renders.
+            render_markdown_task(task)
+            build = md_engine_stats.last_build_time
+
+            each = best_time(search_each, options["reps"])
+            prefiltered = best_time(search_prefiltered, options["reps"])
+            render = best_time(lambda: render_markdown_task(task), options["reps"])
+            print(
+                f"{count:>10} {each * 10**6:>16.1f} {prefiltered * 10**6:>17.1f}"
+                f" {each / prefiltered:>7.1f}x {build * 1000:>11.1f} {render * 1000:>12.2f}"
+            )
@@ -0,0 +1,65 @@
+from timeit import default_timer as timer
+from typing import Any, Callable, Dict
+
+from django.core.management.base import BaseCommand, CommandParser
+from django.db import transaction
+from django.db.models import Max
+
+from zerver.lib.user_message import (
+    BULK_INSERT_UMS_COPY_THRESHOLD,
+    UserMessageRows,
+    copy_user_message_rows,
+    insert_user_message_rows,
+)
+from zerver.models import Message, UserProfile
+
+
+class Command(BaseCommand):
+    help = """Times inserting UserMessage rows with a multi-row INSERT and with COPY.
+
+Rows are inserted for a single existing message, for made-up user
+IDs, in a transaction which is then rolled back; the database is left
+unchanged."""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--recipients",
+            help="Numbers of recipients to insert rows for",
+            default=[10, 100, 1000, 5000, 20000, 50000],
+            nargs="+",
+            type=int,
+        )
+        parser.add_argument("--reps", help="Iterations of each insert", default=5, type=int)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        message_id = Message.objects.latest("id").id
+        # Foreign keys are only checked at commit, which never
+        # happens, so we can use IDs past the end of the real users
+        # without conflicting with any real rows.
+        first_user_id = (UserProfile.objects.aggregate(Max("id"))["id__max"] or 0) + 1
+        methods: Dict[str, Callable[[UserMessageRows], None]] = {
+            "INSERT": insert_user_message_rows,
+            "COPY": copy_user_message_rows,
+        }
+
+        print(f"Current threshold for COPY: {BULK_INSERT_UMS_COPY_THRESHOLD} rows")
+        print(f"{'Recipients':>10} {'INSERT (ms)':>12} {'COPY (ms)':>12} {'Speedup':>8}")
+        for count in options["recipients"]:
+            rows = UserMessageRows()
+            for user_id in range(first_user_id, first_user_id + count):
+                rows.append(user_id, message_id, 0)
+
+            best: Dict[str, float] = {}
+            for name, method in methods.items():
+                for _ in range(options["reps"]):
+                    with transaction.atomic():
+                        start = timer()
+                        method(rows)
+                        duration = timer() - start
+                        transaction.set_rollback(True)
+                    best[name] = min(best.get(name, duration), duration)
+
+            print(
+                f"{count:>10} {best['INSERT'] * 1000:>12.2f} {best['COPY'] * 1000:>12.2f}"
+                f" {best['INSERT'] / best['COPY']:>7.2f}x"
+            )
@@ -174,6 +174,22 @@ USER_STATE_SIZE_LIMIT = 10000000
 # Max size of a single configuration entry of an embedded bot.
 BOT_CONFIG_SIZE_LIMIT = 10000
 
+# Message translation
+MESSAGE_TRANSLATION_ENABLED = True
+# Which service to use to translate messages: "translate" (the
+# `translate` Python package), "http" (a LibreTranslate-compatible
+# service at TRANSLATION_SERVICE_URL), or "local" (an offline
+# stand-in, which leaves text untranslated).
+TRANSLATION_BACKEND: Literal["http", "local", "translate"] = "translate"
+TRANSLATION_SERVICE_URL: Optional[str] = None
+TRANSLATION_SERVICE_API_KEY = get_secret("translation_service_api_key")
+TRANSLATION_SERVICE_TIMEOUT_SECONDS = 10
+# Maximum number of texts sent to the translation service per request.
+TRANSLATION_BATCH_SIZE = 100
+# Maximum number of translations cached in each process, in front of
+# the remote cache.
+TRANSLATION_CACHE_SIZE = 1000
+
 # External service configuration
 CAMO_URI = ""
 MEMCACHED_LOCATION = "127.0.0.1:11211"
@@ -191,6 +207,13 @@ THUMBNAIL_IMAGES = False
 
 TORNADO_PORTS: List[int] = []
 USING_TORNADO = True
+# Past this many bytes of events, an event queue writes its oldest
+# events out to disk, until they're fetched; None disables this.
+EVENT_QUEUE_MEMORY_BUDGET_BYTES: Optional[int] = None
+# Whether Tornado logs how much memory its event queues use, when
+# dumping them at shutdown; this walks every queued event, and so
+# slows down restarts.
+EVENT_QUEUE_LOG_MEMORY_STATS = False
 
 # ToS/Privacy templates
 POLICIES_DIRECTORY: str = "zerver/policies_absent"
@@ -556,6 +579,21 @@ NAGIOS_BOT_HOST = EXTERNAL_HOST
 # Use half of the available CPUs for data import purposes.
 DEFAULT_DATA_EXPORT_IMPORT_PARALLELISM = (len(os.sched_getaffinity(0)) // 2) or 1
 
+# Worker processes each Django process may use to render the Markdown
+# of several messages sent at once; 1 renders them in-process.
+MARKDOWN_RENDER_PROCESSES = 1
+
+# Whether to cache the rendering of message content which doesn't
+# mention anyone or anything; integrations often send identical
+# content many times.
+CACHE_RENDERED_MESSAGE_CONTENT = True
+
+# If set, messages being sent which take longer than this to render
+# are sent with a degraded rendering (their text, with links), and
+# rendered in full later, by the deferred_work queue worker; rather
+# than failing to send if they take over 5 seconds.
+MARKDOWN_RENDER_BUDGET_SECONDS: Optional[float] = None
+
 # How long after the last upgrade to nag users that the server needs
 # to be upgraded because of likely security releases in the meantime.
 # Default is 18 months, constructed as 12 months before someone should
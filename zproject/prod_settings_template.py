@@ -633,6 +633,21 @@ SOCIAL_AUTH_SAML_SUPPORT_CONTACT = {
 ## can also be disabled in a realm's organization settings.
 # INLINE_URL_EMBED_PREVIEW = True
 
+## Controls whether or not Zulip will translate messages into each
+## recipient's preferred language.  Translations are computed
+## asynchronously by the `translation` queue worker.
+# MESSAGE_TRANSLATION_ENABLED = True
+
+## The service used to translate messages.  "translate" uses the
+## public services supported by the `translate` Python package; "http"
+## uses a LibreTranslate-compatible server (e.g. a self-hosted one)
+## at TRANSLATION_SERVICE_URL, with an optional API key configured as
+## `translation_service_api_key` in /etc/zulip/zulip-secrets.conf;
+## "local" leaves messages untranslated, for servers without access
+## to a translation service.
+# TRANSLATION_BACKEND = "translate"
+# TRANSLATION_SERVICE_URL = "https://libretranslate.example.com/translate"
+
 ########
 ## Twitter previews.
 ##
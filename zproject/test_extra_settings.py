@@ -152,6 +152,9 @@ S3_AUTH_UPLOADS_BUCKET = "test-authed-bucket"
 S3_AVATAR_BUCKET = "test-avatar-bucket"
 
 INLINE_URL_EMBED_PREVIEW = False
+CACHE_RENDERED_MESSAGE_CONTENT = False
+MESSAGE_TRANSLATION_ENABLED = False
+TRANSLATION_BACKEND = "local"
 
 HOME_NOT_LOGGED_IN = "/login/"
 LOGIN_URL = "/accounts/login/"
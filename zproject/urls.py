@@ -19,7 +19,13 @@ from zerver.forms import LoggingSetPasswordForm
 from zerver.lib.integrations import WEBHOOK_INTEGRATIONS
 from zerver.lib.rest import rest_path
 from zerver.lib.url_redirects import DOCUMENTATION_REDIRECTS
-from zerver.tornado.views import cleanup_event_queue, get_events, get_events_internal, notify
+from zerver.tornado.views import (
+    cleanup_event_queue,
+    get_events,
+    get_events_internal,
+    get_notification_stats,
+    notify,
+)
 from zerver.views.alert_words import add_alert_words, list_alert_words, remove_alert_words
 from zerver.views.attachments import list_by_user, remove
 from zerver.views.auth import (
@@ -64,6 +70,7 @@ from zerver.views.invite import (
     revoke_multiuse_invite,
     revoke_user_invite,
 )
+from zerver.views.markdown_stats import get_markdown_stats
 from zerver.views.message_edit import (
     delete_message_backend,
     get_message_edit_history,
@@ -78,7 +85,12 @@ from zerver.views.message_flags import (
     update_message_flags,
     update_message_flags_for_narrow,
 )
-from zerver.views.message_send import render_message_backend, send_message_backend, zcommand_backend
+from zerver.views.message_send import (
+    render_message_backend,
+    send_message_backend,
+    send_messages_bulk_backend,
+    zcommand_backend,
+)
 from zerver.views.muted_users import mute_user, unmute_user
 from zerver.views.presence import (
     get_presence_backend,
@@ -346,6 +358,7 @@ v1_api_and_json_patterns = [
         DELETE=delete_message_backend,
     ),
     rest_path("messages/render", POST=render_message_backend),
+    rest_path("messages/bulk", POST=send_messages_bulk_backend),
     rest_path("messages/flags", POST=update_message_flags),
     rest_path("messages/flags/narrow", POST=update_message_flags_for_narrow),
     rest_path("messages/<int:message_id>/history", GET=get_message_edit_history),
@@ -726,6 +739,11 @@ urls += [
     path("email_mirror_message", email_mirror_message),
 ]
 
+# Used internally, for monitoring how long rendering messages takes
+urls += [
+    path("markdown/stats", get_markdown_stats),
+]
+
 # Include URL configuration files for site-specified extra installed
 # Django apps
 for app_name in settings.EXTRA_INSTALLED_APPS:
@@ -741,6 +759,7 @@ urls += [
     # Since these views don't use rest_dispatch, they cannot have
     # asynchronous Tornado behavior.
     path("notify_tornado", notify),
+    path("notify_tornado/stats", get_notification_stats),
     path("api/v1/events/internal", get_events_internal),
 ]
 